@@ -0,0 +1,123 @@
+import collections
+import math
+
+from constants import *
+
+QUOTE_MARKETS = ('BTC', 'ETH', 'USDT', 'KCS', 'NEO')
+
+
+class ArbitrageGraph(object):
+    """
+    Currency graph over every quote market, searched incrementally for profitable cycles of length 3 and 4.
+
+    Each symbol COIN-MARKET gives two edges weighted -log(rate): COIN -> MARKET selling at the bid and
+    MARKET -> COIN buying at the ask, both net of the trading fee. A cycle is profitable when its total weight is
+    negative. update() only re-evaluates the cycles that go through the edges whose weight changed, so a snapshot
+    where few tickers moved costs work in proportion to the edges touched, not a full rebuild.
+    """
+
+    def __init__(self, quote_markets=QUOTE_MARKETS, fee_rate=0.001, threshold=0.0):
+        self.quote_markets = set(quote_markets)
+        self.fee_rate = fee_rate
+        self.threshold = threshold
+        self.quotes = {}
+        self.weights = {}
+        self.out_edges = collections.defaultdict(set)
+        self.cycles = {}
+
+    def edge_weights(self, ticker):
+        fee_rate = ticker.get('feeRate', self.fee_rate)
+        bid, ask = ticker.get(BUY), ticker.get(SELL)
+        sell_weight = -math.log(bid * (1 - fee_rate)) if bid else None
+        buy_weight = -math.log((1 - fee_rate) / ask) if ask else None
+        return sell_weight, buy_weight
+
+    def set_edge(self, source, target, weight):
+        """
+        :return: True if the weight changed
+        """
+        edge = (source, target)
+        if weight is None:
+            if edge not in self.weights:
+                return False
+            del self.weights[edge]
+            self.out_edges[source].discard(target)
+            return True
+        if self.weights.get(edge) == weight:
+            return False
+        self.weights[edge] = weight
+        self.out_edges[source].add(target)
+        return True
+
+    def update(self, all_tickers):
+        """
+        Apply a (full or partial) get_tick snapshot and update the profitable cycles.
+        :return: (added, removed) cycles
+        """
+        touched = []
+        for ticker in all_tickers:
+            coin, market = ticker[COIN_TYPE], ticker[COIN_TYPE_PAIR]
+            if market not in self.quote_markets:
+                continue
+            quote = (ticker.get(BUY), ticker.get(SELL))
+            if self.quotes.get((coin, market)) == quote:
+                continue
+            self.quotes[(coin, market)] = quote
+            sell_weight, buy_weight = self.edge_weights(ticker)
+            for edge, weight in (((coin, market), sell_weight), ((market, coin), buy_weight)):
+                if weight is None and edge in self.weights:
+                    # Drop the cycles through an edge before it disappears from the adjacency.
+                    touched.extend(self.cycles_through(*edge))
+                if self.set_edge(edge[0], edge[1], weight):
+                    touched.extend(self.cycles_through(*edge))
+
+        added, removed = [], []
+        for cycle in set(touched):
+            profit = self.cycle_profit(cycle)
+            if profit is not None and profit > self.threshold:
+                if cycle not in self.cycles:
+                    added.append(cycle)
+                self.cycles[cycle] = profit
+            elif cycle in self.cycles:
+                del self.cycles[cycle]
+                removed.append(cycle)
+        return added, removed
+
+    def cycles_through(self, source, target):
+        """
+        Enumerate the cycles of length 3 and 4 that use the edge source -> target.
+        """
+        cycles = []
+        if (source, target) not in self.weights:
+            return cycles
+        for second in self.out_edges[target]:
+            if second == source:
+                continue
+            if source in self.out_edges[second]:
+                cycles.append(canonical_cycle((source, target, second)))
+            for third in self.out_edges[second]:
+                if third in (source, target) or source not in self.out_edges[third]:
+                    continue
+                cycles.append(canonical_cycle((source, target, second, third)))
+        return cycles
+
+    def cycle_profit(self, cycle):
+        total = 0.0
+        for i in range(len(cycle)):
+            weight = self.weights.get((cycle[i], cycle[(i + 1) % len(cycle)]))
+            if weight is None:
+                return None
+            total += weight
+        return math.exp(-total) - 1
+
+    def profitable_cycles(self):
+        """
+        :return: list of (profit, cycle), the most profitable first. A cycle is a tuple of currencies, each one
+                 traded for the next and the last one for the first.
+        """
+        return sorted(((profit, cycle) for cycle, profit in self.cycles.items()), reverse=True)
+
+
+def canonical_cycle(cycle):
+    start = cycle.index(min(cycle))
+    return tuple(cycle[start:] + cycle[:start])
@@ -0,0 +1,153 @@
+import base64
+import hashlib
+import hmac
+import time
+
+import aiohttp
+from kucoin.exceptions import *
+
+
+class AsyncClient(object):
+    """
+    Coroutine counterpart of the kucoin v1 Client for the endpoints the bot uses.
+
+    Requests are signed the same way as kucoin.client.Client and share one aiohttp session, so any number of
+    requests can be in flight at once. Methods return the same payloads as their Client counterparts.
+    """
+    API_URL = 'https://api.kucoin.com'
+    API_VERSION = 'v1'
+
+    def __init__(self, api_key, api_secret, pool_size=100):
+        self.API_KEY = api_key
+        self.API_SECRET = api_secret
+        self.pool_size = pool_size
+        self.session = None
+
+    async def open(self):
+        if not self.session:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                headers={'Accept': 'application/json', 'User-Agent': 'python-kucoin', 'KC-API-KEY': self.API_KEY,
+                         'HTTP_ACCEPT_LANGUAGE': 'en-US', 'Accept-Language': 'en-US'})
+        return self
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def _generate_signature(self, path, data, nonce):
+        query_string = '&'.join("{}={}".format(key, data[key]) for key in sorted(data))
+        sig_str = ("{}/{}/{}".format(path, nonce, query_string)).encode('utf-8')
+        m = hmac.new(self.API_SECRET.encode('utf-8'), base64.b64encode(sig_str), hashlib.sha256)
+        return m.hexdigest()
+
+    async def _request(self, method, path, signed, data=None):
+        data = data or {}
+        full_path = '/{}/{}'.format(self.API_VERSION, path)
+        headers = {}
+        if signed:
+            nonce = int(time.time() * 1000)
+            headers['KC-API-NONCE'] = str(nonce)
+            headers['KC-API-SIGNATURE'] = self._generate_signature(full_path, data, nonce)
+        kwargs = {'params': data} if method == 'get' else {'data': data}
+        await self.open()
+        async with self.session.request(method.upper(), self.API_URL + full_path, headers=headers, **kwargs) as response:
+            text = await response.text()
+            if not str(response.status).startswith('2'):
+                raise KucoinRequestException('HTTP %d: %s' % (response.status, text))
+            try:
+                json = await response.json(content_type=None)
+            except ValueError:
+                raise KucoinRequestException('Invalid Response: %s' % text)
+        if 'success' in json and not json['success']:
+            raise KucoinRequestException('%s: %s' % (json.get('code'), json.get('msg')))
+        if 'data' not in json:
+            return json
+        if isinstance(json['data'], dict) and 'timestamp' in json:
+            # Server time of the response in milliseconds, as OrderClient gives it.
+            json['data'].setdefault('timestamp', json['timestamp'])
+        return json['data']
+
+    async def get_order_book(self, symbol, group=None, limit=None):
+        data = {'symbol': symbol}
+        if group:
+            data['group'] = group
+        if limit:
+            data['limit'] = limit
+        return await self._request('get', 'open/orders', False, data)
+
+    async def get_tick(self, symbol=None):
+        return await self._request('get', 'open/tick', False, {'symbol': symbol} if symbol else None)
+
+    async def get_currencies(self, coins=None):
+        data = {}
+        if coins:
+            data['coins'] = ','.join(coins if type(coins) == list else [coins])
+        return await self._request('get', 'open/currencies', False, data)
+
+    async def create_order(self, symbol, order_type, price, amount):
+        data = {'symbol': symbol, 'type': order_type, 'price': price, 'amount': amount}
+        return await self._request('post', 'order', True, data)
+
+    async def cancel_order(self, order_id, order_type, symbol=None):
+        data = {'orderOid': order_id}
+        if order_type:
+            data['type'] = order_type
+        if symbol:
+            data['symbol'] = symbol
+        return await self._request('post', 'cancel-order', True, data)
+
+    async def cancel_all_orders(self, symbol=None, order_type=None):
+        data = {}
+        if order_type:
+            data['type'] = order_type
+        if symbol:
+            data['symbol'] = symbol
+        return await self._request('post', 'order/cancel-all', True, data)
+
+    async def get_active_orders(self, symbol):
+        return await self._request('get', 'order/active', True, {'symbol': symbol})
+
+    async def get_symbol_dealt_orders(self, symbol, order_type=None, limit=None, page=None):
+        data = {'symbol': symbol}
+        if order_type:
+            data['type'] = order_type
+        if limit:
+            data['limit'] = limit
+        if page:
+            data['page'] = page
+        return await self._request('get', 'deal-orders', True, data)
+
+    async def get_dealt_orders(self, symbol=None, order_type=None, limit=None, page=None, since=None, before=None):
+        data = {}
+        if symbol:
+            data['symbol'] = symbol
+        if order_type:
+            data['type'] = order_type
+        if limit:
+            data['limit'] = limit
+        if page:
+            data['page'] = page
+        if since:
+            data['since'] = since
+        if before:
+            data['before'] = before
+        return await self._request('get', 'order/dealt', True, data)
+
+    async def get_coin_balance(self, coin):
+        return await self._request('get', 'account/{}/balance'.format(coin), True)
+
+    async def get_all_balances(self, limit=None, page=None):
+        data = {}
+        if limit:
+            data['limit'] = limit
+        if page:
+            data['page'] = page
+        return await self._request('get', 'account/balance', True, data)
+
+    async def get_total_balance(self, currency='USD'):
+        balances = await self.get_all_balances()
+        rates = (await self.get_currencies([b['coinType'] for b in balances]))['rates']
+        return sum((b['balance'] + b['freezeBalance']) * rates[b['coinType']][currency] for b in balances
+                   if b['coinType'] in rates)
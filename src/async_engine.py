@@ -0,0 +1,346 @@
+import asyncio
+
+import aiohttp
+from kucoin.exceptions import *
+
+import flight_recorder
+import metrics
+from cleanup import AsyncCleanupCoordinator
+from fill_tracker import AsyncFillTracker
+from quotes import order_text
+from utility import *
+
+log = logging.getLogger(__name__)
+
+
+class AsyncEngine(object):
+    """
+    Asyncio alternative to the Trader/AccountManager threads.
+
+    Every scan coin gets its own scanning coroutine, and order book fetches, order creation, fill tracking, clean-ups
+    and rebalancing all run as coroutines on the shared AsyncClient session, the transaction helper's fill tracker
+    and clean-up coordinator being replaced by their async counterparts. Spread detection and order building are
+    delegated to Helper. Trades are serialized by trade_lock, the rebalancing runs alongside them, its orders only
+    taking the funds they reserve in the balance ledger.
+    """
+
+    def __init__(self, helper, client, coins, scan_interval=0.02, rebalance_interval=100):
+        self.helper = helper
+        self.client = client
+        self.coins = coins
+        self.scan_interval = scan_interval
+        self.rebalance_interval = rebalance_interval
+        self.trade_lock = asyncio.Lock()
+        self.stop = False
+        self.asset = 0.0
+        self.initial_asset = None
+        transaction_helper = helper.transaction_helper
+        transaction_helper.fill_tracker.stop = True
+        transaction_helper.fill_tracker = AsyncFillTracker(client)
+        transaction_helper.cleanup = AsyncCleanupCoordinator(client, transaction_helper.fill_tracker)
+
+    async def get_order_book(self, symbol):
+        response = await async_call_api_with_retry(self.client.get_order_book, symbol, None,
+                                                   self.helper.ORDER_BOOK_DEPTH)
+        ticker = self.helper.make_ticker(symbol, response)
+        flight_recorder.RECORDER.ticker(ticker)
+        if self.helper.recorder:
+            self.helper.recorder.record(ticker)
+        return ticker
+
+    async def get_order_book_hedged(self, symbol, hedge_delay):
+        """
+        Get an order book, sending a duplicate request if the first one is still pending after hedge_delay.
+        """
+        attempts = {asyncio.ensure_future(self.get_order_book(symbol))}
+        if hedge_delay is not None:
+            done, _ = await asyncio.wait(attempts, timeout=hedge_delay)
+            if not done:
+                self.helper.transaction_helper.deadlines.hedges += 1
+                attempts.add(asyncio.ensure_future(self.get_order_book(symbol)))
+        try:
+            while True:
+                done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [attempt for attempt in done if not attempt.exception()]
+                if succeeded or not attempts:
+                    return (succeeded or list(done))[0].result()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def get_orderbook_parallel(self, symbol_list, timeout=None):
+        if self.helper.market_data:
+            tickers = [self.helper.market_data.get_ticker(symbol) for symbol in symbol_list]
+            if all(tickers):
+                return tickers
+        deadlines = self.helper.transaction_helper.deadlines
+        hedge_delay = deadlines.hedge_delay()
+        try:
+            return await asyncio.wait_for(asyncio.gather(*[self.get_order_book_hedged(symbol, hedge_delay)
+                                                           for symbol in symbol_list]),
+                                          deadlines.book_deadline() if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            log.warning("Didn't finish getting order books on time.")
+        except Exception as e:
+            log.error("Error while getting order book parallel.")
+            log.error(e, exc_info=True)
+            await asyncio.sleep(0.5)
+
+    async def detect_spread_and_fill(self, coin):
+        tickers = await self.get_orderbook_parallel(list(self.helper.get_triangle_symbols(coin)))
+        if not tickers:
+            return False
+        order_group = self.helper.prepare_order_group(coin, tickers)
+        if order_group is False:
+            await asyncio.sleep(0.5)
+        if not order_group:
+            return False
+        waited = self.trade_lock.locked()
+        async with self.trade_lock:
+            if waited:
+                # Balances and books moved while another trade held the lock.
+                tickers = await self.get_orderbook_parallel(list(self.helper.get_triangle_symbols(coin)))
+                order_group = self.helper.prepare_order_group(coin, tickers) if tickers else None
+                if not order_group:
+                    return False
+            return await self.create_order_group(*order_group)
+
+    async def create_order_group(self, spread, order_1_params, order_2_params, order_3_params, direction):
+        if not self.helper.clears_threshold(spread):
+            if sample_log('spread_lower', self.helper.HOT_LOG_SAMPLE):
+                log.info("Spread lower than minimum requirement." + " {:.2%}".format((spread - 1) / 1.0))
+            return False
+        order_params_group = [order_1_params, order_2_params, order_3_params]
+        log_json_utils(log.info, message="Creating 3 combo orders", data=order_params_group)
+        deal_ratio = await self.deal_parallel_orders(order_params_group)
+        if deal_ratio < 0.5:
+            self.helper.ledger.request_reconcile()
+        return self.helper.record_trade_result(order_1_params, order_3_params, direction, deal_ratio)
+
+    async def match_active_order(self, order_params):
+        response = await async_call_api_with_retry(self.client.get_active_orders, order_params['symbol'])
+        for order in response['BUY'] + response['SELL']:
+            if order[1] == order_params['type'] and abs(order[2] - order_params['price']) < 1e-9 and abs(
+                    order[3] - order_params['amount']) < 1e-9 and self.helper.transaction_helper.claim_order(order[5]):
+                return order[5]
+
+    async def match_dealt_orders(self, order_params):
+        response = await async_call_api_with_retry(self.client.get_symbol_dealt_orders, order_params['symbol'],
+                                                   order_params['type'], 6)
+        for order in response['datas']:
+            if order['direction'] == order_params['type'] and time.time() * 1000 - float(order['createdAt']) < 200000 \
+                    and self.helper.transaction_helper.claim_order(order['orderOid']):
+                return order['orderOid'], order['amount']
+        return None, 0.0
+
+    async def create_order(self, order_params):
+        price, amount = order_text(order_params)
+        log_json_utils(log.info, message="Creating an order.", symbol=order_params['symbol'], type=order_params['type'],
+                       price=price, amount=amount)
+        try:
+            response = await self.client.create_order(order_params['symbol'], order_params['type'], price, amount)
+            if not response or "orderOid" not in response:
+                raise TypeError("None or invalid response type.")
+            return response["orderOid"], 0.0
+        except (KucoinAPIException, KucoinRequestException, TypeError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error('Error while creating an order for %s' % order_params['symbol'].split('-')[0])
+            log.error(e, exc_info=True)
+
+        log.error('Checking active orders and dealt orders to locate the order.')
+        for i in range(4):
+            orderOid = await self.match_active_order(order_params)
+            if orderOid:
+                return orderOid, 0.0
+            dealt_orderOid, deal_amount = await self.match_dealt_orders(order_params)
+            if dealt_orderOid:
+                return dealt_orderOid, deal_amount
+            await asyncio.sleep(0.2 * (2 ** i))
+        raise Exception("Order creation failed, cannot locate the orderOid.")
+
+    async def create_and_track_single_order(self, order_params, additional_wait_time=0):
+        reservation = self.helper.transaction_helper.reserve([order_params])
+        if reservation is False:
+            return 0.0
+        try:
+            return await self.create_track_and_apply(order_params, additional_wait_time)
+        finally:
+            self.helper.transaction_helper.release(reservation)
+
+    async def create_track_and_apply(self, order_params, additional_wait_time=0):
+        deal_ratio = None
+        try:
+            deal_ratio = await self.track_single_order(order_params, additional_wait_time)
+            return deal_ratio
+        finally:
+            if deal_ratio is None:
+                self.helper.ledger.request_reconcile()
+            else:
+                self.helper.ledger.apply_fill(order_params, order_params['amount'] * deal_ratio)
+
+    async def track_single_order(self, order_params, additional_wait_time=0):
+        start_time = time.time()
+        orderOid, deal_amount = await self.create_order(order_params)
+        transaction_helper = self.helper.transaction_helper
+        transaction_helper.cleanup.register(order_params, orderOid)
+        log_json_utils(log.info, message="Successfully created an order.", orderOid=orderOid,
+                       symbol=order_params['symbol'], type=order_params['type'])
+        metrics.REGISTRY.observe('order_reaction', time.time() - start_time)
+        flight_recorder.RECORDER.order_submit(order_params, deal_amount, time.time() - start_time)
+        if abs(order_params['amount'] - deal_amount) < 1e-9:
+            log.info("Order %s has been fully dealt.", orderOid)
+            return 1.0
+        deal_amount = await transaction_helper.fill_tracker.track(
+            orderOid, order_params, transaction_helper.tracking_timeout(additional_wait_time))
+        if deal_amount / order_params['amount'] > 0.999:
+            log.info("Order %s has been fully dealt.", orderOid)
+            return 1.0
+        if transaction_helper.cleanup.is_confirmed(orderOid):
+            log.error("Order %s has been cancelled by the clean-up of its group.", orderOid)
+            return deal_amount / order_params['amount']
+        log_json_utils(log.error, message="The transaction didn't finished on time. Cancelling...",
+                       orderOid=orderOid, symbol=order_params['symbol'], type=order_params['type'],
+                       amount=order_params['amount'], deal_amount=deal_amount)
+        await async_call_api_with_retry(self.client.cancel_order, orderOid, order_params['type'],
+                                        symbol=order_params['symbol'])
+        log.error("Successfully cancelled order %s", orderOid)
+        return deal_amount / order_params['amount']
+
+    async def deal_parallel_orders(self, order_params_group, timeout=None, additional_wait_time=0):
+        """
+        Create and track all orders of the group at once.
+        :param timeout: seconds to wait for the group, None to derive it from the tracking timeout and the latencies
+        :return: ratio of dealt quantity against submitted quantity
+        """
+        transaction_helper = self.helper.transaction_helper
+        if timeout is None:
+            timeout = transaction_helper.deadlines.group_deadline(
+                transaction_helper.tracking_timeout(additional_wait_time))
+        reservation = transaction_helper.reserve(order_params_group)
+        if reservation is False:
+            return 0.0
+        transaction_helper.cleanup.open_group(order_params_group)
+        # Legs keep running past the timeout, the reservation is released once they are done.
+        tasks = [asyncio.ensure_future(self.create_track_and_apply(order_params, additional_wait_time))
+                 for order_params in order_params_group]
+        group_done = transaction_helper.release_when_done(tasks, reservation, order_params_group)
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+            results = [task.exception() or task.result() for task in done]
+            if pending:
+                log.error("Orders weren't dealt on time.")
+                results.append(0.0)
+            min_deal_ratio = 1.0
+            for result in results:
+                if isinstance(result, Exception):
+                    log.error("Error while deal orders parallel.")
+                    log.error(result, exc_info=result)
+                    result = 0.0
+                min_deal_ratio = min(min_deal_ratio, result)
+            if abs(1.0 - min_deal_ratio) >= 0.02:
+                await self.trade_on_fail(order_params_group)
+            return min_deal_ratio
+        finally:
+            group_done()
+
+    async def trade_on_fail(self, order_params_group):
+        """
+        Cancel what is left of a failed order group, see TransactionHelper.trade_on_fail.
+        """
+        log.info("Clean-up, cancelling the orders of the group.")
+        try:
+            return await self.helper.transaction_helper.cleanup.cleanup(order_params_group)
+        except Exception as e:
+            log.error("Failed to clean up the order group.")
+            log.error(e, exc_info=True)
+
+    async def fill_balances_gap(self):
+        log.info("Balancing coin balances.")
+        helper = self.helper
+        full_coin_list = [helper.market_1, helper.market_2] + self.coins
+        rates, all_balances = await asyncio.gather(
+            async_call_api_with_retry(self.client.get_currencies, full_coin_list),
+            async_call_api_with_retry(self.client.get_all_balances, helper.ledger.BALANCES_LIMIT))
+        exchange_rate = {k: float(v['USD']) for k, v in rates['rates'].items()}
+        # get_all_balances is paged, read the coins missing from its page one by one.
+        all_balances = dict((entry['coinType'], entry) for entry in all_balances)
+        missing = [coin for coin in full_coin_list if coin not in all_balances]
+        entries = await asyncio.gather(*[async_call_api_with_retry(self.client.get_coin_balance, coin)
+                                         for coin in missing])
+        all_balances.update(zip(missing, entries))
+        balance = helper.total_balances(all_balances, full_coin_list)
+        usd_balance = dict((coin, exchange_rate[coin] * balance[coin]) for coin in full_coin_list)
+        helper.market_1_price = exchange_rate[helper.market_1]
+        log.info("Listing USD valued balances for all trading coins.")
+        log_json_utils(log.info, **usd_balance)
+
+        planned_orders = helper.rebalance_planner.plan(self.coins, usd_balance, exchange_rate)
+        spendable = helper.unreserved_balances(all_balances, full_coin_list)
+        for wave in helper.rebalance_planner.waves(planned_orders, spendable, exchange_rate):
+            books = await asyncio.gather(*[async_call_api_with_retry(self.client.get_order_book, order['symbol'],
+                                                                     None, 1) for order in wave])
+            results = await asyncio.gather(*[self.create_and_track_single_order(
+                helper.price_balance_order(order, book)) for order, book in zip(wave, books)],
+                return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    log.error("Error while creating a balance order.")
+                    log.error(result, exc_info=result)
+
+        log.info("Listing USD valued balances for all trading coins after filling gap.")
+        log_json_utils(log.info, **usd_balance)
+        helper.ledger.request_reconcile()
+        log.info("Finished filling balance gap.")
+
+    async def scan_loop(self, coin):
+        while not self.stop:
+            try:
+                # Re-scan right away after a fill to take more pending amount.
+                if await self.detect_spread_and_fill(coin):
+                    continue
+            except Exception as e:
+                log.error("Failed to detect spread and create orders for %s." % coin)
+                log.error(e, exc_info=True)
+                await asyncio.sleep(1)
+            await asyncio.sleep(self.scan_interval)
+
+    async def account_loop(self):
+        i = 0
+        while not self.stop:
+            if i % 3 == 0:
+                log.info("Running account manager...")
+                try:
+                    self.asset = await self.client.get_total_balance()
+                    if not self.initial_asset:
+                        self.initial_asset = self.asset
+                    log.info("Current asset is %.2f" % self.asset)
+                except Exception as e:
+                    log.error("Failed to get the account total balance.")
+                    log.error(e, exc_info=True)
+            try:
+                await self.fill_balances_gap()
+            except Exception as e:
+                log.error("Failed to fill the balances gap.")
+                log.error(e, exc_info=True)
+            i += 1
+            await asyncio.sleep(self.rebalance_interval)
+
+    async def monitor_loop(self):
+        i = 0
+        while not self.stop:
+            await asyncio.sleep(300)
+            i += 1
+            log.info("Round %d - Asset %.f - Profit %.8f" % (i, self.asset, self.helper.profit))
+            log_json_utils(log.info, message="Trade statics", data=self.helper.trade_static)
+            log_json_utils(log.info, message="API latency percentiles", data=metrics.REGISTRY.summary())
+            if self.initial_asset and (self.asset / self.initial_asset) < 0.8:
+                log.critical("Profit change reached threshold %.8f" % self.helper.profit)
+                self.stop = True
+
+    async def run(self):
+        await self.client.open()
+        fill_tracker = asyncio.ensure_future(self.helper.transaction_helper.fill_tracker.run())
+        try:
+            await asyncio.gather(self.account_loop(), self.monitor_loop(), *[self.scan_loop(coin) for coin in self.coins])
+        finally:
+            fill_tracker.cancel()
+            await self.client.close()
@@ -0,0 +1,202 @@
+"""
+Replay a BookRecorder log through Helper and TransactionHelper with a simulated client.
+
+    python src/backtester.py --log /logs/books.bin --market BTC-ETH --balances BTC=1-ETH=20-NEO=100
+
+Fill model: an order fills right away against the recorded book it was decided on, taking liquidity level by
+level up to its limit price; liquidity taken stays taken until the next snapshot of the symbol. Whatever does
+not fill right away is cancelled by the order tracking, as the book has usually moved on by then.
+"""
+import argparse
+import collections
+import itertools
+import threading
+
+import requests
+
+import flight_recorder
+from balance_ledger import TRADE_FEE_RATE
+from book_recorder import BookLog
+from constants import *
+from helper import Helper
+from utility import *
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PRECISION = {'BTC': 8, 'ETH': 6, 'USDT': 4}
+
+
+class ReplayClient(object):
+    """
+    Stand-in for the kucoin Client serving recorded books and filling orders against them.
+    """
+
+    def __init__(self, balances, precision=None, rates=None, fee_rate=TRADE_FEE_RATE):
+        self.session = requests.Session()
+        self.balances = collections.defaultdict(float, balances)
+        self.precision = precision or {}
+        self.rates = rates or {}
+        self.fee_rate = fee_rate
+        self.books = {}
+        self.timestamp = 0.0
+        self.order_ids = itertools.count()
+        self.deals = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def set_book(self, timestamp, ticker):
+        self.timestamp = timestamp
+        self.books[ticker['symbol']] = {'BUY': [list(level) for level in ticker['BUY_LEVELS']],
+                                        'SELL': [list(level) for level in ticker['SELL_LEVELS']]}
+
+    def get_coin_list(self):
+        coins = set(self.balances)
+        for symbol in self.books:
+            coins.update(symbol.split('-'))
+        return [{'coin': coin, 'tradePrecision': self.precision.get(coin, DEFAULT_PRECISION.get(coin, 4))}
+                for coin in coins]
+
+    def get_all_balances(self, limit=None, page=None):
+        return [{'coinType': coin, 'balance': balance, 'freezeBalance': 0.0} for coin, balance in self.balances.items()]
+
+    def get_coin_balance(self, coin):
+        return {'coinType': coin, 'balance': self.balances[coin], 'freezeBalance': 0.0}
+
+    def get_currencies(self, coins=None):
+        return {'rates': dict((coin, {'USD': self.rates.get(coin, 1.0)}) for coin in (coins or self.rates))}
+
+    def get_order_book(self, symbol, group=None, limit=None):
+        book = self.books[symbol]
+        return {'BUY': [level + [level[0] * level[1]] for level in book['BUY'][:limit]],
+                'SELL': [level + [level[0] * level[1]] for level in book['SELL'][:limit]],
+                'timestamp': int(self.timestamp * 1000)}
+
+    def create_order(self, symbol, order_type, price, amount):
+        with self.lock:
+            return self.fill_order(symbol, order_type, float(price), float(amount))
+
+    def fill_order(self, symbol, order_type, price, amount):
+        coin, market = symbol.split('-')
+        order_id = 'replay-%d' % next(self.order_ids)
+        # A BUY takes the asks (the 'SELL' side of the book) at or below its price, a SELL the bids.
+        levels = self.books[symbol]['SELL' if order_type == 'BUY' else 'BUY']
+        remaining = amount
+        while remaining > 1e-12 and levels:
+            level = levels[0]
+            if (order_type == 'BUY' and level[0] > price) or (order_type == 'SELL' and level[0] < price):
+                break
+            taken = min(level[1], remaining)
+            remaining -= taken
+            level[1] -= taken
+            if level[1] <= 1e-12:
+                levels.pop(0)
+            value = taken * level[0]
+            if order_type == 'BUY':
+                self.balances[coin] += taken * (1 - self.fee_rate)
+                self.balances[market] -= value
+            else:
+                self.balances[coin] -= taken
+                self.balances[market] += value * (1 - self.fee_rate)
+            self.deals[symbol].insert(0, {'orderOid': order_id, 'direction': order_type, 'amount': taken,
+                                          'dealPrice': level[0], 'dealValue': value,
+                                          'createdAt': self.timestamp * 1000})
+        return {'orderOid': order_id}
+
+    def get_symbol_dealt_orders(self, symbol, order_type=None, limit=None, page=None):
+        deals = [deal for deal in self.deals[symbol] if not order_type or deal['direction'] == order_type]
+        return {'datas': deals[:limit]}
+
+    def get_active_orders(self, symbol, kv_format=False):
+        return {'BUY': [], 'SELL': []}
+
+    def cancel_order(self, order_id, order_type, symbol=None):
+        return {}
+
+    def cancel_all_orders(self, symbol=None, order_type=None):
+        return {}
+
+
+class Backtester(object):
+    """
+    Feed every snapshot of a BookLog through Helper.prepare_order_group and create_order_group_helper.
+
+    A coin is evaluated whenever one of its three books changes and all three have been seen.
+    """
+
+    def __init__(self, book_log, market_1, market_2, balances, threshold=None, trade_ratio=None, precision=None,
+                 rates=None):
+        self.book_log = book_log
+        self.client = ReplayClient(balances, precision, rates)
+        # Seed the books so Helper resolves the trade precision of every recorded coin.
+        for symbol in book_log.symbols:
+            self.client.books.setdefault(symbol, {'BUY': [], 'SELL': []})
+        self.helper = Helper(self.client, market_1, market_2)
+        # Replayed failures are expected, the outcome is in the stats.
+        flight_recorder.RECORDER.enabled = False
+        if threshold is not None:
+            self.helper.TRADE_THRESHOLD = threshold
+        if trade_ratio is not None:
+            self.helper.trade_ratio = trade_ratio
+        self.helper.market_1_price = self.client.rates.get(market_1)
+        # Orders only fill against the book they were decided on, don't wait for later fills.
+        self.helper.transaction_helper.fill_poll_step = 0.0
+        self.helper.transaction_helper.fill_tracker.poll_interval = 0.0
+        self.coins_by_symbol = collections.defaultdict(list)
+        for symbol in book_log.symbols:
+            coin, market = symbol.split('-')
+            triangle = self.helper.get_triangle_symbols(coin)
+            if market in (market_1, market_2) and all(s in book_log.symbols for s in triangle) and all(
+                    s in self.helper.min_amount for s in triangle[:2]):
+                for triangle_symbol in triangle:
+                    self.coins_by_symbol[triangle_symbol].append(coin)
+        self.tickers = {}
+        self.scans = 0
+
+    def run(self):
+        initial_balances = dict(self.client.balances)
+        start_time = time.time()
+        first_timestamp = last_timestamp = None
+        for timestamp, ticker in self.book_log.tickers():
+            first_timestamp = first_timestamp or timestamp
+            last_timestamp = timestamp
+            self.client.set_book(timestamp, ticker)
+            self.tickers[ticker['symbol']] = ticker
+            for coin in self.coins_by_symbol.get(ticker['symbol'], ()):
+                triangle = self.helper.get_triangle_symbols(coin)
+                if not all(symbol in self.tickers for symbol in triangle):
+                    continue
+                self.scans += 1
+                order_group = self.helper.prepare_order_group(coin, [self.tickers[symbol] for symbol in triangle])
+                if order_group:
+                    self.helper.create_order_group_helper(*order_group)
+                    # Keep the ledger exact, it applies fills at the limit price.
+                    self.helper.ledger.reconcile()
+        elapsed = time.time() - start_time
+        return {'records': len(self.book_log), 'scans': self.scans, 'replay_seconds': elapsed,
+                'recorded_seconds': (last_timestamp - first_timestamp) if first_timestamp else 0.0,
+                'profit': self.helper.profit, 'trade_static': self.helper.trade_static,
+                'initial_balances': initial_balances, 'final_balances': dict(self.client.balances)}
+
+
+def parse_pairs(value):
+    pairs = value.split('-') if value else []
+    return dict((pair.split('=')[0], float(pair.split('=')[1])) for pair in pairs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded order books through the trading logic")
+    parser.add_argument('--log', required=True, help='binary book log written with --record.')
+    parser.add_argument('--market', default='BTC-ETH', help='The two markets to trade against.')
+    parser.add_argument('--balances', required=True, help='initial balances, e.g. BTC=1-ETH=20-NEO=100.')
+    parser.add_argument('--rates', default='', help='USD rates, e.g. BTC=8000-ETH=500.')
+    parser.add_argument('--precision', default='', help='trade precision overrides, e.g. NEO=3.')
+    parser.add_argument('--threshold', type=float, help='override Helper.TRADE_THRESHOLD.')
+    parser.add_argument('--trade-ratio', type=float, help='override Helper.trade_ratio.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
+
+    markets = args.market.split('-')
+    precision = dict((coin, int(value)) for coin, value in parse_pairs(args.precision).items())
+    backtester = Backtester(BookLog(args.log), markets[0], markets[1], parse_pairs(args.balances),
+                            threshold=args.threshold, trade_ratio=args.trade_ratio, precision=precision,
+                            rates=parse_pairs(args.rates))
+    print(json.dumps(backtester.run(), indent=2))
@@ -0,0 +1,276 @@
+import collections
+import itertools
+import threading
+
+from utility import *
+
+log = logging.getLogger(__name__)
+
+TRADE_FEE_RATE = 0.001
+
+
+def fill_changes(symbol, order_type, deal_amount, value, fee_rate=TRADE_FEE_RATE, fee=None):
+    """
+    :return: {coin: signed amount} a fill of deal_amount for value makes to the balances, the fee being charged on
+             the received coin
+    """
+    coin, market = symbol.split('-')
+    if order_type == 'BUY':
+        return {coin: deal_amount - (deal_amount * fee_rate if fee is None else fee), market: -value}
+    return {coin: -deal_amount, market: value - (value * fee_rate if fee is None else fee)}
+
+
+class BalanceStore(object):
+    """
+    Balances and reservations of a BalanceLedger, every method being atomic.
+
+    Kept apart from the ledger so that several processes can share one store through a multiprocessing manager,
+    see sharding.py.
+    """
+
+    def __init__(self):
+        self.balances = {}
+        self.reservations = {}
+        self.reserved = collections.defaultdict(float)
+        self.reservation_ids = itertools.count()
+        # Bumped on every local fill, a reconciliation racing with a fill is dropped and retried.
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get_generation(self):
+        return self.generation
+
+    def replace_balances(self, balances, generation):
+        """
+        Replace the balances of the coins no order in flight spends or receives: fills of those may or may not be
+        in the exchange balances yet, they are left to a later reconciliation.
+        :return: sorted coins left out, None if the balances changed since generation was read
+        """
+        with self.lock:
+            if generation != self.generation:
+                return None
+            busy = set(coin for amounts in self.reservations.values() for coin in amounts)
+            for coin in set(self.balances) | set(balances):
+                if coin in busy:
+                    continue
+                if coin in balances:
+                    self.balances[coin] = balances[coin]
+                else:
+                    self.balances.pop(coin, None)
+            return sorted(busy)
+
+    def balance(self, coin):
+        return self.balances.get(coin, 0.0)
+
+    def available(self, coin):
+        with self.lock:
+            return self.balances.get(coin, 0.0) - self.reserved[coin]
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.balances)
+
+    def reserve(self, amounts):
+        """
+        :param amounts: {coin: amount} to reserve, all or nothing
+        :return: reservation id, or None if the available balance is not enough
+        """
+        with self.lock:
+            for coin, amount in amounts.items():
+                if amount > 0 and self.balances.get(coin, 0.0) - self.reserved[coin] < amount - 1e-12:
+                    return None
+            for coin, amount in amounts.items():
+                self.reserved[coin] += amount
+            reservation_id = next(self.reservation_ids)
+            self.reservations[reservation_id] = amounts
+            return reservation_id
+
+    def release(self, reservation_id):
+        with self.lock:
+            for coin, amount in self.reservations.pop(reservation_id, {}).items():
+                self.reserved[coin] -= amount
+
+    def apply(self, changes):
+        """
+        :param changes: {coin: signed amount} added to the balances
+        """
+        with self.lock:
+            self.generation += 1
+            for coin, change in changes.items():
+                self.balances[coin] = self.balances.get(coin, 0.0) + change
+
+
+class ReservationManager(object):
+    """
+    Reservations of funds per asset, taken by whatever moves balances: a triangle reserves its amounts of market_1,
+    market_2 and the coin, a balance order only the coin it spends. Reservations on different assets, or on one
+    asset with enough available for both, never wait for each other, so trading and rebalancing run side by side.
+
+    A reservation is all or nothing and is never bypassed: once timeout runs out it is refused and the caller skips
+    the orders. Waiters are woken by the releases of this process and poll for those of other processes sharing the
+    store.
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, store):
+        self.store = store
+        self.condition = threading.Condition()
+        self.granted = 0
+        self.waited = 0
+        # Refused reservations per short asset
+        self.refused = collections.Counter()
+
+    def reserve(self, amounts, timeout=0.0):
+        """
+        :param amounts: {coin: amount} to reserve
+        :param timeout: seconds to wait for the other reservations to leave enough available
+        :return: reservation id, or None if the available balance is still not enough after timeout
+        """
+        deadline = time.time() + timeout
+        waited = False
+        with self.condition:
+            while True:
+                reservation_id = self.store.reserve(amounts)
+                if reservation_id is not None:
+                    self.granted += 1
+                    if waited:
+                        self.waited += 1
+                    return reservation_id
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                waited = True
+                self.condition.wait(min(remaining, self.POLL_INTERVAL))
+        short = [coin for coin, amount in amounts.items()
+                 if amount > 0 and self.store.available(coin) < amount - 1e-12]
+        self.refused.update(short)
+        log.error("Not enough %s available to reserve %s", ', '.join(short) or 'balance', amounts)
+        return None
+
+    def release(self, reservation_id):
+        self.store.release(reservation_id)
+        with self.condition:
+            self.condition.notify_all()
+
+    def stats(self):
+        return {'granted': self.granted, 'waited': self.waited, 'refused': sum(self.refused.values())}
+
+    def refused_assets(self):
+        """
+        :return: {asset: number of reservations refused for lack of it}
+        """
+        return dict(self.refused)
+
+
+class BalanceLedger(threading.Thread):
+    """
+    Local balance book kept up to date from our own fills.
+
+    Each leg's dealt amount and fee is applied as soon as it is known, funds of orders in flight are reserved so
+    trade sizing never over-commits, and the ledger is reconciled against get_all_balances in the background every
+    reconcile_interval seconds or when request_reconcile() is called. The state lives in store, a BalanceStore or a
+    proxy of one shared with other processes.
+    """
+    # Entries of a get_all_balances page, the most the exchange serves.
+    BALANCES_LIMIT = 20
+
+    def __init__(self, client, reconcile_interval=120, fee_rate=TRADE_FEE_RATE, store=None):
+        threading.Thread.__init__(self, name="BalanceLedger", daemon=True)
+        self.client = client
+        self.reconcile_interval = reconcile_interval
+        self.fee_rate = fee_rate
+        self.store = store if store is not None else BalanceStore()
+        self.reservations = ReservationManager(self.store)
+        self.reconcile_event = threading.Event()
+        self.stop = False
+
+    def reconcile(self):
+        """
+        Replace the local balances with the exchange balances.
+        :return: True if the exchange balances have been applied
+        """
+        generation = self.store.get_generation()
+        balances = self.get_balances()
+        skipped = self.store.replace_balances(balances, generation)
+        if skipped is None:
+            log.info("Balances changed while reconciling, retrying later.")
+            return False
+        log_json_utils(log.info, message="Finished reconciling balance ledger", data=balances, skipped=skipped)
+        return True
+
+    def get_balances(self):
+        """
+        :return: {coin: balance} of every page of get_all_balances
+        """
+        balances, page = {}, 1
+        while True:
+            response = call_api_with_retry(self.client.get_all_balances, self.BALANCES_LIMIT, page)
+            new = [entry for entry in response if entry['coinType'] not in balances]
+            for entry in new:
+                balances[entry['coinType']] = float(entry['balance'])
+            # A short page is the last one, a client ignoring the paging serves every balance at once.
+            if len(response) < self.BALANCES_LIMIT or not new:
+                return balances
+            page += 1
+
+    def request_reconcile(self):
+        self.reconcile_event.set()
+
+    def run(self):
+        while not self.stop:
+            self.reconcile_event.wait(self.reconcile_interval)
+            self.reconcile_event.clear()
+            try:
+                if not self.reconcile():
+                    self.reconcile_event.set()
+                    time.sleep(1)
+            except Exception as e:
+                log.error("Failed to reconcile the balance ledger.")
+                log.error(e, exc_info=True)
+                time.sleep(1)
+
+    def balance(self, coin):
+        return self.store.balance(coin)
+
+    def available(self, coin):
+        return self.store.available(coin)
+
+    def snapshot(self):
+        return self.store.snapshot()
+
+    @staticmethod
+    def order_cost(order_params):
+        """
+        :return: {coin: amount} spent by an order once fully dealt
+        """
+        coin, market = order_params['symbol'].split('-')
+        if order_params['type'] == 'BUY':
+            return {market: order_params['amount'] * order_params['price']}
+        return {coin: order_params['amount']}
+
+    def reserve(self, order_params_group, timeout=0.0):
+        """
+        Reserve the funds of a group of orders, all or nothing.
+        :param timeout: seconds to wait for other reservations of the same assets to be released
+        :return: reservation id, or None if the available balance is not enough
+        """
+        amounts = collections.defaultdict(float)
+        for order_params in order_params_group:
+            # The received coin is reserved with no amount, its balance is busy until the fill is applied.
+            for coin in order_params['symbol'].split('-'):
+                amounts[coin] += 0.0
+            for coin, amount in self.order_cost(order_params).items():
+                amounts[coin] += amount
+        return self.reservations.reserve(dict(amounts), timeout)
+
+    def release(self, reservation_id):
+        self.reservations.release(reservation_id)
+
+    def apply_fill(self, order_params, deal_amount, fee=None):
+        """
+        Apply the dealt amount of an order. The fee is charged on the received coin, at fee_rate unless given.
+        """
+        if deal_amount <= 0:
+            return
+        self.store.apply(fill_changes(order_params['symbol'], order_params['type'], deal_amount,
+                                      deal_amount * order_params['price'], self.fee_rate, fee))
@@ -0,0 +1,294 @@
+"""
+Benchmarks of the spread detection and order group hot paths, run against a simulated exchange.
+
+    python src/benchmark.py --latency 0.02 --jitter 0.005 --save-baseline /logs/benchmark.json
+    python src/benchmark.py --latency 0.02 --jitter 0.005 --baseline /logs/benchmark.json
+
+Every API call of the ReplayClient goes through LatencyClient, which sleeps a configurable latency plus an
+exponentially distributed jitter. The books are synthetic, a seeded fraction of them shows a tradable spread.
+Each benchmark reports its throughput and latency percentiles; with --baseline the run is compared against a saved
+one and the exit code is 1 if any benchmark regressed by more than --tolerance.
+"""
+import argparse
+import functools
+import random
+import sys
+import tempfile
+
+import flight_recorder
+import metrics
+from backtester import DEFAULT_PRECISION, ReplayClient
+from constants import *
+from helper import Helper
+from utility import *
+
+log = logging.getLogger(__name__)
+
+BENCHMARKS = ('get_spread', 'detect_spread_and_fill', 'get_orderbook_parallel', 'deal_parallel_orders',
+              'fill_balances_gap')
+BOOK_LATENCIES = (0.0, 0.005, 0.02, 0.05)
+
+
+class LatencyClient(object):
+    """
+    Proxy of a client sleeping latency plus an exponential jitter of mean jitter before every API call.
+    """
+
+    def __init__(self, client, latency=0.0, jitter=0.0, seed=None):
+        self.client = client
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def delay(self):
+        return self.latency + (self.random.expovariate(1.0 / self.jitter) if self.jitter else 0.0)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def delayed(*args, **kwargs):
+            delay = self.delay()
+            if delay:
+                time.sleep(delay)
+            return attribute(*args, **kwargs)
+
+        return delayed
+
+
+class SyntheticMarket(object):
+    """
+    Order books of the triangles of some coins around fixed mid prices.
+
+    refresh() rewrites every book of the client; with probability spread_rate, or always with spread=True, the
+    bids of a coin on market_2 are lifted so that market_1 -> coin -> market_2 clears the trade threshold.
+    """
+    HALF_SPREAD = 0.001
+    LEVEL_STEP = 0.0005
+    SPREAD_LIFT = 0.015
+
+    def __init__(self, coins, market_1, market_2, base_price=0.05, coin_prices=None, depth=5, level_amount=50.0,
+                 spread_rate=0.05, seed=None):
+        self.coins = coins
+        self.market_1, self.market_2 = market_1, market_2
+        self.base_price = base_price
+        self.coin_prices = coin_prices or dict((coin, 0.001 * (i + 1)) for i, coin in enumerate(coins))
+        self.depth = depth
+        self.level_amount = level_amount
+        self.spread_rate = spread_rate
+        self.random = random.Random(seed)
+
+    def rates(self, market_1_usd):
+        """
+        :return: USD rate of every coin, for get_currencies
+        """
+        rates = dict((coin, price * market_1_usd) for coin, price in self.coin_prices.items())
+        rates[self.market_1] = market_1_usd
+        rates[self.market_2] = self.base_price * market_1_usd
+        return rates
+
+    def ticker(self, symbol, mid, amount, lift=0.0):
+        # Prices on the market's tick, as the orders priced from them are.
+        precision = DEFAULT_PRECISION[symbol.split('-')[1]]
+        bid, ask = mid * (1 - self.HALF_SPREAD + lift), mid * (1 + self.HALF_SPREAD + lift)
+        return {'symbol': symbol,
+                'BUY_LEVELS': [[round(bid * (1 - self.LEVEL_STEP * i), precision), amount] for i in range(self.depth)],
+                'SELL_LEVELS': [[round(ask * (1 + self.LEVEL_STEP * i), precision), amount] for i in range(self.depth)]}
+
+    def refresh(self, client, spread=False, level_amount=None):
+        timestamp = time.time()
+        level_amount = level_amount or self.level_amount
+        base_symbol = '%s-%s' % (self.market_2, self.market_1)
+        client.set_book(timestamp, self.ticker(base_symbol, self.base_price, level_amount * 100))
+        for coin in self.coins:
+            price = self.coin_prices[coin]
+            lift = self.SPREAD_LIFT if spread or self.random.random() < self.spread_rate else 0.0
+            client.set_book(timestamp, self.ticker('%s-%s' % (coin, self.market_1), price, level_amount))
+            client.set_book(timestamp, self.ticker('%s-%s' % (coin, self.market_2), price / self.base_price,
+                                                   level_amount, lift))
+
+
+class Benchmark(object):
+    """
+    Helper and TransactionHelper on a LatencyClient over a ReplayClient fed by a SyntheticMarket.
+    """
+
+    def __init__(self, coins, market_1='BTC', market_2='ETH', latency=0.02, jitter=0.005, iterations=200, seed=1,
+                 spread_rate=0.05):
+        self.coins = coins
+        self.latency, self.jitter = latency, jitter
+        self.iterations = iterations
+        self.market = SyntheticMarket(coins, market_1, market_2, spread_rate=spread_rate, seed=seed)
+        rates = self.market.rates(8000.0)
+        # The same USD value of every coin, fill_balances_gap has nothing to do.
+        self.balances = dict((coin, 80000.0 / rate) for coin, rate in rates.items())
+        self.replay_client = ReplayClient(self.balances, rates=rates)
+        self.market.refresh(self.replay_client)
+        self.client = LatencyClient(self.replay_client, latency, jitter, seed)
+        # Failed trades are part of the runs, keep their dumps out of the way.
+        flight_recorder.RECORDER.dump_dir = tempfile.mkdtemp(prefix='benchmark-')
+        self.helper = Helper(self.client, market_1, market_2)
+        self.helper.market_1_price = self.replay_client.rates[market_1]
+
+    def reset_balances(self, balances=None):
+        self.replay_client.balances.clear()
+        self.replay_client.balances.update(balances or self.balances)
+        self.helper.ledger.reconcile()
+
+    def measure(self, fun, iterations, setup=None):
+        """
+        Time iterations calls of fun, setup runs before each call and is not timed.
+        :return: throughput and latency percentiles in milliseconds
+        """
+        histogram = metrics.LatencyHistogram()
+        total = 0.0
+        for i in range(iterations):
+            if setup:
+                setup(i)
+            started = time.perf_counter()
+            fun(i)
+            elapsed = time.perf_counter() - started
+            histogram.record(elapsed)
+            total += elapsed
+        result = {'iterations': iterations, 'seconds': round(total, 6),
+                  'ops_per_second': round(iterations / total, 3) if total else 0.0,
+                  'max_ms': round(histogram.max * 1e3, 4)}
+        for name, quantile in metrics.QUANTILES:
+            result[name + '_ms'] = round(histogram.percentile(quantile) * 1e3, 4)
+        return result
+
+    def tickers(self, coin):
+        return [self.helper.make_ticker(symbol, self.replay_client.get_order_book(symbol))
+                for symbol in self.helper.get_triangle_symbols(coin)]
+
+    def bench_get_spread(self):
+        tickers = [self.tickers(coin) for coin in self.coins]
+        iterations = self.iterations * 100
+        return self.measure(lambda i: self.helper.get_spread(*tickers[i % len(tickers)], self.coins[i % len(self.coins)]),
+                            iterations)
+
+    def bench_detect_spread_and_fill(self):
+        def setup(i):
+            self.market.refresh(self.replay_client)
+            if i % 10 == 0:
+                self.reset_balances()
+
+        return self.measure(lambda i: self.helper.detect_spread_and_fill(self.coins[i % len(self.coins)]),
+                            self.iterations, setup)
+
+    def bench_get_orderbook_parallel(self):
+        # Earlier trades took liquidity out of the books.
+        self.market.refresh(self.replay_client)
+        results = {}
+        for latency in BOOK_LATENCIES:
+            self.client.latency = latency
+            name = 'get_orderbook_parallel[%dms]' % (latency * 1000)
+            results[name] = self.measure(lambda i: self.helper.get_orderbook_parallel(
+                list(self.helper.get_triangle_symbols(self.coins[i % len(self.coins)]))), self.iterations)
+        self.client.latency = self.latency
+        return results
+
+    def bench_deal_parallel_orders(self):
+        order_groups = {}
+
+        def setup(i):
+            self.market.refresh(self.replay_client, spread=True)
+            if i % 10 == 0:
+                self.reset_balances()
+            coin = self.coins[i % len(self.coins)]
+            order_groups[i] = self.helper.prepare_order_group(coin, self.tickers(coin))
+
+        return self.measure(lambda i: self.helper.transaction_helper.deal_parallel_orders(
+            list(order_groups.pop(i)[1:4])), self.iterations, setup)
+
+    def bench_fill_balances_gap(self):
+        # Sell half the first coin's value for the last coin, through both markets so they stay balanced. The
+        # balance orders are priced at the top of the book, which has to hold them.
+        balances = dict(self.balances)
+        balances[self.coins[0]] *= 1.5
+        balances[self.coins[-1]] *= 0.5
+
+        def setup(i):
+            self.market.refresh(self.replay_client, level_amount=max(balances.values()))
+            self.reset_balances(balances)
+
+        return self.measure(lambda i: self.helper.fill_balances_gap(self.coins), max(1, self.iterations // 10), setup)
+
+    def run(self, names=BENCHMARKS):
+        results = {}
+        for name in names:
+            log.warning("Running benchmark %s.", name)
+            result = getattr(self, 'bench_' + name)()
+            if 'iterations' in result:
+                results[name] = result
+            else:
+                results.update(result)
+        return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    :return: list of regression messages, a throughput drop or a p99 rise of more than tolerance
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['ops_per_second'] < base['ops_per_second'] * (1 - tolerance):
+            regressions.append("%s: throughput %.1f/s, baseline %.1f/s" % (
+                name, result['ops_per_second'], base['ops_per_second']))
+        if result['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append("%s: p99 %.3fms, baseline %.3fms" % (name, result['p99_ms'], base['p99_ms']))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    lines = ["%-32s %12s %10s %10s %10s %10s" % ('benchmark', 'ops/s', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms')]
+    for name, result in results.items():
+        line = "%-32s %12.1f %10.3f %10.3f %10.3f %10.3f" % (name, result['ops_per_second'], result['p50_ms'],
+                                                             result['p99_ms'], result['p999_ms'], result['max_ms'])
+        base = (baseline or {}).get(name)
+        if base and base['ops_per_second']:
+            line += "  (%+.1f%% ops/s)" % ((result['ops_per_second'] / base['ops_per_second'] - 1) * 100)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the spread detection and order group hot paths")
+    parser.add_argument('--coin', default='NEO-DRGN-FOTA-TNC', help='coins to scan, e.g. NEO-DRGN.')
+    parser.add_argument('--market', default='BTC-ETH', help='The two markets to trade against.')
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated API latency in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.005, help='mean of the exponential latency jitter.')
+    parser.add_argument('--iterations', type=int, default=200, help='iterations of each benchmark.')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the books and the jitter.')
+    parser.add_argument('--spread-rate', type=float, default=0.05, help='fraction of the scans showing a spread.')
+    parser.add_argument('--only', default='', help='benchmarks to run, e.g. get_spread-fill_balances_gap.')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed regression against the baseline.')
+    parser.add_argument('--save-baseline', help='write the results as JSON to this file.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
+
+    markets = args.market.split('-')
+    benchmark = Benchmark(args.coin.split('-'), markets[0], markets[1], latency=args.latency, jitter=args.jitter,
+                          iterations=args.iterations, seed=args.seed, spread_rate=args.spread_rate)
+    results = benchmark.run(args.only.split('-') if args.only else BENCHMARKS)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        sys.exit(1 if regressions else 0)
+    sys.exit(0)
@@ -0,0 +1,94 @@
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+RECORD_DEPTH = 5
+# timestamp, symbol id, then RECORD_DEPTH (price, amount) levels of bids followed by asks. Missing levels are 0.
+RECORD_FORMAT = '<dH%dd' % (4 * RECORD_DEPTH)
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('symbol_id', '<u2'),
+                         ('bids', '<f8', (RECORD_DEPTH, 2)), ('asks', '<f8', (RECORD_DEPTH, 2))])
+SYMBOLS_SUFFIX = '.symbols'
+
+
+class BookRecorder(object):
+    """
+    Append order book snapshots to a binary log of fixed-width records.
+
+    Symbol names are stored once in a '<path>.symbols' side file, one per line, the line number being the symbol
+    id of the records. Both files are append-only, so a log can be read with BookLog while it is still recorded.
+    """
+    _record = struct.Struct(RECORD_FORMAT)
+
+    def __init__(self, path):
+        self.path = path
+        self.symbols = dict((symbol, i) for i, symbol in enumerate(load_symbols(path)))
+        self.file = open(path, 'ab')
+        self.symbols_file = open(path + SYMBOLS_SUFFIX, 'a')
+        self.lock = threading.Lock()
+
+    def symbol_id(self, symbol):
+        if symbol not in self.symbols:
+            self.symbols[symbol] = len(self.symbols)
+            self.symbols_file.write(symbol + '\n')
+            self.symbols_file.flush()
+        return self.symbols[symbol]
+
+    def record(self, ticker, timestamp=None):
+        """
+        :param ticker: order book in the Helper.get_order_book format
+        """
+        values = []
+        for side, levels_key in (('BUY', 'BUY_LEVELS'), ('SELL', 'SELL_LEVELS')):
+            levels = ticker.get(levels_key) or [ticker[side]]
+            for i in range(RECORD_DEPTH):
+                values.extend(levels[i][:2] if i < len(levels) else (0.0, 0.0))
+        with self.lock:
+            self.file.write(self._record.pack(timestamp or time.time(), self.symbol_id(ticker['symbol']), *values))
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.symbols_file.close()
+
+
+class BookLog(object):
+    """
+    Memory-mapped read access to a log written by BookRecorder.
+    """
+
+    def __init__(self, path):
+        self.symbols = load_symbols(path)
+        size = os.path.getsize(path) // RECORD_DTYPE.itemsize
+        self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(size,)) if size else \
+            np.zeros(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def tickers(self, chunk_size=65536):
+        """
+        :return: iterator of (timestamp, ticker) in recording order
+        """
+        for start in range(0, len(self.records), chunk_size):
+            chunk = self.records[start:start + chunk_size]
+            for timestamp, symbol_id, bids, asks in zip(chunk['timestamp'].tolist(), chunk['symbol_id'].tolist(),
+                                                        chunk['bids'].tolist(), chunk['asks'].tolist()):
+                bids = [level for level in bids if level[1] > 0]
+                asks = [level for level in asks if level[1] > 0]
+                if bids and asks:
+                    yield timestamp, {'symbol': self.symbols[symbol_id], 'BUY': bids[0], 'SELL': asks[0],
+                                      'BUY_LEVELS': bids, 'SELL_LEVELS': asks}
+
+
+def load_symbols(path):
+    if not os.path.isfile(path + SYMBOLS_SUFFIX):
+        return []
+    with open(path + SYMBOLS_SUFFIX, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
@@ -0,0 +1,262 @@
+import collections
+import concurrent.futures
+import threading
+
+from balance_ledger import TRADE_FEE_RATE, fill_changes
+from utility import *
+
+log = logging.getLogger(__name__)
+
+
+class CleanupCoordinator(object):
+    """
+    Clean up a failed order group: cancel its legs concurrently, then confirm what each leg dealt in one pass.
+
+    Only the legs of the groups opened with open_group are registered, until the group is forgotten. Legs are
+    cancelled by order id once registered, with cancel_all_orders of their symbol as the fallback for a leg whose
+    creation is still unresolved. A leg is confirmed when its cancel succeeded or its deals show it fully
+    dealt, and is then resolved in the fill tracker right away, its caller doesn't wait for the tracking timeout of
+    an order that is gone. Other legs are left unconfirmed and unresolved, their own tracking cancels them.
+
+    Requests for a group being cleaned up, e.g. one per failed leg in deal_parallel_orders, wait for and share the
+    same result. A later request runs the clean-up again for the legs still unconfirmed, e.g. registered after the
+    previous one, confirmed legs keeping their dealt amounts.
+    """
+    DEALT_ORDERS_LIMIT = 20
+
+    def __init__(self, client, fill_tracker, fee_rate=TRADE_FEE_RATE, max_workers=3):
+        self.client = client
+        self.fill_tracker = fill_tracker
+        self.fee_rate = fee_rate
+        self.max_workers = max_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        # {group key: order params group} of the open groups, which keeps their order params, keyed by id, alive.
+        self.groups = {}
+        # {id(order params): order id, None until created} of the legs of the open groups
+        self.order_ids = {}
+        # {order id: id(order params)}
+        self.registered = {}
+        self.cleanups = {}
+        # {order id: (dealt amount, dealt value)} of the confirmed legs
+        self.confirmed = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def group_key(order_params_group):
+        return tuple(id(order_params) for order_params in order_params_group)
+
+    def open_group(self, order_params_group):
+        """
+        Watch the legs of a group about to be created, orders outside of an open group aren't registered.
+        """
+        with self.lock:
+            self.groups[self.group_key(order_params_group)] = order_params_group
+            for order_params in order_params_group:
+                self.order_ids.setdefault(id(order_params), None)
+
+    def register(self, order_params, order_id):
+        """
+        Record the order id of a leg of an open group, a no-op for other orders, e.g. single orders.
+        """
+        with self.lock:
+            if id(order_params) in self.order_ids:
+                self.order_ids[id(order_params)] = order_id
+                self.registered[order_id] = id(order_params)
+
+    def is_registered(self, order_id):
+        with self.lock:
+            return order_id in self.registered
+
+    def is_confirmed(self, order_id):
+        """
+        :return: True if the order has been cancelled and confirmed by a clean-up
+        """
+        with self.lock:
+            return order_id in self.confirmed
+
+    def forget(self, order_params_group):
+        """
+        Drop the state of a group once it is done with, successful or not.
+        """
+        with self.lock:
+            key = self.group_key(order_params_group)
+            self.cleanups.pop(key, None)
+            self.groups.pop(key, None)
+            for order_params in order_params_group:
+                order_id = self.order_ids.pop(id(order_params), None)
+                self.registered.pop(order_id, None)
+                self.confirmed.pop(order_id, None)
+
+    def cleanup(self, order_params_group):
+        """
+        :return: {'dealt': {symbol: dealt amount}, 'residual': {coin: signed amount}, 'unconfirmed': [symbol]},
+                 residual being the net position the group left, fee included
+        """
+        key = self.group_key(order_params_group)
+        with self.lock:
+            future = self.cleanups.get(key)
+            # Run again while legs are left unconfirmed by the previous clean-up.
+            owner = future is None or (future.done() and (future.exception() or future.result()['unconfirmed']))
+            if owner:
+                future = self.cleanups[key] = concurrent.futures.Future()
+        if not owner:
+            log.info("Clean-up of this order group already requested, waiting for it.")
+            return future.result()
+        try:
+            result = self.run(order_params_group)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    def run(self, order_params_group):
+        order_ids, confirmed, pending = self.pending_legs(order_params_group)
+        futures = [self.executor.submit(self.cancel, order_params, order_id) for order_params, order_id in pending]
+        cancelled = set()
+        for (order_params, order_id), future in zip(pending, futures):
+            try:
+                future.result()
+                cancelled.add(order_id)
+            except Exception as e:
+                log.error("Failed to cancel an order of the group.")
+                log.error(e, exc_info=True)
+
+        symbols = set(order_params['symbol'] for order_params, _ in pending)
+        dealt_by_symbol = dict(zip(symbols, self.executor.map(self.get_dealt_orders, symbols)))
+        return self.confirm(order_params_group, order_ids, confirmed, pending, cancelled, dealt_by_symbol)
+
+    def pending_legs(self, order_params_group):
+        """
+        :return: (order id of each leg, {order id: (dealt amount, dealt value)} of the legs already confirmed,
+                 [(order params, order id)] of the legs left to cancel and confirm)
+        """
+        with self.lock:
+            order_ids = [self.order_ids.get(id(order_params)) for order_params in order_params_group]
+            confirmed = dict((order_id, self.confirmed[order_id]) for order_id in order_ids
+                             if order_id in self.confirmed)
+        pending = [(order_params, order_id) for order_params, order_id in zip(order_params_group, order_ids)
+                   if order_id not in confirmed]
+        return order_ids, confirmed, pending
+
+    def confirm(self, order_params_group, order_ids, confirmed, pending, cancelled, dealt_by_symbol):
+        """
+        Confirm the pending legs cancelled or fully dealt and sum up the group, see cleanup.
+        :param cancelled: order ids of the legs whose cancel succeeded
+        :param dealt_by_symbol: {symbol: get_dealt_orders result} of the symbols of the pending legs
+        """
+        for order_params, order_id in pending:
+            symbol = order_params['symbol']
+            if order_id is None or dealt_by_symbol[symbol] is None:
+                continue
+            deal_amount, value = dealt_by_symbol[symbol].get(order_id, (0.0, 0.0))
+            if order_id not in cancelled and deal_amount / order_params['amount'] <= 0.999:
+                # The order may still be on the book and deal further.
+                continue
+            confirmed[order_id] = (deal_amount, value)
+            with self.lock:
+                self.confirmed[order_id] = (deal_amount, value)
+            self.fill_tracker.finish(order_id, deal_amount)
+
+        dealt, residual, unconfirmed = {}, collections.defaultdict(float), []
+        for order_params, order_id in zip(order_params_group, order_ids):
+            symbol = order_params['symbol']
+            if order_id not in confirmed:
+                unconfirmed.append(symbol)
+                continue
+            deal_amount, value = confirmed[order_id]
+            dealt[symbol] = deal_amount
+            if deal_amount > 0:
+                for coin, change in fill_changes(symbol, order_params['type'], deal_amount, value,
+                                                 self.fee_rate).items():
+                    residual[coin] += change
+        result = {'dealt': dealt, 'residual': dict(residual), 'unconfirmed': unconfirmed}
+        log_json_utils(log.error, message="Order group cleaned up.", **result)
+        return result
+
+    def cancel(self, order_params, order_id):
+        if order_id is None:
+            # Creation unresolved, the order may still show up on the symbol.
+            return call_api_with_retry(self.client.cancel_all_orders, symbol=order_params['symbol'])
+        return call_api_with_retry(self.client.cancel_order, order_id, order_params['type'],
+                                   symbol=order_params['symbol'])
+
+    def get_dealt_orders(self, symbol):
+        """
+        :return: {order id: (dealt amount, dealt value)} of the latest deals of a symbol, None if they can't be read
+        """
+        try:
+            response = call_api_with_retry(self.client.get_symbol_dealt_orders, symbol, None, self.DEALT_ORDERS_LIMIT)
+        except Exception as e:
+            log.error("Failed to confirm the dealt orders of %s." % symbol)
+            log.error(e, exc_info=True)
+            return None
+        return self.sum_deals(response['datas'])
+
+    @staticmethod
+    def sum_deals(deals):
+        dealt = collections.defaultdict(lambda: (0.0, 0.0))
+        for deal in deals:
+            amount = float(deal['amount'])
+            value = float(deal.get('dealValue') or amount * float(deal['dealPrice']))
+            deal_amount, deal_value = dealt[deal['orderOid']]
+            dealt[deal['orderOid']] = (deal_amount + amount, deal_value + value)
+        return dealt
+
+
+class AsyncCleanupCoordinator(CleanupCoordinator):
+    """
+    CleanupCoordinator cancelling and confirming the legs as coroutines on the event loop with an AsyncClient, its
+    cleanup must be awaited. The bookkeeping is shared with CleanupCoordinator.
+    """
+
+    async def cleanup(self, order_params_group):
+        key = self.group_key(order_params_group)
+        with self.lock:
+            future = self.cleanups.get(key)
+            owner = future is None or (future.done() and (future.exception() or future.result()['unconfirmed']))
+            if owner:
+                future = self.cleanups[key] = asyncio.get_running_loop().create_future()
+        if not owner:
+            log.info("Clean-up of this order group already requested, waiting for it.")
+            return await asyncio.shield(future)
+        try:
+            result = await self.run(order_params_group)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    async def run(self, order_params_group):
+        order_ids, confirmed, pending = self.pending_legs(order_params_group)
+        results = await asyncio.gather(*[self.cancel(order_params, order_id) for order_params, order_id in pending],
+                                       return_exceptions=True)
+        cancelled = set()
+        for (order_params, order_id), result in zip(pending, results):
+            if isinstance(result, Exception):
+                log.error("Failed to cancel an order of the group.")
+                log.error(result, exc_info=result)
+            else:
+                cancelled.add(order_id)
+
+        symbols = list(set(order_params['symbol'] for order_params, _ in pending))
+        dealt_by_symbol = dict(zip(symbols, await asyncio.gather(*[self.get_dealt_orders(symbol)
+                                                                   for symbol in symbols])))
+        return self.confirm(order_params_group, order_ids, confirmed, pending, cancelled, dealt_by_symbol)
+
+    async def cancel(self, order_params, order_id):
+        if order_id is None:
+            return await async_call_api_with_retry(self.client.cancel_all_orders, symbol=order_params['symbol'])
+        return await async_call_api_with_retry(self.client.cancel_order, order_id, order_params['type'],
+                                               symbol=order_params['symbol'])
+
+    async def get_dealt_orders(self, symbol):
+        try:
+            response = await async_call_api_with_retry(self.client.get_symbol_dealt_orders, symbol, None,
+                                                       self.DEALT_ORDERS_LIMIT)
+        except Exception as e:
+            log.error("Failed to confirm the dealt orders of %s." % symbol)
+            log.error(e, exc_info=True)
+            return None
+        return self.sum_deals(response['datas'])
@@ -0,0 +1,85 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+
+
+class CoinStats(object):
+    __slots__ = ('mean', 'variance', 'scans', 'last_scan')
+
+    def __init__(self):
+        self.mean = 0.0
+        self.variance = 0.0
+        self.scans = 0
+        self.last_scan = 0.0
+
+
+class CoinScheduler(object):
+    """
+    Pick the next coin to scan by how likely it is to show a tradable spread.
+
+    Every scan feeds the best top-of-book spread of the coin into an exponentially weighted mean and variance. The
+    score of a coin is how close mean + 2 standard deviations gets to the trade threshold, from 0 for a coin far
+    below it to 1 for a coin regularly crossing it. The score sets the revisit interval, from max_interval for cold
+    coins down to min_interval for hot ones on a log scale, and coins are served from a heap by due time, i.e.
+    last scan + interval. Time since the last scan therefore always counts: a cold coin gets ahead of every hot coin
+    once it is overdue, which keeps the minimum revisit rate of 1 / max_interval. A coin that just filled is due
+    right away, to take the remaining amount.
+    """
+
+    def __init__(self, coins, threshold, min_interval=0.05, max_interval=5.0, alpha=0.2):
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.alpha = alpha
+        self.stats = dict((coin, CoinStats()) for coin in coins)
+        self.sequence = itertools.count()
+        # Scan every coin once, in the given order, before any history exists.
+        self.queue = [(0.0, next(self.sequence), coin) for coin in coins]
+        self.lock = threading.Lock()
+
+    def score(self, coin):
+        stats = self.stats[coin]
+        if not stats.scans:
+            return 1.0
+        reach = (stats.mean + 2 * math.sqrt(stats.variance)) / self.threshold
+        return min(1.0, max(0.0, reach))
+
+    def interval(self, coin):
+        return self.max_interval * (self.min_interval / self.max_interval) ** self.score(coin)
+
+    def next_coin(self):
+        """
+        :return: the coin due first, whether or not its due time has passed
+        """
+        with self.lock:
+            return heapq.heappop(self.queue)[2]
+
+    def record(self, coin, spread, filled=False):
+        """
+        Report the scan of a coin taken with next_coin and schedule its next scan.
+        :param spread: best top-of-book spread ratio seen, None if the scan failed
+        """
+        now = time.time()
+        with self.lock:
+            stats = self.stats[coin]
+            if spread is not None:
+                if not stats.scans:
+                    stats.mean = spread
+                else:
+                    delta = spread - stats.mean
+                    stats.mean += self.alpha * delta
+                    stats.variance = (1 - self.alpha) * (stats.variance + self.alpha * delta * delta)
+                stats.scans += 1
+            stats.last_scan = now
+            due = now if filled else now + self.interval(coin)
+            heapq.heappush(self.queue, (due, next(self.sequence), coin))
+
+    def snapshot(self):
+        """
+        :return: {coin: (score, mean spread)} for logging
+        """
+        with self.lock:
+            return dict((coin, (round(self.score(coin), 3), round(stats.mean, 5)))
+                        for coin, stats in self.stats.items())
@@ -0,0 +1,179 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.connection import is_connection_dropped
+
+import metrics
+from rate_limiter import HOUSEKEEPING, RateLimitExceeded
+from utility import *
+
+log = logging.getLogger(__name__)
+
+
+class CountingAdapter(HTTPAdapter):
+    """
+    HTTPAdapter counting the requests it sends and the connections its pools open, each one a TCP and TLS
+    handshake.
+    """
+
+    def __init__(self, pool_size):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connects = 0
+        HTTPAdapter.__init__(self, pool_connections=1, pool_maxsize=pool_size)
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(
+            (scheme, self.counting_pool(pool_cls)) for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items())
+
+    def counting_pool(self, pool_cls):
+        adapter = self
+
+        class CountingConnection(pool_cls.ConnectionCls):
+            def connect(self):
+                adapter.count('connects')
+                return pool_cls.ConnectionCls.connect(self)
+
+        return type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': CountingConnection})
+
+    def send(self, request, **kwargs):
+        self.count('requests')
+        return HTTPAdapter.send(self, request, **kwargs)
+
+
+class ConnectionManager(threading.Thread):
+    """
+    Keep the HTTPS connections to the exchange open and ready for the trading threads.
+
+    The session of the client gets a pool of pool_size connections, opened at start. Every check_interval the
+    idle connections are checked, oldest first, and dropped ones are reconnected right away rather than by the
+    next request, which may be an order. Every ping_interval each idle connection also sends a cheap tick request
+    of ping_symbol, so that the exchange doesn't close it for being idle. Pings take a HOUSEKEEPING slot of the request scheduler
+    when the client has one, and are skipped when it sheds them.
+    """
+
+    def __init__(self, client, pool_size, ping_symbol, ping_interval=20.0, check_interval=1.0, scheduler=None,
+                 registry=metrics.REGISTRY):
+        threading.Thread.__init__(self, name="ConnectionManager", daemon=True)
+        self.session = client.session
+        self.url = client.API_URL
+        self.pool_size = pool_size
+        self.ping_path = '/%s/open/tick?symbol=%s' % (client.API_VERSION, ping_symbol)
+        self.ping_interval = ping_interval
+        self.check_interval = check_interval
+        self.scheduler = scheduler
+        self.adapter = CountingAdapter(pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.opened = 0
+        self.replaced = 0
+        self.pings = 0
+        self.ping_failures = 0
+        self.stop = False
+        registry.register_gauge('http_pool', self.stats)
+
+    def pool(self):
+        """
+        :return: the urllib3 pool the session sends the exchange requests to
+        """
+        # The pool is keyed by the TLS settings too, e.g. a CA bundle from the environment, take those of the session.
+        settings = self.session.merge_environment_settings(self.url, {}, None, None, None)
+        request = requests.Request('GET', self.url).prepare()
+        if hasattr(self.adapter, 'get_connection_with_tls_context'):
+            return self.adapter.get_connection_with_tls_context(request, settings['verify'], settings['proxies'],
+                                                                settings['cert'])
+        return self.adapter.get_connection(self.url, settings['proxies'])
+
+    def take_oldest(self, pool):
+        """
+        Take the least recently used idle connection out of the pool, None for a slot never connected.
+        :return: (found, connection)
+        """
+        # The pool is a LifoQueue of connections, the bottom one being the least recently used. It is non
+        # blocking, taking from it needs no notification of waiters.
+        with pool.pool.mutex:
+            if not pool.pool.queue:
+                return False, None
+            return True, pool.pool.queue.pop(0)
+
+    def refresh(self, ping=False):
+        """
+        Pass over the idle connections of the pool once: connect never used slots, reconnect dropped connections
+        and, with ping, send a ping on the others.
+        """
+        pool = self.pool()
+        for _ in range(self.pool_size):
+            found, connection = self.take_oldest(pool)
+            if not found:
+                # Every connection is in use.
+                return
+            try:
+                if connection is None:
+                    connection = pool._new_conn()
+                    connection.connect()
+                    self.opened += 1
+                elif connection.sock is None or is_connection_dropped(connection):
+                    self.reconnect(connection)
+                elif ping:
+                    self.ping(connection)
+            except Exception as e:
+                log.warning("Failed to refresh an HTTP connection: %s", e)
+                connection.close()
+            finally:
+                pool._put_conn(connection)
+
+    def ping(self, connection):
+        if self.scheduler:
+            try:
+                self.scheduler.acquire(HOUSEKEEPING)
+            except RateLimitExceeded:
+                return
+        self.pings += 1
+        try:
+            connection.request('GET', self.ping_path)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 500:
+                raise IOError("Ping answered with HTTP %d" % response.status)
+        except Exception:
+            self.ping_failures += 1
+            # Whatever state the connection is in, replace it now.
+            self.reconnect(connection)
+
+    def reconnect(self, connection):
+        connection.close()
+        connection.connect()
+        self.replaced += 1
+
+    def warm_up(self):
+        log.info("Opening %d HTTP connections to %s.", self.pool_size, self.url)
+        self.refresh()
+
+    def stats(self):
+        with self.adapter.lock:
+            requests_sent, connects = self.adapter.requests, self.adapter.connects
+        # Connections opened by requests themselves rather than in advance, each one delayed its request by a handshake.
+        handshakes = max(0, connects - self.opened - self.replaced)
+        return {'requests': requests_sent, 'connects': connects, 'opened': self.opened, 'replaced': self.replaced,
+                'pings': self.pings, 'ping_failures': self.ping_failures,
+                'handshake_ratio': handshakes / requests_sent if requests_sent else 0.0}
+
+    def run(self):
+        self.warm_up()
+        last_ping = time.time()
+        while not self.stop:
+            time.sleep(self.check_interval)
+            ping = time.time() - last_ping >= self.ping_interval
+            try:
+                self.refresh(ping)
+            except Exception as e:
+                log.error("Failed to refresh the HTTP connections.")
+                log.error(e, exc_info=True)
+            if ping:
+                last_ping = time.time()
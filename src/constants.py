@@ -47,5 +47,6 @@ LOG_CONFIGURATION_FILENAME = 'configurations/log-configuration.json'
 CREDENTIALS_FILENAME = "configurations/credentials.json"
 LOG_FORMAT = "%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s"
 COIN_METADATA_FILENAME = "configurations/coin_metadata.json"
+SIMULATOR_PLATFORM = "Simulator"
 
 MINIMUM_ORDER_AMOUNT = "minimum_order_amount"
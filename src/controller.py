@@ -1,11 +1,25 @@
 import argparse
+import asyncio
 import threading
 from pathlib import Path
 
-from kucoin.client import Client
-
+import flight_recorder
+import metrics
 import secret_downloader
+from log_setup import enable_queue_logging
+from async_client import AsyncClient
+from async_engine import AsyncEngine
+from book_recorder import BookRecorder
+from coin_scheduler import CoinScheduler
+from connection_manager import ConnectionManager
+from exchange_simulator import simulated_exchange
 from helper import Helper
+from market_data import MarketDataFeed
+from metrics import InstrumentedClient, MetricsServer
+from order_client import OrderClient
+from rate_limiter import RequestScheduler, ScheduledClient
+from shared_book import SharedBookStore
+from sharding import BalanceManager, ShardPool, rate_share, split_coins
 from utility import *
 from constants import *
 
@@ -14,7 +28,7 @@ logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
 
 class AccountManager(threading.Thread):
-    def __init__(self, scan_coins, market_coins, semaphore):
+    def __init__(self, scan_coins, market_coins):
         threading.Thread.__init__(self)
         self.helper = helper
         self.client = client
@@ -24,7 +38,6 @@ class AccountManager(threading.Thread):
         self.asset = 0.0
         self.initial_asset = None
         self.stop = False
-        self.semaphore = semaphore
         self.trade_failure_count = 0
 
     def run(self):
@@ -42,8 +55,7 @@ class AccountManager(threading.Thread):
                     self.initial_asset = self.asset
                 log.info("Current asset is %.2f" % self.asset)
             try:
-                with self.semaphore:
-                    self.helper.fill_balances_gap(self.coins)
+                self.helper.fill_balances_gap(self.coins)
             except Exception as e:
                 log.error("Failed to fill the balances gap. [Error thrown to the run method]")
                 log.error(e, exc_info=True)
@@ -52,54 +64,62 @@ class AccountManager(threading.Thread):
 
 
 class Trader(threading.Thread):
-    def __init__(self, market_1, market_2, coins, semaphore):
+    def __init__(self, market_1, market_2, coins, all_coins=False):
         threading.Thread.__init__(self)
         self.helper = helper
         self.market_1, self.market_2 = market_1, market_2
         self.coins = coins
+        self.all_coins = all_coins
+        self.scheduler = CoinScheduler(coins, helper.TRADE_THRESHOLD)
         self.stop = False
         self.profit = 0.0
-        self.semaphore = semaphore
 
     def run(self):
-        last_execution_millis = time.time()
         while not self.stop:
-            i = 0
-            while i < len(self.coins):
-                coin = self.coins[i]
-                log.info("Start scanning coin %s" % coin)
+            if self.all_coins:
+                self.scan_all_coins()
+            # One round is as many scans as there are coins, hot coins taking the turns of cold ones.
+            for _ in range(0 if self.all_coins else len(self.coins)):
+                coin = self.scheduler.next_coin()
+                if sample_log('start_scanning', self.helper.HOT_LOG_SAMPLE):
+                    log.info("Start scanning coin %s" % coin)
+                filled = False
+                self.helper.last_spreads.pop(coin, None)
                 try:
-                    with self.semaphore:
-                        if self.helper.detect_spread_and_fill(coin):
-                            # Re-scan this coin in next loop to take more pending amount.
-                            i -= 1
+                    filled = self.helper.detect_spread_and_fill(coin)
                 except Exception as e:
                     # swallow any exception here.
                     log.error("Failed to detect spread and create orders for it. [Error thrown to the run method]")
                     log.error(e, exc_info=True)
                     time.sleep(1)
+                self.scheduler.record(coin, self.helper.last_spreads.get(coin), filled)
                 if self.stop:
                     break
                 time.sleep(0.02)
-                i += 1
-            if time.time() - last_execution_millis > 30:
-                # Keep the http connection alive
-                try:
-                    self.helper.idle_executor()
-                except Exception as e:
-                    # swallow any exception here
-                    log.error("Failed to do idle execution. [Error thrown to the run method]")
-                    log.error(e, exc_info=True)
-                    time.sleep(1)
-                last_execution_millis = time.time()
+
+    def scan_all_coins(self):
+        log.info("Start scanning all coins")
+        try:
+            filled = self.helper.detect_spread_in_all_coins()
+        except Exception as e:
+            # swallow any exception here.
+            log.error("Failed to detect spread in all coins. [Error thrown to the run method]")
+            log.error(e, exc_info=True)
+            time.sleep(1)
+            return
+        if not filled:
+            time.sleep(0.5)
 
 
 class conrl(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
-        self.semaphore = semaphore
-        self.thread_1 = AccountManager(scan_coins, markets, self.semaphore)
-        self.thread_2 = Trader(markets[0], markets[1], scan_coins, self.semaphore)
+        self.thread_1 = AccountManager(scan_coins, markets)
+        if args.shards > 1:
+            self.thread_2 = ShardPool(credentials, markets[0], markets[1], scan_coins, args.shards, balance_manager,
+                                      vars(args), book_store=book_store)
+        else:
+            self.thread_2 = Trader(markets[0], markets[1], scan_coins, all_coins=args.all_coins)
 
     def run(self):
         print("program is executing...")
@@ -111,9 +131,7 @@ class conrl(threading.Thread):
             i += 1
             log.info("Round %d - Asset %.f - Profit %.8f" % (i, self.thread_1.asset, self.thread_2.profit))
             log_json_utils(log.info, message="Trade statics", data=self.thread_1.helper.trade_static)
-            if self.thread_1.helper.transaction_helper.reaction_count > 0:
-                average_reaction_time = self.thread_1.helper.transaction_helper.reaction_time / self.thread_1.helper.transaction_helper.reaction_count
-                log.info("Trading reaction average time: %s ms", average_reaction_time * 1000)
+            log_json_utils(log.info, message="API latency percentiles", data=metrics.REGISTRY.summary())
             # if self.thread_2.profit < -10 or self.thread_2.profit > 100 or (
             if (self.thread_1.asset / self.thread_1.initial_asset) < 0.8:
                 log.critical("Profit change reached threshold %.8f" % self.thread_2.profit)
@@ -128,23 +146,109 @@ class conrl(threading.Thread):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Find price gap within a platform")
-    parser.add_argument('--coin', help='coin to be scanned, separated by dash(-).')
-    parser.add_argument('--platform', help='Platform to trade.')
+    parser.add_argument('--coin', help='coin to be scanned, separated by dash(-). Optional with --all-coins, where it '
+                                       'lists the coins kept balanced.')
+    parser.add_argument('--platform', help='Platform to trade, Simulator for the local exchange simulator.')
     parser.add_argument('--market', default='BTC-ETH', help='The two markets to trade against.')
+    parser.add_argument('--engine', default='thread', choices=['thread', 'async'],
+                        help='Run the trader and account manager as threads or as coroutines on one event loop.')
+    parser.add_argument('--all-coins', action='store_true',
+                        help='Scan every coin listed on both markets with one ticker snapshot instead of --coin.')
+    parser.add_argument('--feed', default='stream', choices=['stream', 'rest'],
+                        help='Serve order books from the push feed or poll them via REST.')
+    parser.add_argument('--feed-url', help='Push feed endpoint, e.g. a local stand-in server.')
+    parser.add_argument('--record', help='Append every order book snapshot to this binary log for backtesting.')
+    parser.add_argument('--metrics-port', type=int, default=9108,
+                        help='Serve API latency histograms on http://127.0.0.1:PORT/metrics, 0 to disable.')
+    parser.add_argument('--rate-limit', type=float, default=10.0,
+                        help='Requests per second allowed by the exchange, shared by priority, 0 to disable.')
+    parser.add_argument('--rate-burst', type=int, default=20, help='Requests the exchange allows in a burst.')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split --coin across this many scanning processes sharing one balance ledger.')
+    parser.add_argument('--log-queue', action='store_true',
+                        help='Format and write log records in a background thread instead of the trading threads.')
+    parser.add_argument('--flight-dir', default='/logs',
+                        help='Directory the flight recorder dumps its last events to when a trade fails.')
+    parser.add_argument('--consistency-window', type=float, default=Helper.CONSISTENCY_WINDOW,
+                        help='Seconds apart the three order books of a triangle may be for its spread to be traded.')
+    parser.add_argument('--ping-interval', type=float, default=20.0,
+                        help='Seconds between the keep-alive pings of each idle connection to the exchange.')
+    parser.add_argument('--simulator-latency', type=float, default=0.0,
+                        help='API latency in seconds of --platform Simulator.')
+    parser.add_argument('--simulator-error-rate', type=float, default=0.0,
+                        help='Fraction of the API calls failing with --platform Simulator.')
     args = parser.parse_args()
-    scan_coins = args.coin.split('-')
-
-    # Get API credentials from AWS S3 bucket.
-    abs_path = Path(Path(__file__).resolve().parents[1], CREDENTIALS_FILENAME)
-    secret_downloader.download_secret(str(abs_path))
-    with abs_path.open('r') as f:
-        credentials = json.load(f)[args.platform]
-
+    if args.shards > 1 and (args.all_coins or args.engine == 'async'):
+        parser.error("--shards splits --coin across processes running the thread engine, it can't be used with "
+                     "--all-coins or --engine async.")
+    if not args.coin and (not args.all_coins or args.engine == 'async'):
+        # The async engine scans --coin only.
+        parser.error("--coin is required unless --all-coins is set with the thread engine.")
+    flight_recorder.RECORDER.dump_dir = args.flight_dir
+    if args.log_queue:
+        enable_queue_logging()
+    scan_coins = args.coin.split('-') if args.coin else []
     markets = args.market.split('-')
 
-    client = Client(credentials['api_key'], credentials['secret_key'])
-    helper = Helper(client, markets[0], markets[1])
-    semaphore = threading.BoundedSemaphore(value=1)
-
-    t3 = conrl()
-    t3.start()
+    if args.platform == SIMULATOR_PLATFORM:
+        if args.engine == 'async' or args.shards > 1:
+            parser.error("The simulator runs in this process, use it with --engine thread and --shards 1.")
+        if not scan_coins:
+            parser.error("The simulator only quotes the --coin triangles, --coin is required.")
+        credentials = None
+        # The simulator has no push feed, its books are polled.
+        args.feed = 'rest'
+        client = InstrumentedClient(simulated_exchange(scan_coins, markets[0], markets[1],
+                                                       latency=args.simulator_latency,
+                                                       error_rate=args.simulator_error_rate))
+    else:
+        # Get API credentials from AWS S3 bucket.
+        abs_path = Path(Path(__file__).resolve().parents[1], CREDENTIALS_FILENAME)
+        secret_downloader.download_secret(str(abs_path))
+        with abs_path.open('r') as f:
+            credentials = json.load(f)[args.platform]
+        client = InstrumentedClient(OrderClient(credentials['api_key'], credentials['secret_key']))
+    scheduler = None
+    if args.rate_limit:
+        rate, burst = args.rate_limit, args.rate_burst
+        if args.shards > 1:
+            # The account manager, the feed and the pings of this process take one share, the shards the others.
+            rate, burst = rate_share(rate, burst, len(split_coins(scan_coins, args.shards)) + 1)
+        scheduler = RequestScheduler(rate=rate, burst=burst)
+        client = ScheduledClient(client, scheduler)
+    if args.metrics_port:
+        MetricsServer(args.metrics_port).start()
+    market_data = None
+    balance_manager = None
+    balance_store = None
+    book_store = None
+    if args.shards > 1:
+        balance_manager = BalanceManager()
+        balance_manager.start()
+        balance_store = balance_manager.get_balance_store()
+    if args.feed == 'stream':
+        feed_symbols = ['%s-%s' % (coin, market) for coin in scan_coins for market in markets]
+        feed_symbols.append('%s-%s' % (markets[1], markets[0]))
+        if args.shards > 1:
+            # One feed for every shard, published to shared memory.
+            book_store = SharedBookStore(feed_symbols, depth=Helper.ORDER_BOOK_DEPTH)
+        market_data = MarketDataFeed(client, feed_symbols, url=args.feed_url, depth=Helper.ORDER_BOOK_DEPTH,
+                                     store=book_store)
+        market_data.start()
+    recorder = BookRecorder(args.record) if args.record else None
+    helper = Helper(client, markets[0], markets[1], market_data=market_data, recorder=recorder,
+                    balance_store=balance_store, consistency_window=args.consistency_window)
+    helper.transaction_helper.prepare_orders([symbol for coin in scan_coins
+                                              for symbol in helper.get_triangle_symbols(coin)])
+    if args.platform != SIMULATOR_PLATFORM:
+        ConnectionManager(client, helper.transaction_helper.pool_size(), helper.base_symbol,
+                          ping_interval=args.ping_interval, scheduler=scheduler).start()
+
+    if args.engine == 'async':
+        async_client = InstrumentedClient(AsyncClient(credentials['api_key'], credentials['secret_key']))
+        if scheduler:
+            async_client = ScheduledClient(async_client, scheduler)
+        asyncio.run(AsyncEngine(helper, async_client, scan_coins).run())
+    else:
+        t3 = conrl()
+        t3.start()
@@ -0,0 +1,136 @@
+import collections
+import threading
+
+import metrics
+from utility import *
+
+log = logging.getLogger(__name__)
+
+
+class LatencyWindow(object):
+    """
+    Percentiles of the values recorded in a registry histogram over roughly the last window seconds.
+
+    Snapshots of the bucket counts are kept every window / SNAPSHOTS seconds, the window being the difference
+    between the current counts and the oldest snapshot, so recording stays the registry's bucket increment.
+    """
+    SNAPSHOTS = 4
+
+    def __init__(self, histogram, window):
+        self.histogram = histogram
+        self.window = window
+        self.snapshots = collections.deque()
+
+    def percentile(self, quantile, min_samples):
+        """
+        :return: percentile in seconds of the window, of all values if the window has too few, None without enough
+        """
+        now = time.time()
+        counts, count, maximum = self.histogram.snapshot()
+        if not self.snapshots or now - self.snapshots[-1][0] >= self.window / self.SNAPSHOTS:
+            self.snapshots.append((now, counts, count))
+        while len(self.snapshots) > 1 and now - self.snapshots[1][0] >= self.window:
+            self.snapshots.popleft()
+        _, base_counts, base_count = self.snapshots[0]
+        if count - base_count >= min_samples:
+            return metrics.counts_percentile([current - base for current, base in zip(counts, base_counts)],
+                                             count - base_count, maximum, quantile)
+        if count >= min_samples:
+            return metrics.counts_percentile(counts, count, maximum, quantile)
+        return None
+
+
+class DeadlineManager(object):
+    """
+    Deadlines of the scans and order groups learnt from the recent latencies of the endpoints.
+
+    Latencies are read from the histograms of the metrics registry, fed by InstrumentedClient per endpoint and by
+    the fill tracker for 'order_fill', the time an order took to be fully dealt. Until an endpoint has
+    min_samples values, its deadline is the fixed default it replaces. Percentiles are cached for refresh_interval
+    seconds, the hot path reads a float.
+    """
+    BOOK_ENDPOINT = 'get_order_book'
+    FILL = 'order_fill'
+    # Order book scans
+    BOOK_DEADLINE = 0.5
+    BOOK_FACTOR = 2.0
+    MIN_BOOK_DEADLINE = 0.1
+    MAX_BOOK_DEADLINE = 2.0
+    HEDGE_QUANTILE = 0.9
+    # Order tracking
+    FILL_FACTOR = 2.0
+    MIN_FILL_DEADLINE = 3.0
+    # Margin of an order group over its tracking: create, locate and cancel an order, and confirm its deals.
+    GROUP_ENDPOINTS = ('create_order', 'get_active_orders', 'cancel_order', 'get_symbol_dealt_orders')
+    GROUP_FACTOR = 3.0
+    MIN_GROUP_MARGIN = 10.0
+
+    def __init__(self, registry=metrics.REGISTRY, window=300.0, min_samples=20, refresh_interval=1.0):
+        self.registry = registry
+        self.window = window
+        self.min_samples = min_samples
+        self.refresh_interval = refresh_interval
+        self.windows = {}
+        self.cache = {}
+        # Order book requests duplicated after the hedge delay
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def percentile(self, name, quantile):
+        """
+        :return: recent percentile in seconds of an endpoint, None until it has enough samples
+        """
+        key = (name, quantile)
+        cached = self.cache.get(key)
+        if cached and time.time() - cached[0] < self.refresh_interval:
+            return cached[1]
+        with self.lock:
+            latency_window = self.windows.get(name)
+            if latency_window is None:
+                latency_window = self.windows[name] = LatencyWindow(self.registry.histogram(name), self.window)
+            value = latency_window.percentile(quantile, self.min_samples)
+        self.cache[key] = (time.time(), value)
+        return value
+
+    def book_deadline(self):
+        """
+        :return: seconds a scan waits for its order books
+        """
+        p99 = self.percentile(self.BOOK_ENDPOINT, 0.99)
+        if p99 is None:
+            return self.BOOK_DEADLINE
+        return min(self.MAX_BOOK_DEADLINE, max(self.MIN_BOOK_DEADLINE, self.BOOK_FACTOR * p99))
+
+    def hedge_delay(self):
+        """
+        :return: seconds after which an order book request still pending gets a duplicate, None not to hedge
+        """
+        delay = self.percentile(self.BOOK_ENDPOINT, self.HEDGE_QUANTILE)
+        if delay is None:
+            return None
+        # Leave the duplicate time to answer within the deadline.
+        return delay if delay < self.book_deadline() / 2 else None
+
+    def fill_deadline(self, schedule, scale=1.0):
+        """
+        :param schedule: fixed tracking time of the order, the upper bound
+        :param scale: factor of the learnt deadline, for orders given additional time
+        :return: seconds an order is tracked before it gets cancelled
+        """
+        p99 = self.percentile(self.FILL, 0.99)
+        if p99 is None:
+            return schedule
+        return min(schedule, max(self.MIN_FILL_DEADLINE, self.FILL_FACTOR * p99) * scale)
+
+    def group_deadline(self, fill_deadline):
+        """
+        :return: seconds an order group may take, its tracking included
+        """
+        margin = 0.0
+        for name in self.GROUP_ENDPOINTS:
+            margin += self.percentile(name, 0.99) or 0.0
+        return fill_deadline + max(self.MIN_GROUP_MARGIN, self.GROUP_FACTOR * margin)
+
+    def stats(self):
+        return {'book_deadline': self.book_deadline(), 'hedge_delay': self.hedge_delay() or 0.0, 'hedges': self.hedges,
+                'order_fill_p99': self.percentile(self.FILL, 0.99) or 0.0}
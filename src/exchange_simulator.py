@@ -0,0 +1,633 @@
+"""
+Local stand-in for the kucoin exchange: a price-time priority matching engine behind the kucoin Client methods the
+bot uses, with simulated latency, rate limits and injected errors.
+
+Liquidity comes from a market maker account quoting through set_quotes, driven by SyntheticFlow (random walk
+mid prices) or ReplayFlow (a BookRecorder log). Only the bot account has balances; its orders freeze funds while
+they rest and settle with the trade fee as they fill, on either side of a trade.
+
+    python src/exchange_simulator.py --coin NEO-DRGN-FOTA-TNC --threads 8 --seconds 30 --latency 0.01
+
+runs a load test of TransactionHelper against it, see LoadTest.
+"""
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import itertools
+import math
+import random
+import threading
+
+import requests
+from kucoin.exceptions import KucoinRequestException
+
+from backtester import DEFAULT_PRECISION
+from balance_ledger import TRADE_FEE_RATE
+from quotes import OrderParams, SymbolSpec
+from transaction_helper import TransactionHelper
+from utility import *
+from constants import *
+
+log = logging.getLogger(__name__)
+
+BOT = 'bot'
+MARKET_MAKER = 'market'
+OPPOSITE = {'BUY': 'SELL', 'SELL': 'BUY'}
+
+
+class SimulatedOrder(object):
+    __slots__ = ('order_id', 'account', 'symbol', 'type', 'price', 'amount', 'dealt', 'created_at', 'deals')
+
+    def __init__(self, order_id, account, symbol, order_type, price, amount):
+        self.order_id = order_id
+        self.account = account
+        self.symbol = symbol
+        self.type = order_type
+        self.price = price
+        self.amount = amount
+        self.dealt = 0.0
+        self.created_at = time.time() * 1000
+        self.deals = []
+
+    @property
+    def pending(self):
+        return self.amount - self.dealt
+
+
+class OrderBook(object):
+    """
+    Limit orders of one symbol in price-time priority.
+
+    Each side maps a price to the FIFO deque of its orders, and keeps its prices in a sorted list of keys, negated
+    for the bids, so the best price of either side is the first key.
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.levels = {'BUY': {}, 'SELL': {}}
+        self.keys = {'BUY': [], 'SELL': []}
+
+    @staticmethod
+    def key(side, price):
+        return -price if side == 'BUY' else price
+
+    def best(self, side):
+        keys = self.keys[side]
+        return abs(keys[0]) if keys else None
+
+    def add(self, order):
+        levels = self.levels[order.type]
+        level = levels.get(order.price)
+        if level is None:
+            level = levels[order.price] = collections.deque()
+            bisect.insort(self.keys[order.type], self.key(order.type, order.price))
+        level.append(order)
+
+    def remove(self, order):
+        level = self.levels[order.type].get(order.price)
+        if level is None or order not in level:
+            return False
+        level.remove(order)
+        if not level:
+            self.drop_level(order.type, order.price)
+        return True
+
+    def drop_level(self, side, price):
+        del self.levels[side][price]
+        keys = self.keys[side]
+        del keys[bisect.bisect_left(keys, self.key(side, price))]
+
+    def match(self, order, on_trade):
+        """
+        Fill an incoming order against the resting orders it crosses, best price first and oldest first within a
+        price. Trades are made at the resting order's price and reported as on_trade(maker, taker, price, amount).
+        """
+        side = OPPOSITE[order.type]
+        keys, levels = self.keys[side], self.levels[side]
+        while order.pending > 1e-12 and keys:
+            price = abs(keys[0])
+            if (order.type == 'BUY' and price > order.price) or (order.type == 'SELL' and price < order.price):
+                break
+            level = levels[price]
+            while order.pending > 1e-12 and level:
+                maker = level[0]
+                amount = min(maker.pending, order.pending)
+                maker.dealt += amount
+                order.dealt += amount
+                if maker.pending <= 1e-12:
+                    level.popleft()
+                on_trade(maker, order, price, amount)
+            if not level:
+                self.drop_level(side, price)
+
+    def depth(self, side, limit=None):
+        """
+        :return: [[price, amount, volume]] of the best limit price levels, as get_order_book
+        """
+        result = []
+        for key in self.keys[side][:limit]:
+            price = abs(key)
+            amount = sum(order.pending for order in self.levels[side][price])
+            result.append([price, amount, price * amount])
+        return result
+
+
+class ExchangeSimulator(object):
+    """
+    The kucoin Client methods the bot uses, served by an in-process matching engine.
+
+    Every call first sleeps latency plus an exponential jitter of mean jitter, is then refused with
+    KucoinRequestException beyond rate_limit requests per second (burst in a row), and fails at random with
+    error_rate. With lost_order_rate, create_order places the order but raises as if the response got lost, which
+    is what TransactionHelper.create_order looks for in the active and dealt orders.
+    """
+
+    def __init__(self, balances, precision=None, rates=None, fee_rate=TRADE_FEE_RATE, latency=0.0, jitter=0.0,
+                 rate_limit=0.0, burst=20, error_rate=0.0, lost_order_rate=0.0, seed=None, history=100000):
+        self.session = requests.Session()
+        self.balances = collections.defaultdict(float, balances)
+        self.frozen = collections.defaultdict(float)
+        self.precision = precision or {}
+        self.rates = rates or {}
+        self.fee_rate = fee_rate
+        self.latency, self.jitter = latency, jitter
+        self.rate_limit, self.burst = rate_limit, burst
+        self.error_rate, self.lost_order_rate = error_rate, lost_order_rate
+        self.history = history
+        self.books = {}
+        # Orders of the bot by id, the oldest finished ones are forgotten beyond history.
+        self.orders = collections.OrderedDict()
+        self.deals = collections.defaultdict(lambda: collections.deque(maxlen=1000))
+        self.last_prices = {}
+        self.order_ids = itertools.count()
+        self.deal_ids = itertools.count()
+        self.random = random.Random(seed)
+        self.tokens = float(burst)
+        self.refilled = time.time()
+        self.rate_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.flow = None
+
+    # Network
+
+    def request(self, endpoint):
+        self.stats['requests'] += 1
+        delay = self.latency + (self.random.expovariate(1.0 / self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        if self.rate_limit:
+            with self.rate_lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate_limit)
+                self.refilled = now
+                if self.tokens < 1:
+                    self.stats['rate_limited'] += 1
+                    raise KucoinRequestException('TOO_MANY_REQUESTS: %s over %.1f requests per second' % (
+                        endpoint, self.rate_limit))
+                self.tokens -= 1
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.stats['injected_errors'] += 1
+            raise KucoinRequestException('SYSTEM_ERROR: injected failure of %s' % endpoint)
+
+    # Matching
+
+    def book(self, symbol):
+        book = self.books.get(symbol)
+        if book is None:
+            book = self.books[symbol] = OrderBook(symbol)
+        return book
+
+    def available(self, coin):
+        return self.balances[coin] - self.frozen[coin]
+
+    def place(self, account, symbol, order_type, price, amount, resting=True):
+        """
+        Match an order and rest what is left of it, or drop it if resting is False. Must hold the lock.
+        """
+        order_id = '%024x' % next(self.order_ids)
+        order = SimulatedOrder(order_id, account, symbol, order_type, price, amount)
+        if account == BOT:
+            coin, market = symbol.split('-')
+            frozen_coin, frozen_amount = (market, price * amount) if order_type == 'BUY' else (coin, amount)
+            if self.available(frozen_coin) < frozen_amount - 1e-12:
+                raise KucoinRequestException('NO_BALANCE: %.8f %s available, %.8f needed' % (
+                    self.available(frozen_coin), frozen_coin, frozen_amount))
+            self.frozen[frozen_coin] += frozen_amount
+            self.orders[order_id] = order
+            self.stats['orders'] += 1
+        book = self.book(symbol)
+        book.match(order, self.settle)
+        if order.pending > 1e-12:
+            if resting:
+                book.add(order)
+            else:
+                self.unfreeze(order)
+        self.forget_orders()
+        return order
+
+    def settle(self, maker, taker, price, amount):
+        self.last_prices[maker.symbol] = price
+        self.stats['trades'] += 1
+        for order in (maker, taker):
+            if order.account != BOT:
+                continue
+            coin, market = order.symbol.split('-')
+            value = price * amount
+            fee = (amount if order.type == 'BUY' else value) * self.fee_rate
+            if order.type == 'BUY':
+                self.balances[coin] += amount - fee
+                self.balances[market] -= value
+                self.frozen[market] -= order.price * amount
+            else:
+                self.balances[coin] -= amount
+                self.balances[market] += value - fee
+                self.frozen[coin] -= amount
+            deal = {'oid': '%024x' % next(self.deal_ids), 'orderOid': order.order_id, 'direction': order.type,
+                    'coinType': coin, 'coinTypePair': market, 'amount': amount, 'dealPrice': price,
+                    'dealValue': value, 'fee': fee, 'feeRate': self.fee_rate, 'createdAt': time.time() * 1000}
+            order.deals.append(deal)
+            self.deals[order.symbol].appendleft(deal)
+
+    def unfreeze(self, order):
+        if order.account != BOT or order.pending <= 1e-12:
+            return
+        coin, market = order.symbol.split('-')
+        if order.type == 'BUY':
+            self.frozen[market] -= order.price * order.pending
+        else:
+            self.frozen[coin] -= order.pending
+        # Cancelled, the pending amount no longer counts.
+        order.amount = order.dealt
+
+    def cancel(self, order):
+        if self.book(order.symbol).remove(order):
+            self.unfreeze(order)
+            return True
+        return False
+
+    def forget_orders(self):
+        while len(self.orders) > self.history:
+            order_id, order = next(iter(self.orders.items()))
+            if order.pending > 1e-12:
+                # Oldest order still resting, keep it and its successors.
+                break
+            self.orders.popitem(last=False)
+
+    def set_quotes(self, symbol, bids, asks):
+        """
+        Replace the market maker's orders of a symbol with the given [price, amount] levels. New quotes crossing
+        resting orders of the bot fill them.
+        """
+        with self.lock:
+            book = self.book(symbol)
+            for side in ('BUY', 'SELL'):
+                for price in list(book.levels[side]):
+                    for order in [order for order in book.levels[side][price] if order.account == MARKET_MAKER]:
+                        book.remove(order)
+            for order_type, levels in (('BUY', bids), ('SELL', asks)):
+                for price, amount in levels:
+                    if amount > 0:
+                        self.place(MARKET_MAKER, symbol, order_type, price, amount)
+
+    def take(self, symbol, order_type, price, amount):
+        """
+        Immediate-or-cancel order of the market maker, e.g. a taker of SyntheticFlow.
+        """
+        with self.lock:
+            return self.place(MARKET_MAKER, symbol, order_type, price, amount, resting=False)
+
+    # kucoin Client
+
+    def create_order(self, symbol, order_type, price, amount):
+        self.request('create_order')
+        with self.lock:
+            order = self.place(BOT, symbol, order_type, float(price), float(amount))
+        if self.lost_order_rate and self.random.random() < self.lost_order_rate:
+            self.stats['lost_orders'] += 1
+            raise KucoinRequestException('TIMEOUT: no response to create_order %s' % order.order_id)
+        return {'orderOid': order.order_id}
+
+    def cancel_order(self, order_id, order_type, symbol=None):
+        self.request('cancel_order')
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None:
+                raise KucoinRequestException('NOT_FOUND: order %s' % order_id)
+            self.cancel(order)
+
+    def cancel_all_orders(self, symbol=None, order_type=None):
+        self.request('cancel_all_orders')
+        with self.lock:
+            for order in list(self.orders.values()):
+                if (not symbol or order.symbol == symbol) and (not order_type or order.type == order_type):
+                    self.cancel(order)
+
+    def get_active_orders(self, symbol, kv_format=False):
+        self.request('get_active_orders')
+        result = {'BUY': [], 'SELL': []}
+        with self.lock:
+            for order in self.orders.values():
+                if order.symbol != symbol or order.pending <= 1e-12:
+                    continue
+                if kv_format:
+                    coin, market = symbol.split('-')
+                    result[order.type].append({'oid': order.order_id, 'type': order.type, 'coinType': coin,
+                                               'coinTypePair': market, 'direction': order.type,
+                                               'price': order.price, 'dealAmount': order.dealt,
+                                               'pendingAmount': order.pending, 'createdAt': order.created_at})
+                else:
+                    result[order.type].append([order.created_at, order.type, order.price, order.amount,
+                                               order.dealt, order.order_id])
+        return result
+
+    def get_symbol_dealt_orders(self, symbol, order_type=None, limit=None, page=None):
+        self.request('get_symbol_dealt_orders')
+        limit = limit or 12
+        with self.lock:
+            deals = [deal for deal in self.deals[symbol] if not order_type or deal['direction'] == order_type]
+        start = ((page or 1) - 1) * limit
+        return {'datas': deals[start:start + limit], 'total': len(deals), 'limit': limit, 'page': page or 1}
+
+    def get_dealt_orders(self, symbol=None, order_type=None, limit=None, page=None, since=None, before=None):
+        self.request('get_dealt_orders')
+        limit = limit or 12
+        with self.lock:
+            deals = [deal for deals in ([self.deals[symbol]] if symbol else list(self.deals.values())) for deal in deals
+                     if (not order_type or deal['direction'] == order_type) and
+                     (not since or deal['createdAt'] >= since) and (not before or deal['createdAt'] < before)]
+        deals.sort(key=lambda deal: deal['createdAt'], reverse=True)
+        start = ((page or 1) - 1) * limit
+        return {'datas': deals[start:start + limit], 'total': len(deals), 'limit': limit, 'page': page or 1}
+
+    def get_order_details(self, symbol, order_type, limit=None, page=None, order_id=None):
+        self.request('get_order_details')
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None or order.symbol != symbol:
+                return None
+            deals = list(order.deals)
+            dealt, pending = order.dealt, order.pending
+        value = sum(deal['dealValue'] for deal in deals)
+        return {'coinType': symbol.split('-')[0], 'coinTypePair': symbol.split('-')[1], 'orderOid': order.order_id,
+                'type': order.type, 'orderPrice': order.price, 'dealAmount': dealt, 'pendingAmount': pending,
+                'dealValueTotal': value, 'dealPriceAverage': value / dealt if dealt else 0.0,
+                'feeTotal': sum(deal['fee'] for deal in deals),
+                'dealOrders': {'datas': deals[:limit], 'total': len(deals)}}
+
+    def get_order_book(self, symbol, group=None, limit=None):
+        self.request('get_order_book')
+        with self.lock:
+            book = self.book(symbol)
+            return {'BUY': book.depth('BUY', limit), 'SELL': book.depth('SELL', limit),
+                    'timestamp': int(time.time() * 1000)}
+
+    def get_tick(self, symbol=None):
+        self.request('get_tick')
+        with self.lock:
+            ticks = []
+            for book_symbol, book in self.books.items():
+                if symbol and book_symbol != symbol:
+                    continue
+                coin, market = book_symbol.split('-')
+                ticks.append({COIN_TYPE: coin, COIN_TYPE_PAIR: market, 'trading': True, BUY: book.best('BUY'),
+                              SELL: book.best('SELL'), 'lastDealPrice': self.last_prices.get(book_symbol),
+                              'feeRate': self.fee_rate, 'datetime': time.time() * 1000})
+        return ticks[0] if symbol and ticks else ticks
+
+    def balance_entry(self, coin):
+        frozen = self.frozen[coin]
+        balance = self.balances[coin] - frozen
+        return {'coinType': coin, 'balance': balance, 'freezeBalance': frozen, 'balanceStr': str(balance),
+                'freezeBalanceStr': str(frozen)}
+
+    def get_all_balances(self, limit=None, page=None):
+        self.request('get_all_balances')
+        with self.lock:
+            return [self.balance_entry(coin) for coin in list(self.balances)]
+
+    def get_coin_balance(self, coin):
+        self.request('get_coin_balance')
+        with self.lock:
+            return self.balance_entry(coin)
+
+    def rate(self, coin):
+        """
+        :return: USD rate of a coin, given or derived from the last price against a coin with a given rate
+        """
+        if coin in self.rates:
+            return self.rates[coin]
+        for market, market_rate in self.rates.items():
+            book = self.books.get('%s-%s' % (coin, market))
+            price = self.last_prices.get('%s-%s' % (coin, market)) or (book and book.best('BUY'))
+            if price:
+                return price * market_rate
+        return 0.0
+
+    def get_currencies(self, coins=None):
+        self.request('get_currencies')
+        if isinstance(coins, str):
+            coins = coins.split(',')
+        with self.lock:
+            return {'currencies': [], 'rates': dict((coin, {'USD': self.rate(coin)})
+                                                    for coin in (coins or list(self.balances)))}
+
+    def get_coin_list(self):
+        self.request('get_coin_list')
+        coins = set(self.balances)
+        for symbol in list(self.books):
+            coins.update(symbol.split('-'))
+        return [{'coin': coin, 'name': coin, 'tradePrecision': self.precision.get(coin, DEFAULT_PRECISION.get(coin, 4)),
+                 ENABLE_WITHDRAW: True, ENABLE_DEPOSIT: True} for coin in sorted(coins)]
+
+    def get_total_balance(self, currency='USD'):
+        self.request('get_total_balance')
+        with self.lock:
+            return sum((self.balances[coin]) * self.rate(coin) for coin in list(self.balances))
+
+
+class SyntheticFlow(threading.Thread):
+    """
+    Market maker quoting depth levels around a random walk mid price of every symbol, every interval seconds,
+    and hitting the top of the book with a taker order at taker_rate per symbol and interval.
+
+    The mids of a triangle walk independently, so its spread drifts around zero and now and then clears the trade
+    threshold.
+    """
+
+    def __init__(self, simulator, mids, interval=0.1, volatility=0.0005, half_spread=0.001, depth=5,
+                 level_value=1.0, taker_rate=0.05, seed=None):
+        threading.Thread.__init__(self, name="SyntheticFlow", daemon=True)
+        self.simulator = simulator
+        self.mids = dict(mids)
+        self.interval = interval
+        self.volatility = volatility
+        self.half_spread = half_spread
+        self.depth = depth
+        # Value of a level in the market coin of the symbol.
+        self.level_value = level_value
+        self.taker_rate = taker_rate
+        self.random = random.Random(seed)
+        self.stop = False
+
+    def quote(self, symbol):
+        mid = self.mids[symbol] = self.mids[symbol] * math.exp(self.random.gauss(0, self.volatility))
+        precision = self.simulator.precision.get(symbol.split('-')[1], DEFAULT_PRECISION.get(symbol.split('-')[1], 8))
+        amount = self.level_value / mid
+        step = max(self.half_spread, 10 ** -precision / mid)
+        bids = [[round(mid * (1 - self.half_spread - step * i), precision), amount] for i in range(self.depth)]
+        asks = [[round(mid * (1 + self.half_spread + step * i), precision), amount] for i in range(self.depth)]
+        self.simulator.set_quotes(symbol, bids, asks)
+        if self.random.random() < self.taker_rate:
+            order_type = self.random.choice(('BUY', 'SELL'))
+            price = asks[0][0] if order_type == 'BUY' else bids[0][0]
+            self.simulator.take(symbol, order_type, price, amount * self.random.random())
+
+    def run(self):
+        while not self.stop:
+            started = time.time()
+            for symbol in self.mids:
+                try:
+                    self.quote(symbol)
+                except Exception as e:
+                    log.error("Synthetic flow failed to quote %s." % symbol)
+                    log.error(e, exc_info=True)
+            time.sleep(max(0.0, self.interval - (time.time() - started)))
+
+
+class ReplayFlow(threading.Thread):
+    """
+    Market maker quoting the books of a BookLog at their recorded pace, sped up speed times.
+    """
+
+    def __init__(self, simulator, book_log, speed=1.0, loop=False):
+        threading.Thread.__init__(self, name="ReplayFlow", daemon=True)
+        self.simulator = simulator
+        self.book_log = book_log
+        self.speed = speed
+        self.loop = loop
+        self.stop = False
+
+    def run(self):
+        while not self.stop:
+            started, first_timestamp = time.time(), None
+            for timestamp, ticker in self.book_log.tickers():
+                if self.stop:
+                    return
+                first_timestamp = first_timestamp or timestamp
+                delay = (timestamp - first_timestamp) / self.speed - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+                self.simulator.set_quotes(ticker['symbol'], ticker['BUY_LEVELS'], ticker['SELL_LEVELS'])
+            if not self.loop:
+                return
+
+
+def simulated_exchange(coins, market_1, market_2, usd_per_coin=10000.0, market_1_usd=8000.0, latency=0.0,
+                       jitter=0.0, rate_limit=0.0, error_rate=0.0, lost_order_rate=0.0, seed=None):
+    """
+    ExchangeSimulator quoting the triangles of coins with a running SyntheticFlow, and a bot account holding
+    usd_per_coin worth of every coin.
+    """
+    market_2_price = 0.05
+    rng = random.Random(seed)
+    mids = {'%s-%s' % (market_2, market_1): market_2_price}
+    rates = {market_1: market_1_usd, market_2: market_2_price * market_1_usd}
+    for coin in coins:
+        price = 10 ** rng.uniform(-5, -2)
+        mids['%s-%s' % (coin, market_1)] = price
+        mids['%s-%s' % (coin, market_2)] = price / market_2_price
+        rates[coin] = price * market_1_usd
+    balances = dict((coin, usd_per_coin / rate) for coin, rate in rates.items())
+    simulator = ExchangeSimulator(balances, rates={market_1: market_1_usd}, latency=latency, jitter=jitter,
+                                  rate_limit=rate_limit, error_rate=error_rate, lost_order_rate=lost_order_rate,
+                                  seed=seed)
+    flow = SyntheticFlow(simulator, mids, level_value=usd_per_coin / market_1_usd / 10, seed=seed)
+    # Quote once before returning, the books are never empty.
+    for symbol in mids:
+        flow.quote(symbol)
+    flow.start()
+    simulator.flow = flow
+    return simulator
+
+
+class LoadTest(object):
+    """
+    threads workers creating and tracking crossing orders through one TransactionHelper, i.e. its executor,
+    connection pool and fill tracker, for seconds.
+    """
+
+    def __init__(self, simulator, symbols, threads=8, seconds=30.0, value=0.001):
+        self.simulator = simulator
+        self.symbols = symbols
+        self.threads = threads
+        self.seconds = seconds
+        self.value = value
+        self.transaction_helper = TransactionHelper(simulator)
+        # Cancel whatever did not fill within about 2 seconds instead of 36.
+        self.transaction_helper.fill_poll_step = 0.05
+        self.specs = {}
+        coins_info = dict((coin['coin'], coin) for coin in simulator.get_coin_list())
+        for symbol in symbols:
+            coin, market = symbol.split('-')
+            self.specs[symbol] = SymbolSpec(symbol, coins_info[market]['tradePrecision'],
+                                            coins_info[coin]['tradePrecision'])
+        self.deal_ratios = []
+        self.failures = 0
+
+    def order(self, rng):
+        symbol = rng.choice(self.symbols)
+        order_type = rng.choice(('BUY', 'SELL'))
+        book = self.simulator.get_order_book(symbol, limit=1)
+        # Cross the spread, the order takes the top level like the combo orders do.
+        price, amount = book['SELL' if order_type == 'BUY' else 'BUY'][0][:2]
+        return OrderParams.from_float(self.specs[symbol], order_type, price, min(amount, self.value / price))
+
+    def worker(self, index, deadline):
+        rng = random.Random(index)
+        while time.time() < deadline:
+            try:
+                order_params = self.order(rng)
+                if order_params.amount_ticks:
+                    self.deal_ratios.append(self.transaction_helper.track_single_order(order_params))
+            except Exception as e:
+                log.debug(e, exc_info=True)
+                self.failures += 1
+
+    def run(self):
+        started = time.time()
+        deadline = started + self.seconds
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for future in [executor.submit(self.worker, i, deadline) for i in range(self.threads)]:
+                future.result()
+        elapsed = time.time() - started
+        dealt = [ratio for ratio in self.deal_ratios if ratio > 0.999]
+        return {'seconds': round(elapsed, 3), 'orders': len(self.deal_ratios), 'failures': self.failures,
+                'orders_per_second': round(len(self.deal_ratios) / elapsed, 2), 'fully_dealt': len(dealt),
+                'simulator': dict(self.simulator.stats)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test TransactionHelper against the exchange simulator")
+    parser.add_argument('--coin', default='NEO-DRGN-FOTA-TNC', help='coins to quote, separated by dash(-).')
+    parser.add_argument('--market', default='BTC-ETH', help='The two markets to quote against.')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent order workers.')
+    parser.add_argument('--seconds', type=float, default=30.0, help='duration of the load test.')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated API latency in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='mean of the exponential latency jitter.')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='requests per second, 0 for no limit.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of the requests failing.')
+    parser.add_argument('--lost-order-rate', type=float, default=0.0,
+                        help='fraction of the created orders whose response gets lost.')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the prices, the flow and the errors.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
+
+    markets = args.market.split('-')
+    coins = args.coin.split('-')
+    simulator = simulated_exchange(coins, markets[0], markets[1], latency=args.latency, jitter=args.jitter,
+                                   rate_limit=args.rate_limit, error_rate=args.error_rate,
+                                   lost_order_rate=args.lost_order_rate, seed=args.seed)
+    symbols = ['%s-%s' % (coin, market) for coin in coins for market in markets]
+    print(json.dumps(LoadTest(simulator, symbols, args.threads, args.seconds).run(), indent=2))
@@ -0,0 +1,125 @@
+"""
+Local stand-in for the kucoin push feed, used to test MarketDataFeed without touching the exchange, see
+tests/test_market_data.py.
+
+    python src/feed_stub_server.py --symbols NEO-BTC-NEO-ETH-ETH-BTC --port 8765
+
+The server accepts '/trade/<symbol>_TRADE' subscriptions, answers pings and broadcasts the level updates
+passed to publish(). With --simulate it also publishes random level updates for every symbol.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+
+import websockets
+
+log = logging.getLogger(__name__)
+
+
+class FeedStubServer(threading.Thread):
+    def __init__(self, host='127.0.0.1', port=8765):
+        threading.Thread.__init__(self, name="FeedStubServer", daemon=True)
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.subscriptions = {}
+        self.started = threading.Event()
+        self.stop_event = None
+
+    async def handler(self, ws):
+        self.subscriptions[ws] = set()
+        try:
+            async for raw in ws:
+                message = json.loads(raw)
+                if message.get('type') == 'subscribe':
+                    self.subscriptions[ws].add(message['topic'])
+                    await ws.send(json.dumps({'id': message.get('id'), 'type': 'ack'}))
+                elif message.get('type') == 'ping':
+                    await ws.send(json.dumps({'id': message.get('id'), 'type': 'pong'}))
+        finally:
+            self.subscriptions.pop(ws, None)
+
+    async def serve(self):
+        self.stop_event = asyncio.Event()
+        async with websockets.serve(self.handler, self.host, self.port):
+            self.started.set()
+            await self.stop_event.wait()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.serve())
+
+    @property
+    def url(self):
+        return "ws://%s:%d" % (self.host, self.port)
+
+    async def broadcast(self, topic, message):
+        for ws, topics in list(self.subscriptions.items()):
+            if topic in topics:
+                await ws.send(message)
+
+    def publish(self, symbol, side, price, count, action='ADD', timestamp=None):
+        """
+        Broadcast a level update to every connection subscribed to the symbol. Safe to call from any thread.
+        :param timestamp: exchange time of the update in milliseconds, now if None
+        """
+        topic = '/trade/%s_TRADE' % symbol
+        message = json.dumps({'type': 'message', 'topic': topic,
+                              'data': {'type': side, 'price': price, 'count': count, 'action': action,
+                                       'time': timestamp or int(time.time() * 1000)}})
+        return asyncio.run_coroutine_threadsafe(self.broadcast(topic, message), self.loop)
+
+    async def close_all(self):
+        for ws in list(self.subscriptions):
+            # Nothing is sent to a connection while it closes.
+            self.subscriptions.pop(ws, None)
+            await ws.close()
+
+    def disconnect(self):
+        """
+        Close every connection, as the exchange does now and then. Safe to call from any thread.
+        """
+        return asyncio.run_coroutine_threadsafe(self.close_all(), self.loop)
+
+    def shutdown(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+
+def simulate(server, symbols, interval):
+    """
+    Publish random ADD/CANCEL updates around a fixed mid price for every symbol.
+    """
+    while True:
+        for symbol in symbols:
+            side = random.choice(['BUY', 'SELL'])
+            offset = random.randint(1, 5) * 1e-6
+            price = round(1e-3 - offset if side == 'BUY' else 1e-3 + offset, 8)
+            server.publish(symbol, side, price, round(random.uniform(0.1, 10.0), 4), random.choice(['ADD', 'CANCEL']))
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the push order book feed")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--symbols', default='', help='symbols separated by dash(-), e.g. NEO-BTC-NEO-ETH.')
+    parser.add_argument('--simulate', action='store_true', help='publish random level updates.')
+    parser.add_argument('--interval', type=float, default=0.1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    stub = FeedStubServer(args.host, args.port)
+    stub.start()
+    stub.started.wait()
+    log.info("Feed stub server listening on %s", stub.url)
+    parts = args.symbols.split('-') if args.symbols else []
+    scan_symbols = ['%s-%s' % (parts[i], parts[i + 1]) for i in range(0, len(parts) - 1, 2)]
+    if args.simulate:
+        simulate(stub, scan_symbols, args.interval)
+    else:
+        stub.join()
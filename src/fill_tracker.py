@@ -0,0 +1,332 @@
+import collections
+import concurrent.futures
+import threading
+
+import flight_recorder
+import metrics
+from utility import *
+
+log = logging.getLogger(__name__)
+
+
+class TrackedOrder(object):
+    __slots__ = ('order_id', 'order_params', 'future', 'started', 'deadline', 'deal_amount', 'polls')
+
+    def __init__(self, order_id, order_params, timeout):
+        self.order_id = order_id
+        self.order_params = order_params
+        self.future = concurrent.futures.Future()
+        self.started = time.time()
+        self.deadline = self.started + timeout
+        self.deal_amount = 0.0
+        self.polls = 0
+
+    def next_poll(self, poll_budget):
+        """
+        The budget of polls is spread over the tracking time, denser at first when fills are likeliest, like the
+        former poll_step * i schedule. Once it is spent the order is due at its deadline.
+        """
+        return self.started + (self.deadline - self.started) * min(1.0, float(self.polls) / poll_budget) ** 2
+
+
+class OrderTracker(object):
+    """
+    Outstanding orders of a fill tracker, their dealt amounts and poll schedule, polled by FillTracker from its own
+    thread or by AsyncFillTracker on the event loop.
+
+    A tick polls when an order is due, at most every poll_interval seconds: one merged get_dealt_orders call, since
+    the oldest outstanding order was created, updates every order on every symbol. An order pays for at most
+    poll_budget ticks spread over its tracking time, then one more at its deadline, ticks paid for by other orders
+    still update it. Clients without the merged endpoint, or when it fails, fall back to one get_symbol_dealt_orders
+    call per symbol of the orders due. The future of an order is resolved with its dealt amount once it is fully
+    dealt or its deadline passed. A push feed can report fills directly through on_fill. The time orders took to be
+    fully dealt, or the timeout of those which weren't, is recorded as 'order_fill' in the metrics registry.
+    """
+    DEALT_ORDERS_LIMIT = 20
+    # Pages of the merged deals read per tick, a busy account may have more deals since its oldest order.
+    DEALT_ORDERS_PAGES = 5
+    # Seconds the since filter reaches back before the oldest order, for the clock skew with the exchange.
+    SINCE_MARGIN = 5.0
+    POLL_INTERVAL = 0.05
+    POLL_BUDGET = 20
+
+    def __init__(self, client, poll_interval=POLL_INTERVAL, poll_budget=POLL_BUDGET):
+        self.client = client
+        self.poll_interval = poll_interval
+        self.poll_budget = poll_budget
+        self.orders = {}
+        self.lock = threading.Lock()
+        self.stop = False
+
+    def add(self, order_id, order_params, timeout):
+        order = TrackedOrder(order_id, order_params, timeout)
+        with self.lock:
+            if order_id in self.orders:
+                raise ValueError("Order %s is already tracked." % order_id)
+            self.orders[order_id] = order
+        return order
+
+    def is_tracked(self, order_id):
+        with self.lock:
+            return order_id in self.orders
+
+    def on_fill(self, order_id, deal_amount):
+        """
+        Report the total dealt amount of an order, e.g. from a push feed.
+        """
+        with self.lock:
+            order = self.orders.get(order_id)
+        if order:
+            self.update(order, deal_amount)
+
+    def finish(self, order_id, deal_amount):
+        """
+        Resolve an order that won't deal any further, e.g. cancelled, with its final dealt amount.
+        """
+        with self.lock:
+            order = self.orders.get(order_id)
+        if order:
+            order.deal_amount = max(order.deal_amount, deal_amount)
+            self.resolve(order)
+
+    def update(self, order, deal_amount):
+        flight_recorder.RECORDER.fill_poll(order.order_params, deal_amount)
+        order.deal_amount = max(order.deal_amount, deal_amount)
+        if order.deal_amount / order.order_params['amount'] > 0.999:
+            self.resolve(order, time.time())
+
+    def resolve(self, order, ended=None):
+        """
+        :param ended: time the order got fully dealt or timed out, None if it was resolved otherwise, e.g. cancelled
+        """
+        with self.lock:
+            if self.orders.pop(order.order_id, None) is None:
+                return
+        if ended is not None:
+            metrics.REGISTRY.observe('order_fill', ended - order.started)
+        order.future.set_result(order.deal_amount)
+
+    def next_delay(self):
+        """
+        :return: seconds until the next order is due, None without outstanding orders
+        """
+        now = time.time()
+        with self.lock:
+            if not self.orders:
+                return None
+            return min(order.next_poll(self.poll_budget) for order in self.orders.values()) - now
+
+    def due_orders(self):
+        """
+        :return: (every outstanding order, the orders due)
+        """
+        now = time.time()
+        with self.lock:
+            orders = list(self.orders.values())
+        return orders, [order for order in orders if order.next_poll(self.poll_budget) <= now]
+
+    def since(self, orders):
+        return int((min(order.started for order in orders) - self.SINCE_MARGIN) * 1000)
+
+    @staticmethod
+    def add_deals(deal_amounts, deals):
+        for deal in deals:
+            deal_amounts[deal['orderOid']] += float(deal['amount'])
+        return deal_amounts
+
+    @staticmethod
+    def orders_by_symbol(orders, due):
+        symbols = set(order.order_params['symbol'] for order in due)
+        orders_by_symbol = collections.defaultdict(list)
+        for order in orders:
+            if order.order_params['symbol'] in symbols:
+                orders_by_symbol[order.order_params['symbol']].append(order)
+        return orders_by_symbol
+
+    def apply_deals(self, orders, deal_amounts):
+        for order in orders:
+            self.update(order, deal_amounts.get(order.order_id, 0.0))
+
+    def polled(self, due):
+        now = time.time()
+        for order in due:
+            order.polls += 1
+            if now >= order.deadline:
+                self.resolve(order, order.deadline)
+
+
+class FillTracker(OrderTracker, threading.Thread):
+    """
+    Watch every outstanding order from one thread, see OrderTracker.
+    """
+    WORKERS = 3
+
+    def __init__(self, client, poll_interval=OrderTracker.POLL_INTERVAL, poll_budget=OrderTracker.POLL_BUDGET):
+        OrderTracker.__init__(self, client, poll_interval, poll_budget)
+        threading.Thread.__init__(self, name="FillTracker", daemon=True)
+        self.wakeup = threading.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.WORKERS)
+
+    def track(self, order_id, order_params, timeout):
+        """
+        :return: future resolved with the dealt amount of the order
+        """
+        order = self.add(order_id, order_params, timeout)
+        self.wakeup.set()
+        return order.future
+
+    def get_dealt_amounts(self, symbol):
+        response = call_api_with_retry(self.client.get_symbol_dealt_orders, symbol, None, self.DEALT_ORDERS_LIMIT)
+        return self.add_deals(collections.defaultdict(float), response['datas'])
+
+    def get_all_dealt_amounts(self, since):
+        """
+        :param since: time in milliseconds of the oldest deal of interest
+        :return: {order id: dealt amount} of the deals on every symbol since then
+        """
+        deal_amounts = collections.defaultdict(float)
+        read = 0
+        for page in range(1, self.DEALT_ORDERS_PAGES + 1):
+            response = call_api_with_retry(self.client.get_dealt_orders, None, None, self.DEALT_ORDERS_LIMIT, page,
+                                           since)
+            self.add_deals(deal_amounts, response['datas'])
+            read += len(response['datas'])
+            if not response['datas'] or read >= response.get('total', 0):
+                break
+        return deal_amounts
+
+    def poll_merged(self, orders):
+        """
+        Update every outstanding order from the merged deals.
+        :return: False if the merged deals couldn't be read
+        """
+        if not hasattr(self.client, 'get_dealt_orders'):
+            return False
+        try:
+            deal_amounts = self.get_all_dealt_amounts(self.since(orders))
+        except Exception as e:
+            log.error("Error while polling the merged dealt orders, polling by symbol.")
+            log.error(e, exc_info=True)
+            return False
+        self.apply_deals(orders, deal_amounts)
+        return True
+
+    def poll_by_symbol(self, orders, due):
+        futures = dict((self.executor.submit(self.get_dealt_amounts, symbol), symbol_orders)
+                       for symbol, symbol_orders in self.orders_by_symbol(orders, due).items())
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                deal_amounts = future.result()
+            except Exception as e:
+                log.error("Error while polling dealt orders.")
+                log.error(e, exc_info=True)
+                continue
+            self.apply_deals(futures[future], deal_amounts)
+
+    def poll(self):
+        orders, due = self.due_orders()
+        if not due:
+            return
+        if not self.poll_merged(orders):
+            self.poll_by_symbol(orders, due)
+        self.polled(due)
+
+    def run(self):
+        while not self.stop:
+            delay = self.next_delay()
+            if delay is None or delay > 0:
+                self.wakeup.wait(1 if delay is None else min(delay, 1))
+                self.wakeup.clear()
+                continue
+            started = time.time()
+            try:
+                self.poll()
+            except Exception as e:
+                log.error("Fill tracker failed to poll.")
+                log.error(e, exc_info=True)
+            time.sleep(max(0.0, self.poll_interval - (time.time() - started)))
+
+
+class AsyncFillTracker(OrderTracker):
+    """
+    Watch every outstanding order from a coroutine on the event loop, polling with an AsyncClient, see OrderTracker.
+    """
+
+    def __init__(self, client, poll_interval=OrderTracker.POLL_INTERVAL, poll_budget=OrderTracker.POLL_BUDGET):
+        OrderTracker.__init__(self, client, poll_interval, poll_budget)
+        self.wakeup = asyncio.Event()
+
+    def track(self, order_id, order_params, timeout):
+        """
+        Must be called from the event loop.
+        :return: awaitable resolved with the dealt amount of the order
+        """
+        order = self.add(order_id, order_params, timeout)
+        self.wakeup.set()
+        return asyncio.wrap_future(order.future)
+
+    async def get_dealt_amounts(self, symbol):
+        response = await async_call_api_with_retry(self.client.get_symbol_dealt_orders, symbol, None,
+                                                   self.DEALT_ORDERS_LIMIT)
+        return self.add_deals(collections.defaultdict(float), response['datas'])
+
+    async def get_all_dealt_amounts(self, since):
+        deal_amounts = collections.defaultdict(float)
+        read = 0
+        for page in range(1, self.DEALT_ORDERS_PAGES + 1):
+            response = await async_call_api_with_retry(self.client.get_dealt_orders, None, None,
+                                                       self.DEALT_ORDERS_LIMIT, page, since)
+            self.add_deals(deal_amounts, response['datas'])
+            read += len(response['datas'])
+            if not response['datas'] or read >= response.get('total', 0):
+                break
+        return deal_amounts
+
+    async def poll_merged(self, orders):
+        if not hasattr(self.client, 'get_dealt_orders'):
+            return False
+        try:
+            deal_amounts = await self.get_all_dealt_amounts(self.since(orders))
+        except Exception as e:
+            log.error("Error while polling the merged dealt orders, polling by symbol.")
+            log.error(e, exc_info=True)
+            return False
+        self.apply_deals(orders, deal_amounts)
+        return True
+
+    async def poll_by_symbol(self, orders, due):
+        orders_by_symbol = self.orders_by_symbol(orders, due)
+        results = await asyncio.gather(*[self.get_dealt_amounts(symbol) for symbol in orders_by_symbol],
+                                       return_exceptions=True)
+        for symbol_orders, deal_amounts in zip(orders_by_symbol.values(), results):
+            if isinstance(deal_amounts, Exception):
+                log.error("Error while polling dealt orders.")
+                log.error(deal_amounts, exc_info=deal_amounts)
+                continue
+            self.apply_deals(symbol_orders, deal_amounts)
+
+    async def poll(self):
+        orders, due = self.due_orders()
+        if not due:
+            return
+        if not await self.poll_merged(orders):
+            await self.poll_by_symbol(orders, due)
+        self.polled(due)
+
+    async def run(self):
+        while not self.stop:
+            delay = self.next_delay()
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), 1 if delay is None else min(delay, 1))
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            started = time.time()
+            try:
+                await self.poll()
+            except Exception as e:
+                log.error("Fill tracker failed to poll.")
+                log.error(e, exc_info=True)
+            await asyncio.sleep(max(0.0, self.poll_interval - (time.time() - started)))
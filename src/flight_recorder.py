@@ -0,0 +1,131 @@
+import itertools
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+SCAN, TICKER, ORDER_SUBMIT, FILL_POLL, TRADE_FAILURE = range(5)
+# Names of the event kinds and of their four values, for the dumps.
+EVENT_FIELDS = {
+    SCAN: ('scan', ('spread_12', 'spread_21', None, None)),
+    TICKER: ('ticker', ('bid', 'bid_amount', 'ask', 'ask_amount')),
+    ORDER_SUBMIT: ('order_submit', ('price', 'amount', 'dealt_amount', 'latency')),
+    FILL_POLL: ('fill_poll', ('dealt_amount', 'amount', None, None)),
+    TRADE_FAILURE: ('trade_failure', ('deal_ratio', None, None, None)),
+}
+
+
+class FlightRecorder(object):
+    """
+    Fixed-size ring buffer of binary encoded events of the trading path, dumped to disk when a trade fails.
+
+    An event is one struct: timestamp, kind, a flag (side, direction or success), a symbol id and four floats. The
+    slot is taken from an itertools.count, which is atomic under the GIL, so recording is a pack_into without any
+    lock. dump() only copies the buffer, the events of the last dump_seconds are decoded and written as JSON lines by
+    a background thread.
+    """
+    EVENT = struct.Struct('<dBBH4d')
+
+    def __init__(self, capacity=65536, dump_dir='/logs', dump_seconds=30.0, min_dump_interval=1.0):
+        self.capacity = capacity
+        self.dump_dir = dump_dir
+        self.dump_seconds = dump_seconds
+        self.min_dump_interval = min_dump_interval
+        self.buffer = bytearray(self.EVENT.size * capacity)
+        self.slots = itertools.count()
+        self.symbols = {}
+        self.symbol_names = []
+        self.lock = threading.Lock()
+        self.last_dump = 0.0
+        self.enabled = True
+
+    def symbol_id(self, symbol):
+        symbol_id = self.symbols.get(symbol)
+        if symbol_id is None:
+            with self.lock:
+                symbol_id = self.symbols.get(symbol)
+                if symbol_id is None:
+                    symbol_id = len(self.symbol_names)
+                    self.symbol_names.append(symbol)
+                    self.symbols[symbol] = symbol_id
+        return symbol_id
+
+    def record(self, kind, symbol, flag=0, v0=0.0, v1=0.0, v2=0.0, v3=0.0):
+        if not self.enabled:
+            return
+        slot = next(self.slots) % self.capacity
+        self.EVENT.pack_into(self.buffer, slot * self.EVENT.size, time.time(), kind, flag, self.symbol_id(symbol),
+                             v0, v1, v2, v3)
+
+    def scan(self, coin, spread_12, spread_21):
+        self.record(SCAN, coin, 0, spread_12, spread_21)
+
+    def ticker(self, ticker):
+        self.record(TICKER, ticker['symbol'], 0, ticker['BUY'][0], ticker['BUY'][1], ticker['SELL'][0],
+                    ticker['SELL'][1])
+
+    def order_submit(self, order_params, dealt_amount, latency, success=True):
+        self.record(ORDER_SUBMIT, order_params['symbol'], (order_params['type'] == 'BUY') | (success << 1),
+                    order_params['price'], order_params['amount'], dealt_amount, latency)
+
+    def fill_poll(self, order_params, dealt_amount):
+        self.record(FILL_POLL, order_params['symbol'], order_params['type'] == 'BUY', dealt_amount,
+                    order_params['amount'])
+
+    def trade_failure(self, coin, deal_ratio, direction):
+        self.record(TRADE_FAILURE, coin, direction, deal_ratio)
+
+    def events(self, since=0.0):
+        """
+        :return: decoded events recorded after since, oldest first
+        """
+        return self.decode(bytes(self.buffer), next(self.slots), since)
+
+    def decode(self, data, end, since):
+        events = []
+        for i in range(max(0, end - self.capacity), end):
+            timestamp, kind, flag, symbol_id, *values = self.EVENT.unpack_from(
+                data, (i % self.capacity) * self.EVENT.size)
+            if timestamp < since or kind not in EVENT_FIELDS:
+                continue
+            name, value_names = EVENT_FIELDS[kind]
+            event = {'time': timestamp, 'event': name, 'symbol': self.symbol_names[symbol_id], 'flag': flag}
+            event.update((value_name, value) for value_name, value in zip(value_names, values) if value_name)
+            events.append(event)
+        # Taking the end slot above left a hole, whatever it holds is older.
+        events.sort(key=lambda event: event['time'])
+        return events
+
+    def dump(self, reason):
+        """
+        Write the events of the last dump_seconds to <dump_dir>/flight-<time>-<reason>.jsonl in the background.
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            if now - self.last_dump < self.min_dump_interval:
+                return
+            self.last_dump = now
+        end, data = next(self.slots), bytes(self.buffer)
+        path = os.path.join(self.dump_dir, 'flight-%s-%s.jsonl' % (time.strftime('%Y%m%d-%H%M%S'), reason))
+        threading.Thread(target=self.write, args=(path, data, end, now - self.dump_seconds),
+                         name="FlightRecorderDump", daemon=True).start()
+
+    def write(self, path, data, end, since):
+        try:
+            events = self.decode(data, end, since)
+            with open(path, 'w') as f:
+                for event in events:
+                    f.write(json.dumps(event) + '\n')
+            log.info("Dumped %d flight recorder events to %s", len(events), path)
+        except Exception as e:
+            log.error("Failed to dump the flight recorder.")
+            log.error(e, exc_info=True)
+
+
+RECORDER = FlightRecorder()
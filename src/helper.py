@@ -1,10 +1,15 @@
-import collections
 import concurrent.futures
-import itertools
 from pathlib import Path
 
 from kucoin.exceptions import *
 
+from arbitrage_graph import ArbitrageGraph
+import flight_recorder
+import metrics
+from balance_ledger import BalanceLedger
+from quotes import OrderParams, SymbolTable
+from rebalancer import RebalancePlanner
+from spread_scanner import SpreadScanner
 from transaction_helper import TransactionHelper
 from utility import *
 from constants import *
@@ -15,21 +20,46 @@ log = logging.getLogger(__name__)
 class Helper(object):
     TRADE_PRECISION = 'tradePrecision'
     TRADE_THRESHOLD = 0.008
-
-    def __init__(self, client, market_1, market_2):
+    ORDER_BOOK_DEPTH = 5
+    # Log 1 out of HOT_LOG_SAMPLE of the per-scan INFO lines, 0 to turn them off. The flight recorder keeps them all.
+    HOT_LOG_SAMPLE = 100
+    # Seconds apart the three books of a triangle may be, by receive time and by exchange time, for its spread to
+    # be traded.
+    CONSISTENCY_WINDOW = 0.3
+    # Seconds a balance order waits for funds reserved by triangles in flight before it is skipped.
+    REBALANCE_RESERVE_TIMEOUT = 10.0
+
+    def __init__(self, client, market_1, market_2, market_data=None, recorder=None, balance_store=None,
+                 consistency_window=CONSISTENCY_WINDOW):
         self.client = client
+        self.market_data = market_data
+        self.recorder = recorder
         self.market_1 = market_1
         self.market_2 = market_2
         self.base_symbol = "%s-%s" % (market_2, market_1)
         self.coins_info = self.load_coins_info()
         self.market_1_price = None
 
-        self.balance_cache = self.get_all_balances()
+        self.ledger = BalanceLedger(client, store=balance_store)
+        self.ledger.reconcile()
+        self.ledger.start()
+        metrics.REGISTRY.register_gauge('reservations', self.ledger.reservations.stats)
+        metrics.REGISTRY.register_gauge('reservations_refused', self.ledger.reservations.refused_assets, label='asset')
         self.profit = 0.0
-        self.transaction_helper = TransactionHelper(client)
+        self.transaction_helper = TransactionHelper(client, ledger=self.ledger)
         self.min_amount = self.get_min_order_amount()
+        self.symbol_table = SymbolTable(self.coins_info, self.min_amount, market_1, market_2)
         self.trade_ratio = 0.49
         self.trade_static = {'success': {}, 'failure': {}}
+        self.spread_scanner = SpreadScanner(market_1, market_2, self.TRADE_THRESHOLD)
+        self.rebalance_planner = RebalancePlanner(market_1, market_2, self.coins_info)
+        self.arbitrage_graph = ArbitrageGraph(threshold=self.TRADE_THRESHOLD)
+        # Best top-of-book spread of the last scan of each coin, for the coin scheduler.
+        self.last_spreads = {}
+        self.consistency_window = consistency_window
+        # Spreads checked against the consistency window, and those rejected as mixing books from different moments
+        self.consistency_stats = {'checked': 0, 'phantom': 0}
+        metrics.REGISTRY.register_gauge('spread_consistency', lambda: dict(self.consistency_stats))
 
     def load_coins_info(self):
         try:
@@ -48,7 +78,24 @@ class Helper(object):
 
     def get_order_book(self, symbol, group=None, limit=None):
         response = call_api_with_retry(self.client.get_order_book, symbol, group, limit)
-        return {'symbol': symbol, 'BUY': response['BUY'][0][:2], 'SELL': response['SELL'][0][:2]}
+        ticker = self.make_ticker(symbol, response, time.monotonic())
+        if self.recorder:
+            self.recorder.record(ticker)
+        return ticker
+
+    def make_ticker(self, symbol, response, received=None):
+        """
+        Convert an order book response to a ticker: the top level under 'BUY'/'SELL' and the first
+        ORDER_BOOK_DEPTH levels under 'BUY_LEVELS'/'SELL_LEVELS', as [price, amount]. 'received' is the
+        time.monotonic() the response arrived and 'exchange_time' the server time of the response in seconds, None
+        if the client doesn't tell it.
+        """
+        timestamp = response.get('timestamp')
+        return {'symbol': symbol, 'BUY': response['BUY'][0][:2], 'SELL': response['SELL'][0][:2],
+                'BUY_LEVELS': [level[:2] for level in response['BUY'][:self.ORDER_BOOK_DEPTH]],
+                'SELL_LEVELS': [level[:2] for level in response['SELL'][:self.ORDER_BOOK_DEPTH]],
+                'received': time.monotonic() if received is None else received,
+                'exchange_time': timestamp / 1000.0 if timestamp else None}
 
     def get_symbol_dealt_orders(self, symbol, order_type, limit):
         try:
@@ -124,8 +171,8 @@ class Helper(object):
         return new_price, amount
 
     def get_trade_amount(self, order_amount, coin, coin_price, market_2_price, trade_precision):
-        market_1_bal, market_2_bal = self.balance_cache[self.market_1], self.balance_cache[self.market_2]
-        coin_bal = self.balance_cache[coin]
+        market_1_bal, market_2_bal = self.ledger.available(self.market_1), self.ledger.available(self.market_2)
+        coin_bal = self.ledger.available(coin)
 
         # Calculate balances based on market_1
         coin_worth = coin_bal * coin_price
@@ -156,14 +203,31 @@ class Helper(object):
             self.transaction_helper.cancel_active_order(symbol, orderOid, order_type)
             log.info("Successfully cancelled order %s" % orderOid)
 
-    def detect_spread_and_fill(self, coin):
-        symbol_1 = '%s-%s' % (coin, self.market_1)
-        symbol_2 = '%s-%s' % (coin, self.market_2)
-        base_symbol = '%s-%s' % (self.market_2, self.market_1)
+    def get_triangle_symbols(self, coin):
+        return '%s-%s' % (coin, self.market_1), '%s-%s' % (coin, self.market_2), self.base_symbol
 
-        tickers = self.get_orderbook_parallel([symbol_1, symbol_2, base_symbol])
+    def detect_spread_and_fill(self, coin):
+        tickers = self.get_orderbook_parallel(list(self.get_triangle_symbols(coin)))
         if not tickers:
             return False
+        for ticker in tickers:
+            flight_recorder.RECORDER.ticker(ticker)
+        order_group = self.prepare_order_group(coin, tickers)
+        if order_group is False:
+            time.sleep(0.5)
+        if not order_group:
+            return False
+        return self.create_order_group_helper(*order_group)
+
+    def prepare_order_group(self, coin, tickers):
+        """
+        Detect the spread of a coin and build the 3 combo orders for it.
+
+        :param tickers: order books of the coin on both markets and of the base symbol
+        :return: (spread, order_1_params, order_2_params, order_3_params, direction), None if there is no spread
+                 or False if there is a spread but the order amount is too low.
+        """
+        symbol_1, symbol_2, base_symbol = self.get_triangle_symbols(coin)
         for ticker in tickers:
             if ticker['symbol'] == symbol_1:
                 ticker_1 = ticker
@@ -173,120 +237,125 @@ class Helper(object):
                 base_ticker = ticker
 
         spread_result = self.get_spread(ticker_1, ticker_2, base_ticker, coin)
-        make_spread = False
-
         if not spread_result:
-            return False
-            # spread_result = self.make_spread(ticker_1, ticker_2, base_ticker, coin)
-            # if not spread_result:
-            #     return False
-            # make_spread = True
+            return None
+        if not self.is_consistent(coin, (ticker_1, ticker_2, base_ticker)):
+            return None
 
         spread, direction = spread_result[0], spread_result[1]
+        depth_result = None
+        if all('BUY_LEVELS' in ticker for ticker in (ticker_1, ticker_2, base_ticker)):
+            # Size the orders to the depth of all three legs, the tickers are replaced by the worst levels to take.
+            depth_result = self.calculate_spread_with_best_tick(ticker_1, ticker_2, base_ticker, direction)
+            if depth_result:
+                ticker_1, ticker_2, base_ticker = depth_result[1:]
         # Trade precision is the minimum order quantity increment for this currency.
         # For market currencies, it is the minimum order price increment for all tokens trading on it.
-        trade_precision_1 = self.coins_info[self.market_1][self.TRADE_PRECISION]
-        trade_precision_2 = self.coins_info[self.market_2][self.TRADE_PRECISION]
-        coin_trade_precision = self.coins_info[coin][self.TRADE_PRECISION]
+        spec_1, spec_2, base_spec = self.symbol_table.triangle(coin)
+        trade_precision_1 = base_spec.price_precision
+        coin_trade_precision = spec_1.amount_precision
+        min_amount = max(spec_1.min_amount, spec_2.min_amount)
         if direction:
             # market_1 -> coin -> market_2 -> market_1
 
-            price_1, amount_1 = self.generate_order(ticker_1, 'SELL', trade_precision_1)
-            price_2, amount_2 = self.generate_order(ticker_2, 'BUY', trade_precision_2)
+            price_1, amount_1 = ticker_1['SELL']
+            price_2, amount_2 = ticker_2['BUY']
             price_3, amount_3 = self.generate_order(base_ticker, 'BUY', trade_precision_1, floating_price=True,
                                                     floating_rate=100)
-            spread_volumes = {symbol_1: amount_1, symbol_2: amount_2, base_symbol: amount_3}
-            log_json_utils(log.info, message="Spread volume information", data=spread_volumes)
+            if sample_log('spread_volume', self.HOT_LOG_SAMPLE):
+                spread_volumes = {symbol_1: amount_1, symbol_2: amount_2, base_symbol: amount_3}
+                log_json_utils(log.info, message="Spread volume information", data=spread_volumes)
             amount = min(amount_1, amount_2)
             trade_amount = self.get_trade_amount(amount, coin, price_1, price_3, coin_trade_precision)
-            if trade_amount <= max(self.min_amount[symbol_1], self.min_amount[symbol_2]):
+            if trade_amount <= min_amount:
                 log.info("Failed to create orders for this spread. Order amount too low %f" % trade_amount)
-                time.sleep(0.5)
                 return False
-            order_1_params = {'symbol': symbol_1, 'type': 'BUY', 'amount': trade_amount, 'price': price_1}
-            order_2_params = {'symbol': symbol_2, 'type': 'SELL',
-                              'amount': round(trade_amount, coin_trade_precision), 'price': price_2}
-            order_3_params = {'symbol': base_symbol,
-                              'type': 'SELL',
-                              'amount': round(price_2 * trade_amount, trade_precision_2),
-                              'price': price_3}
-
-            spread = price_2 / price_1 * price_3
-            if make_spread:
-                return self.create_order_group_helper(spread, order_1_params, order_2_params, order_3_params, direction,
-                                                      timeout=210, additional_wait_time=8)
-            return self.create_order_group_helper(spread, order_1_params, order_2_params, order_3_params, direction)
+            order_1_params = OrderParams.from_float(spec_1, 'BUY', price_1, trade_amount)
+            order_2_params = OrderParams.from_float(spec_2, 'SELL', price_2, trade_amount)
+            order_3_params = OrderParams.from_float(base_spec, 'SELL', price_3, order_2_params.price * trade_amount)
+
+            spread = depth_result[0] if depth_result else price_2 / price_1 * price_3
         else:
             # currency_2 -> coin -> currency_1 -> currency_2
 
-            price_1, amount_1 = self.generate_order(ticker_2, 'SELL', trade_precision_2)
-            price_2, amount_2 = self.generate_order(ticker_1, 'BUY', trade_precision_1)
+            price_1, amount_1 = ticker_2['SELL']
+            price_2, amount_2 = ticker_1['BUY']
             price_3, amount_3 = self.generate_order(base_ticker, 'SELL', trade_precision_1, floating_price=True,
                                                     floating_rate=100)
-            spread_volumes = {symbol_2: amount_1, symbol_1: amount_2, base_symbol: amount_3}
-            log_json_utils(log.info, message="Spread volume information", data=spread_volumes)
+            if sample_log('spread_volume', self.HOT_LOG_SAMPLE):
+                spread_volumes = {symbol_2: amount_1, symbol_1: amount_2, base_symbol: amount_3}
+                log_json_utils(log.info, message="Spread volume information", data=spread_volumes)
             amount = min(amount_1, amount_2)
             trade_amount = self.get_trade_amount(amount, coin, price_2, price_3, coin_trade_precision)
-            if trade_amount <= max(self.min_amount[symbol_1], self.min_amount[symbol_2]):
+            if trade_amount <= min_amount:
                 log.info("Failed to create orders for this spread. Order amount too low %f." % trade_amount)
-                time.sleep(0.5)
                 return False
-            order_1_params = {'symbol': symbol_2, 'type': 'BUY', 'amount': trade_amount, 'price': price_1}
-            order_2_params = {'symbol': symbol_1, 'type': 'SELL',
-                              'amount': trade_amount, 'price': price_2}
-            order_3_params = {'symbol': base_symbol,
-                              'type': 'BUY',
-                              'amount': round(price_2 * trade_amount / price_3, trade_precision_2),
-                              'price': price_3}
-
-            spread = price_2 / price_1 / price_3
-            if make_spread:
-                return self.create_order_group_helper(spread, order_1_params, order_2_params, order_3_params, direction,
-                                                      timeout=210, additional_wait_time=8)
-
-            return self.create_order_group_helper(spread, order_1_params, order_2_params, order_3_params, direction)
-
-    def create_order_group_helper(self, spread, order_1_params, order_2_params, order_3_params, direction, timeout=60, additional_wait_time=0):
-        if (spread - 1) > (self.TRADE_THRESHOLD - 0.001):
+            order_1_params = OrderParams.from_float(spec_2, 'BUY', price_1, trade_amount)
+            order_2_params = OrderParams.from_float(spec_1, 'SELL', price_2, trade_amount)
+            order_3_params = OrderParams.from_float(base_spec, 'BUY', price_3,
+                                                    order_2_params.price * trade_amount / price_3)
+
+            spread = depth_result[0] if depth_result else price_2 / price_1 / price_3
+        return spread, order_1_params, order_2_params, order_3_params, direction
+
+    def clears_threshold(self, spread):
+        return (spread - 1) > (self.TRADE_THRESHOLD - 0.001)
+
+    def create_order_group_helper(self, spread, order_1_params, order_2_params, order_3_params, direction, timeout=None, additional_wait_time=0):
+        if self.clears_threshold(spread):
             # create a new order
             order_params_group = [order_1_params, order_2_params, order_3_params]
             log_json_utils(log.info, message="Creating 3 combo orders", data=order_params_group)
-            deal_ratio = self.transaction_helper.deal_parallel_orders(order_params_group, timeout, additional_wait_time)
-            if direction:
-                profit = order_3_params['amount'] * order_3_params['price'] - order_1_params['amount'] * order_1_params[
-                    'price']
-            else:
-                profit = (order_3_params['amount'] - order_1_params['amount'] * order_1_params['price']) * \
-                         order_3_params['price']
-            profit = round(profit * deal_ratio, self.coins_info[self.market_1][self.TRADE_PRECISION])
-            self.profit += profit
-
-            # Refresh market coin balances after creating orders.
-            if self.market_1 != 'USDT':
-                if self.market_1_price:
-                    log.critical("Current Profit is %.8f USDT" % (self.profit * self.market_1_price))
-                else:
-                    log.error("Primary market exchange rate is not available")
-            else:
-                log.critical("Current Profit is %.8f USDT" % self.profit)
+            try:
+                deal_ratio = self.transaction_helper.deal_parallel_orders(order_params_group, timeout,
+                                                                          additional_wait_time)
+            except Exception:
+                # The group failed before its result could be recorded, see record_trade_result.
+                flight_recorder.RECORDER.dump('trade_failure')
+                raise
+            # Partially dealt legs were applied to the ledger, have it double checked against the exchange.
+            if deal_ratio < 0.5:
+                self.ledger.request_reconcile()
+            return self.record_trade_result(order_1_params, order_3_params, direction, deal_ratio)
+        else:
+            if sample_log('spread_lower', self.HOT_LOG_SAMPLE):
+                log.info("Spread lower than minimum requirement." + " {:.2%}".format((spread - 1) / 1.0))
+            return False
 
-            coin = order_1_params['symbol'].split('-')[0]
-            if deal_ratio > 0.999:
-                log.info("Trade succeeded. Earned %.8f %s" % (profit, self.market_1))
-                previous_static = self.trade_static['success'].get(coin, (0, 0))
-                self.trade_static['success'][coin] = (previous_static[0] + 1, previous_static[1] + profit)
+    def record_trade_result(self, order_1_params, order_3_params, direction, deal_ratio):
+        """
+        Update profit and trade statics after a 3 combo order group has been dealt.
+        :return: True if the trade succeeded
+        """
+        if direction:
+            profit = order_3_params['amount'] * order_3_params['price'] - order_1_params['amount'] * order_1_params[
+                'price']
+        else:
+            profit = (order_3_params['amount'] - order_1_params['amount'] * order_1_params['price']) * \
+                     order_3_params['price']
+        profit = round(profit * deal_ratio, self.coins_info[self.market_1][self.TRADE_PRECISION])
+        self.profit += profit
+
+        if self.market_1 != 'USDT':
+            if self.market_1_price:
+                log.critical("Current Profit is %.8f USDT" % (self.profit * self.market_1_price))
             else:
-                log.error("Trade failed. Earned %.8f %s" % (profit, self.market_1))
-                previous_static = self.trade_static['failure'].get(coin, (0, 0))
-                self.trade_static['failure'][coin] = (previous_static[0] + 1, previous_static[1] + profit)
-                # Refresh balance cache
-                if deal_ratio < 0.5:
-                    self.balance_cache = self.get_all_balances()
-                return False
-            return True
+                log.error("Primary market exchange rate is not available")
         else:
-            log.info("Spread lower than minimum requirement." + " {:.2%}".format((spread - 1) / 1.0))
-            return False
+            log.critical("Current Profit is %.8f USDT" % self.profit)
+
+        coin = order_1_params['symbol'].split('-')[0]
+        if deal_ratio > 0.999:
+            log.info("Trade succeeded. Earned %.8f %s" % (profit, self.market_1))
+            previous_static = self.trade_static['success'].get(coin, (0, 0))
+            self.trade_static['success'][coin] = (previous_static[0] + 1, previous_static[1] + profit)
+            return True
+        log.error("Trade failed. Earned %.8f %s" % (profit, self.market_1))
+        flight_recorder.RECORDER.trade_failure(coin, deal_ratio, direction)
+        flight_recorder.RECORDER.dump('trade_failure')
+        previous_static = self.trade_static['failure'].get(coin, (0, 0))
+        self.trade_static['failure'][coin] = (previous_static[0] + 1, previous_static[1] + profit)
+        return False
 
     def create_order_group_helper_tmp(self, **kwargs):
         ticker_from, ticker_to = kwargs['ticker_from'], kwargs['ticker_to']
@@ -309,11 +378,32 @@ class Helper(object):
             return False
         return trade_amount
 
+    def is_consistent(self, coin, tickers):
+        """
+        Check that the books of a triangle were taken close enough in time to be combined, by the time they were
+        received and by the exchange time they tell. A timestamp missing on a book, e.g. replayed from a book log,
+        skips its check.
+        :return: False if the books are more than consistency_window seconds apart
+        """
+        self.consistency_stats['checked'] += 1
+        for key in ('received', 'exchange_time'):
+            times = [ticker.get(key) for ticker in tickers]
+            if None in times:
+                continue
+            skew = max(times) - min(times)
+            if skew > self.consistency_window:
+                self.consistency_stats['phantom'] += 1
+                log.warning("Spread of %s rejected, its books are %.3f s apart by %s.", coin, skew, key)
+                return False
+        return True
+
     def get_spread(self, ticker_1, ticker_2, base_ticker, coin):
         ratio_12 = ticker_2['BUY'][0] / ticker_1['SELL'][0]
         ratio_21 = ticker_1['BUY'][0] / ticker_2['SELL'][0]
         spread_12 = ratio_12 * base_ticker['BUY'][0]
         spread_21 = ratio_21 / base_ticker['SELL'][0]
+        self.last_spreads[coin] = max(spread_12, spread_21) - 1
+        flight_recorder.RECORDER.scan(coin, spread_12 - 1, spread_21 - 1)
         if (spread_12 - 1) > self.TRADE_THRESHOLD:
             log.info("%s -> %s -> %s  " % (self.market_1, coin, self.market_2) + "{:.2%} ".format(
                 (spread_12 - 1) / 1.0) + "unit: %s" % self.market_1)
@@ -389,152 +479,190 @@ class Helper(object):
                    "spread {:.2%}  ".format((spread - 1) / 1.0)]
         return ' '.join(message)
 
-    def calculate_spread_with_best_tick(self, ticker_1, ticker_2, base_ticker, coin):
-        ratio_12 = ticker_2['BUY'][0] / ticker_1['SELL'][0]
-        ratio_21 = ticker_1['BUY'][0] / ticker_2['SELL'][0]
-        spread_12 = ratio_12 * base_ticker['BUY'][0]
-        spread_21 = ratio_21 / base_ticker['SELL'][0]
-        best_indices_1, best_indices_2 = (0, 0), (0, 0) # (BUY, SELL)
-        while (spread_12 - 1) > 0.008:
-            ratio_12 = ticker_2['BUY'][best_indices_2[0]] / ticker_1['SELL'][best_indices_1[1]]
-            ratio_21 = ticker_1['BUY'][best_indices_1[0]] / ticker_2['SELL'][best_indices_2[0]]
-            spread_12 = ratio_12 * base_ticker['BUY'][0]
-            spread_21 = ratio_21 / base_ticker['SELL'][0]
+    def calculate_spread_with_best_tick(self, ticker_1, ticker_2, base_ticker, direction):
+        """
+        Walk the order book levels of all three legs together and find the largest coin quantity whose cumulative
+        spread still clears TRADE_THRESHOLD. The spread of a quantity is computed from the volume weighted prices
+        of the levels it takes, so it only decreases as the quantity grows.
+
+        :param direction: True for market_1 -> coin -> market_2, False for market_2 -> coin -> market_1
+        :return: (spread, ticker_1, ticker_2, base_ticker) where each ticker holds [worst level price, amount] on
+                 the side to take, or None if even the smallest quantity doesn't clear the threshold.
+        """
+        if direction:
+            buy_levels, sell_levels = ticker_1['SELL_LEVELS'], ticker_2['BUY_LEVELS']
+        else:
+            buy_levels, sell_levels = ticker_2['SELL_LEVELS'], ticker_1['BUY_LEVELS']
+
+        def evaluate(quantity):
+            cost, buy_price = walk_levels(buy_levels, quantity)
+            proceeds, sell_price = walk_levels(sell_levels, quantity)
+            if cost is None or proceeds is None:
+                return None
+            if direction:
+                # Sell the market_2 proceeds for market_1.
+                base_amount = proceeds
+                back, base_price = walk_levels(base_ticker['BUY_LEVELS'], proceeds)
+            else:
+                # Buy market_2 with the market_1 proceeds.
+                back, base_price = walk_levels_by_value(base_ticker['SELL_LEVELS'], proceeds)
+                base_amount = back
+            if back is None:
+                return None
+            return back / cost, buy_price, sell_price, base_price, base_amount
+
+        breakpoints, total = [], 0.0
+        for levels in (buy_levels, sell_levels):
+            total = 0.0
+            for level in levels:
+                total += level[1]
+                breakpoints.append(total)
+        best_quantity, best, upper = 0.0, None, None
+        for quantity in sorted(set(breakpoints)):
+            result = evaluate(quantity)
+            if not result or result[0] - 1 <= self.TRADE_THRESHOLD:
+                upper = quantity
+                break
+            best_quantity, best = quantity, result
+        if upper is not None:
+            # The spread only decreases with the quantity, bisect between the last passing and first failing one.
+            lower = best_quantity
+            for _ in range(20):
+                middle = (lower + upper) / 2
+                result = evaluate(middle)
+                if result and result[0] - 1 > self.TRADE_THRESHOLD:
+                    lower, best_quantity, best = middle, middle, result
+                else:
+                    upper = middle
+        if not best:
+            return None
+
+        spread, buy_price, sell_price, base_price, base_amount = best
+        if direction:
+            ticker_1 = {'symbol': ticker_1['symbol'], 'SELL': [buy_price, best_quantity]}
+            ticker_2 = {'symbol': ticker_2['symbol'], 'BUY': [sell_price, best_quantity]}
+            base_ticker = {'symbol': base_ticker['symbol'], 'BUY': [base_price, base_amount]}
+        else:
+            ticker_2 = {'symbol': ticker_2['symbol'], 'SELL': [buy_price, best_quantity]}
+            ticker_1 = {'symbol': ticker_1['symbol'], 'BUY': [sell_price, best_quantity]}
+            base_ticker = {'symbol': base_ticker['symbol'], 'SELL': [base_price, base_amount]}
+        return spread, ticker_1, ticker_2, base_ticker
 
     def get_currencies(self, coin=None):
         return call_api_with_retry(self.client.get_currencies, coin)['rates']
 
-    def idle_executor(self):
-        log.info("Idle executors in order to keep connections alive.")
-        self.transaction_helper.idle_all_executors()
-
     def fill_balances_gap(self, scan_coins):
         """
-        Check market coin balances and target coins, if there is a hugh amount difference, try fix it.
+        Bring the balances of the scan coins and the markets back to their target weights with the orders planned
+        by the rebalance planner. Balances come from one get_all_balances call, see get_balance_entries, and the
+        orders of a wave are created and tracked concurrently, so a wave takes as long as its slowest order.
 
-        :return:
+        Trading goes on meanwhile. Targets and gaps are those of the whole balances, the funds of orders in flight
+        included, but a wave only spends what the ledger hasn't reserved for triangles, and each balance order
+        reserves what it spends, waiting up to REBALANCE_RESERVE_TIMEOUT for those triangles.
         """
         log.info("Balancing coin balances.")
-        balance = {}
-        usd_balance = {}
         full_coin_list = [self.market_1, self.market_2] + scan_coins
-        currency_count = len(full_coin_list)
-        exchange_rate = call_api_with_retry(self.client.get_currencies, list(full_coin_list))
-        exchange_rate = {k: float(v['USD']) for k, v in exchange_rate['rates'].items()}
-        for coin in full_coin_list:
-            response = call_api_with_retry(self.client.get_coin_balance, coin)
-            balance[coin] = float(response['balance'])
-            usd_value = exchange_rate[coin] * balance[coin]
-            usd_balance[coin] = usd_value
+        rates = self.transaction_helper.executor.submit(call_api_with_retry, self.client.get_currencies,
+                                                        list(full_coin_list))
+        entries = self.get_balance_entries(full_coin_list)
+        exchange_rate = {k: float(v['USD']) for k, v in rates.result()['rates'].items()}
+        balance = self.total_balances(entries, full_coin_list)
+        usd_balance = dict((coin, exchange_rate[coin] * balance[coin]) for coin in full_coin_list)
 
         self.market_1_price = exchange_rate[self.market_1]
 
-        avg_usd_balance = sum(usd_balance.values()) / currency_count
         log.info("Listing USD valued balances for all trading coins.")
         log_json_utils(log.info, **usd_balance)
 
         if not self.coins_info:
             log.info("Loading coins information")
-            self.coins_info = call_api_with_retry(self.load_coins_info)
-
-        low_market, high_market = self.compare_market_balances(usd_balance)
-        # Sell over-valued scan coins
-        for coin in scan_coins:
-            if usd_balance[coin] / avg_usd_balance > 1.25:
-                diff = usd_balance[coin] - avg_usd_balance
-                amount = round(diff / exchange_rate[coin], self.coins_info[coin]['tradePrecision'])
-                tmp_symbol = '%s-%s' % (coin, low_market)
-                ticker = call_api_with_retry(self.client.get_order_book, tmp_symbol, limit=1)
-                order_params = {'symbol': tmp_symbol, 'type': 'SELL', 'amount': amount, 'price': ticker['BUY'][0][0]}
-                self.transaction_helper.create_and_track_single_order(order_params)
-                usd_balance[coin], usd_balance[low_market] = usd_balance[coin] - diff, usd_balance[low_market] + diff
-
-        low_market, high_market = self.compare_market_balances(usd_balance)
-        # Buy under-valued scan coins
-        for coin in scan_coins:
-            if usd_balance[coin] / avg_usd_balance < 0.60:
-                diff = avg_usd_balance - usd_balance[coin]
-                amount = round(diff / exchange_rate[coin], self.coins_info[coin]['tradePrecision'])
-                tmp_symbol = '%s-%s' % (coin, high_market)
-                ticker = call_api_with_retry(self.client.get_order_book, tmp_symbol, limit=1)
-                order_params = {'symbol': tmp_symbol, 'type': 'BUY', 'amount': amount, 'price': ticker['SELL'][0][0]}
-                self.transaction_helper.create_and_track_single_order(order_params)
-                usd_balance[coin], usd_balance[high_market] = usd_balance[coin] + diff, usd_balance[high_market] - diff
-
-        # Balance two market coins
-        trade_precision = self.coins_info[self.market_2]['tradePrecision']
-        if usd_balance[self.market_1] / usd_balance[self.market_2] > 1.25:
-            diff = (usd_balance[self.market_1] - usd_balance[self.market_2]) / 2.0
-            amount = round(diff / exchange_rate[self.market_2], trade_precision)
-            tmp_symbol = '%s-%s' % (self.market_2, self.market_1)
-            ticker = call_api_with_retry(self.client.get_order_book, tmp_symbol, limit=1)
-            new_price = round(ticker['BUY'][0][0] * 0.9995, trade_precision)
-            order_params = {'symbol': tmp_symbol, 'type': 'BUY', 'amount': amount, 'price': new_price}
-            self.transaction_helper.create_and_track_single_order(order_params)
-            usd_balance[self.market_1], usd_balance[self.market_2] = usd_balance[self.market_1] - diff, usd_balance[
-                self.market_2] + diff
-        elif usd_balance[self.market_1] / usd_balance[self.market_2] < 0.75:
-            diff = (usd_balance[self.market_2] - usd_balance[self.market_1]) / 2.0
-            amount = round(diff / exchange_rate[self.market_2], trade_precision)
-            tmp_symbol = '%s-%s' % (self.market_2, self.market_1)
-            ticker = call_api_with_retry(self.client.get_order_book, tmp_symbol, limit=1)
-            new_price = round(ticker['BUY'][0][0] * 1.0005, trade_precision)
-            order_params = {'symbol': tmp_symbol, 'type': 'SELL', 'amount': amount, 'price': new_price}
-            self.transaction_helper.create_and_track_single_order(order_params)
-            usd_balance[self.market_1], usd_balance[self.market_2] = usd_balance[self.market_1] + diff, usd_balance[
-                self.market_2] - diff
+            self.coins_info = self.rebalance_planner.coins_info = call_api_with_retry(self.load_coins_info)
+
+        planned_orders = self.rebalance_planner.plan(scan_coins, usd_balance, exchange_rate)
+        for wave in self.rebalance_planner.waves(planned_orders, self.unreserved_balances(entries, full_coin_list),
+                                                 exchange_rate):
+            tickers = self.transaction_helper.executor.map(
+                lambda planned_order: call_api_with_retry(self.client.get_order_book, planned_order['symbol'], limit=1),
+                wave)
+            self.transaction_helper.create_and_track_orders(
+                [self.price_balance_order(planned_order, ticker) for planned_order, ticker in zip(wave, tickers)],
+                reserve_timeout=self.REBALANCE_RESERVE_TIMEOUT)
 
         log.info("Listing USD valued balances for all trading coins after filling gap.")
         log_json_utils(log.info, **usd_balance)
 
-        # Update the balance_cache
-        self.balance_cache = self.get_all_balances()
+        self.ledger.request_reconcile()
 
         log.info("Finished filling balance gap.")
         return
 
-    def compare_market_balances(self, usd_balance):
-        return (self.market_1, self.market_2) if usd_balance[self.market_1] < usd_balance[self.market_2] else (self.market_2, self.market_1)
+    def get_balance_entries(self, coins):
+        """
+        Balance entries of coins from one get_all_balances call. The call is paged, coins missing from its page are
+        read with get_coin_balance.
+        :return: {coin: balance entry}
+        """
+        entries = dict((entry['coinType'], entry)
+                       for entry in call_api_with_retry(self.client.get_all_balances, self.ledger.BALANCES_LIMIT))
+        missing = [coin for coin in coins if coin not in entries]
+        for coin, entry in zip(missing, self.transaction_helper.executor.map(
+                lambda coin: call_api_with_retry(self.client.get_coin_balance, coin), missing)):
+            entries[coin] = entry
+        return entries
+
+    @staticmethod
+    def total_balances(entries, coins):
+        """
+        :param entries: {coin: balance entry} of at least coins
+        :return: {coin: balance} of coins, frozen funds of active orders included
+        """
+        return dict((coin, float(entries[coin]['balance']) + float(entries[coin].get('freezeBalance') or 0.0))
+                    for coin in coins)
+
+    def unreserved_balances(self, entries, coins):
+        """
+        :param entries: {coin: balance entry} of at least coins
+        :return: {coin: balance} of coins the rebalancing may spend, less what the ledger reserved for orders in flight
+        """
+        return dict((coin, max(0.0, min(float(entries[coin]['balance']), self.ledger.available(coin))))
+                    for coin in coins)
+
+    def price_balance_order(self, planned_order, ticker):
+        price = round(ticker[planned_order['price_side']][0][0] * planned_order['price_factor'],
+                      planned_order['price_precision'])
+        return {'symbol': planned_order['symbol'], 'type': planned_order['type'], 'amount': planned_order['amount'],
+                'price': price}
 
     def detect_spread_in_all_coins(self):
+        """
+        Scan every coin listed on both markets with one get_tick call and fill the best spread we can trade.
+        :return: True if a spread has been filled
+        """
         all_tickers = self.client.get_tick()
-        ticker_cache = collections.defaultdict(list)
-        for ticker in all_tickers:
-            coin, coinPair = ticker[COIN_TYPE], ticker[COIN_TYPE_PAIR]
-            tmp_symbol = '%s-%s' % (coin, coinPair)
-            ticker_cache[coin].append({COIN_TYPE_PAIR: coinPair, TICKER: ticker})
-
-        for ticker_group in ticker_cache.keys():
-            for pair in itertools.combinations(ticker_cache[ticker_group], 2):
-                market_1, market_2 = pair[0][COIN_TYPE_PAIR], pair[1][COIN_TYPE_PAIR]
-                if (market_1, market_2) != ('BTC', 'ETH'):
-                    continue
-                base_ticker = list(filter(lambda x: x[COIN_TYPE_PAIR] == 'BTC', ticker_cache['ETH']))[0][TICKER]
-                current_spread = self.get_spread_ticker_without_amount(pair[0][TICKER], pair[1][TICKER], base_ticker, ticker_group)
-                if current_spread:
-                    return self.detect_spread_and_fill(ticker_group, market_1, market_2)
+        self.detect_arbitrage_cycles(all_tickers)
+        candidates = self.spread_scanner.scan(all_tickers)
+        for spread, coin, direction in candidates:
+            symbol_1, symbol_2 = '%s-%s' % (coin, self.market_1), '%s-%s' % (coin, self.market_2)
+            if coin not in self.coins_info or symbol_1 not in self.min_amount or symbol_2 not in self.min_amount:
+                continue
+            log.info("%s -> %s -> %s  " % ((self.market_1, coin, self.market_2) if direction else (
+                self.market_2, coin, self.market_1)) + "{:.2%} ".format(spread) + "unit: %s" % self.market_1)
+            if self.detect_spread_and_fill(coin):
+                return True
         return False
 
-    def get_spread_ticker_without_amount(self, ticker_1, ticker_2, base_ticker, coin):
-        if any(i not in j or not j[i] for i in (BUY, SELL) for j in (ticker_1, ticker_2)):
-            return
-        ratio_12 = ticker_2[BUY] / ticker_1[SELL]
-        ratio_21 = ticker_1[BUY] / ticker_2[SELL]
-        spread_12 = ratio_12 * base_ticker[BUY]
-        spread_21 = ratio_21 / base_ticker[SELL]
-        if (spread_12 - 1) > 0.008:
-            print("%s -> %s -> %s  " % (ticker_1[COIN_TYPE_PAIR], coin, ticker_2[COIN_TYPE_PAIR]),
-                  "{:.2%}  ".format((spread_12 - 1) / 1.0), "unit %s" % ticker_1[COIN_TYPE_PAIR])
-            log.info("%s -> %s -> %s  " % (ticker_1[COIN_TYPE_PAIR], coin, ticker_2[COIN_TYPE_PAIR]) + "{:.2%} ".format(
-                (spread_12 - 1) / 1.0) + "unit: %s" % ticker_1[COIN_TYPE_PAIR])
-            return (spread_12 - 1) / 1.0, True
-        if (spread_21 - 1) > 0.008:
-            print("%s -> %s -> %s  " % (ticker_2[COIN_TYPE_PAIR], coin, ticker_1[COIN_TYPE_PAIR]),
-                  "{:.2%}  ".format((spread_21 - 1) / 1.0), "unit %s" % ticker_1[COIN_TYPE_PAIR])
-            log.info("%s -> %s -> %s  " % (ticker_2[COIN_TYPE_PAIR], coin, ticker_1[COIN_TYPE_PAIR]) + "{:.2%} ".format(
-                (spread_21 - 1) / 1.0) + "unit: %s" % ticker_1[COIN_TYPE_PAIR])
-            return (spread_21 - 1) / 1.0, False
-        return
+    def detect_arbitrage_cycles(self, all_tickers):
+        """
+        Update the currency graph with a ticker snapshot and log the profitable cycles it found across all quote
+        markets.
+        :return: list of (profit, cycle), the most profitable first
+        """
+        added, removed = self.arbitrage_graph.update(all_tickers)
+        for cycle in added:
+            log.info("Arbitrage cycle %s -> %s " % (' -> '.join(cycle), cycle[0]) + "{:.2%}".format(
+                self.arbitrage_graph.cycles[cycle]))
+        return self.arbitrage_graph.profitable_cycles()
 
     def get_min_order_amount(self):
         log.info("Getting minimum order amount data from configuration file.")
@@ -542,16 +670,64 @@ class Helper(object):
         with abs_path.open('r') as f:
             return json.load(f)[MINIMUM_ORDER_AMOUNT]
 
-    def get_orderbook_parallel(self, symbol_list):
-        futures = [self.transaction_helper.executor.submit(self.get_order_book, symbol, limit=1) for symbol in
-                   symbol_list]
+    def get_order_books_hedged(self, symbol_list):
+        """
+        Request the order books in parallel, within the scan deadline of the deadline manager. Requests still pending
+        after its hedge delay get a duplicate on the hedge executor, the first answer for a symbol is taken.
+        :return: tickers in the order of symbol_list
+        :raise concurrent.futures.TimeoutError: if a book isn't there by the deadline
+        """
+        deadlines = self.transaction_helper.deadlines
+        deadline = deadlines.book_deadline()
+        hedge_delay = deadlines.hedge_delay()
+        started = time.time()
+        attempts = dict((self.transaction_helper.executor.submit(self.get_order_book, symbol,
+                                                                 limit=self.ORDER_BOOK_DEPTH), symbol)
+                        for symbol in symbol_list)
+        books = {}
+        while len(books) < len(symbol_list):
+            wait = (deadline if hedge_delay is None else hedge_delay) - (time.time() - started)
+            done, _ = concurrent.futures.wait(attempts, timeout=max(0.0, wait),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                symbol = attempts.pop(future)
+                if symbol in books:
+                    continue
+                try:
+                    books[symbol] = future.result()
+                except Exception:
+                    if symbol not in attempts.values():
+                        raise
+            if done:
+                continue
+            if hedge_delay is None:
+                raise concurrent.futures.TimeoutError()
+            for symbol in set(attempts.values()) - set(books):
+                attempts[self.transaction_helper.hedge_executor.submit(self.get_order_book, symbol,
+                                                                       limit=self.ORDER_BOOK_DEPTH)] = symbol
+            deadlines.hedges += 1
+            hedge_delay = None
+        return [books[symbol] for symbol in symbol_list]
 
+    def get_orderbook_parallel(self, symbol_list):
         result = []
+        if self.market_data:
+            # Serve the books from the push feed, only poll the symbols it cannot serve right now.
+            missing = []
+            for symbol in symbol_list:
+                ticker = self.market_data.get_ticker(symbol)
+                if ticker:
+                    if self.recorder:
+                        self.recorder.record(ticker)
+                    result.append(ticker)
+                else:
+                    missing.append(symbol)
+            if not missing:
+                return result
+            symbol_list = missing
+
         try:
-            for future in concurrent.futures.as_completed(futures, timeout=0.5):
-                tmp_result = future.result()
-                if tmp_result and 'symbol' in tmp_result:
-                    result.append(tmp_result)
+            result.extend(self.get_order_books_hedged(symbol_list))
         except concurrent.futures._base.TimeoutError:
             log.warning("Didn't finish getting order books on time.")
             return None
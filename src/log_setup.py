@@ -1,8 +1,10 @@
+import atexit
 import json
 import logging.config
 import os
+import queue
 from logging import DEBUG
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from pathlib import Path
 
 LOG_CONFIGURATION_FILENAME = 'configurations/log-configuration.json'
@@ -12,10 +14,13 @@ abs_path = str(Path(Path(__file__).resolve().parents[1], LOG_CONFIGURATION_FILEN
 def setup_logging(
     default_path=abs_path,
     default_level=logging.INFO,
-    env_key='LOG_CFG'
+    env_key='LOG_CFG',
+    use_queue=None
 ):
     """Setup logging configuration
 
+    A "queue": true key at the top of the configuration, or use_queue=True, moves the configured root handlers
+    behind a queue, see enable_queue_logging.
     """
     path = default_path
     value = os.getenv(env_key, None)
@@ -24,7 +29,10 @@ def setup_logging(
     if os.path.isfile(path):
         with open(path, 'rt') as f:
             config = json.load(f)
+        config_queue = config.pop('queue', False)
         logging.config.dictConfig(config)
+        if use_queue if use_queue is not None else config_queue:
+            enable_queue_logging()
         print("Successfully loaded logging configuration.")
     else:
         logging.basicConfig(level=default_level)
@@ -39,3 +47,36 @@ class DebugFileHandler(TimedRotatingFileHandler):
         if not record.levelno == DEBUG:
             return
         TimedRotatingFileHandler.emit(self, record)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler leaving the record as is, the message is only built, and log_json_utils payloads only
+    serialized, when the listener thread hands the record to a handler. The payloads are snapshots taken by
+    log_json_utils, %-style arguments should be immutable values.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def enable_queue_logging(logger=None):
+    """
+    Move the handlers of a logger, the root logger by default, behind a queue drained by a listener thread.
+
+    Logging calls then only append the record to a SimpleQueue, formatting and writing to the console and files
+    happen in the listener, so a slow disk or stdout never stalls the calling thread.
+    :return: the started QueueListener, stopped at exit after flushing the queue
+    """
+    logger = logger or logging.getLogger()
+    handlers = [handler for handler in logger.handlers if not isinstance(handler, QueueHandler)]
+    if not handlers:
+        return None
+    record_queue = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(DeferredQueueHandler(record_queue))
+    listener = QueueListener(record_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
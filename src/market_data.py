@@ -0,0 +1,228 @@
+import heapq
+import threading
+
+import websocket
+
+from utility import *
+
+log = logging.getLogger(__name__)
+
+
+class LocalOrderBook(object):
+    """
+    In-memory price level book of a single symbol, seeded by a REST snapshot and kept up to date by feed updates.
+
+    The kucoin v1 feed has no sequence numbers: updates are told apart from those already in the snapshot by their
+    exchange time, those no later than the snapshot are dropped.
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.levels = {'BUY': {}, 'SELL': {}}
+        self.ready = False
+        self.updated_at = 0.0
+        # Exchange time in milliseconds the snapshot was served at
+        self.snapshot_time = None
+
+    def apply_snapshot(self, snapshot, snapshot_time=None):
+        for side in ('BUY', 'SELL'):
+            self.levels[side] = dict((level[0], level[1]) for level in snapshot.get(side) or [])
+        self.snapshot_time = snapshot.get('timestamp') or snapshot_time
+        self.ready = True
+        self.updated_at = time.time()
+
+    def is_stale(self, update_time):
+        """
+        :param update_time: exchange time in milliseconds of a feed update, None if it has none
+        :return: True if the update is already in the snapshot
+        """
+        return update_time is not None and self.snapshot_time is not None and update_time <= self.snapshot_time
+
+    def apply_update(self, side, price, count, action):
+        levels = self.levels[side]
+        if action == 'ADD':
+            levels[price] = levels.get(price, 0.0) + count
+        elif action == 'CANCEL':
+            remaining = levels.get(price, 0.0) - count
+            if remaining > 1e-12:
+                levels[price] = remaining
+            else:
+                levels.pop(price, None)
+        else:
+            raise ValueError("Invalid action=%s, must be either ADD or CANCEL." % action)
+        self.updated_at = time.time()
+
+    def best(self, side):
+        levels = self.levels[side]
+        if not levels:
+            return None
+        price = max(levels) if side == 'BUY' else min(levels)
+        return [price, levels[price]]
+
+    def is_crossed(self):
+        best_buy, best_sell = self.best('BUY'), self.best('SELL')
+        return best_buy is not None and best_sell is not None and best_buy[0] >= best_sell[0]
+
+    def to_ticker(self, depth=1):
+        """
+        Convert the local book to the ticker format returned by Helper.get_order_book.
+        :return: {'symbol', 'BUY', 'SELL', 'BUY_LEVELS', 'SELL_LEVELS'} or None if either side is empty
+        """
+        if not self.levels['BUY'] or not self.levels['SELL']:
+            return None
+        buy_levels = [[price, self.levels['BUY'][price]] for price in heapq.nlargest(depth, self.levels['BUY'])]
+        sell_levels = [[price, self.levels['SELL'][price]] for price in heapq.nsmallest(depth, self.levels['SELL'])]
+        return {'symbol': self.symbol, 'BUY': buy_levels[0], 'SELL': sell_levels[0],
+                'BUY_LEVELS': buy_levels, 'SELL_LEVELS': sell_levels}
+
+
+class MarketDataFeed(threading.Thread):
+    """
+    Subscribe once to the push feed for a set of symbols and keep a local order book for each of them.
+
+    The feed speaks the kucoin v1 push protocol: subscribe to '/trade/<symbol>_TRADE', receive ADD/CANCEL level
+    updates and keep the connection alive with application level ping/pong. Books are seeded with a REST snapshot
+    after each (re)connect and re-synced every resync_interval seconds, or right away if the local book gets crossed.
+    With a SharedBookStore as store, the top levels of every book are also published there for other processes.
+    """
+    SNAPSHOT_LIMIT = 20
+
+    def __init__(self, client, symbols, url=None, max_age=3.0, ping_interval=1.0, resync_interval=30.0, depth=5,
+                 store=None):
+        threading.Thread.__init__(self, name="MarketDataFeed", daemon=True)
+        self.client = client
+        self.symbols = list(symbols)
+        self.url = url
+        self.max_age = max_age
+        self.ping_interval = ping_interval
+        self.resync_interval = resync_interval
+        self.depth = depth
+        self.store = store
+        self.books = dict((symbol, LocalOrderBook(symbol)) for symbol in self.symbols)
+        self.lock = threading.Lock()
+        self.connected = False
+        self.last_message_at = 0.0
+        # A live book is current as of the last feed message, whichever symbol it was about: its time.monotonic()
+        # and its exchange time in seconds, the timestamps of every ticker served.
+        self.last_received = 0.0
+        self.exchange_time = None
+        self.stop = False
+        self.ws = None
+
+    def get_feed_endpoint(self):
+        if self.url:
+            return self.url
+        response = self.client._get('bullet/usercenter/loginUser', False,
+                                    data={'protocol': 'websocket', 'encrypt': 'true'})
+        server = response['instanceServers'][0]
+        return "%s?bulletToken=%s&format=json&resource=api" % (server['endpoint'], response['bulletToken'])
+
+    def get_ticker(self, symbol):
+        """
+        Serve the best bid and ask of a symbol from the local book.
+        :return: ticker in the Helper.get_order_book format, or None if the book is not usable
+        """
+        if not self.connected or time.time() - self.last_message_at > self.max_age:
+            return None
+        book = self.books.get(symbol)
+        if not book or not book.ready:
+            return None
+        with self.lock:
+            ticker = book.to_ticker(self.depth)
+        if ticker:
+            ticker['received'], ticker['exchange_time'] = self.last_received, self.exchange_time
+        return ticker
+
+    def resync(self, symbol):
+        """
+        Seed the book of a symbol with a REST snapshot. Updates received meanwhile wait in the socket, they are
+        handled once it is applied and those already in it dropped.
+        """
+        # Without the server timestamp, updates stamped before the request are taken as in the snapshot.
+        requested_at = int(time.time() * 1000)
+        response = call_api_with_retry(self.client.get_order_book, symbol, None, self.SNAPSHOT_LIMIT)
+        with self.lock:
+            self.books[symbol].apply_snapshot(response, requested_at)
+            self.publish(symbol)
+
+    def publish(self, symbol):
+        if not self.store or not self.books[symbol].ready:
+            return
+        ticker = self.books[symbol].to_ticker(self.depth)
+        if ticker:
+            self.store.write(ticker)
+        else:
+            self.store.invalidate(symbol)
+
+    def resync_all(self):
+        for symbol in self.symbols:
+            self.resync(symbol)
+
+    def subscribe(self):
+        for i, symbol in enumerate(self.symbols):
+            self.ws.send(json.dumps({'id': i, 'type': 'subscribe', 'topic': '/trade/%s_TRADE' % symbol, 'req': 1}))
+
+    def handle_message(self, message):
+        self.last_message_at = time.time()
+        self.last_received = time.monotonic()
+        data = message.get('data')
+        if isinstance(data, dict) and data.get('time'):
+            self.exchange_time = data['time'] / 1000.0
+        if self.store:
+            self.store.beat(self.exchange_time)
+        if message.get('type') != 'message' or 'topic' not in message:
+            return
+        symbol = message['topic'].split('/')[-1].rsplit('_', 1)[0]
+        book = self.books.get(symbol)
+        if not book or book.is_stale(data.get('time')):
+            return
+        with self.lock:
+            book.apply_update(data['type'], float(data['price']), float(data['count']), data['action'])
+            crossed = book.is_crossed()
+            if not crossed:
+                self.publish(symbol)
+        if crossed:
+            log.warning("Local order book of %s is crossed, re-syncing.", symbol)
+            self.resync(symbol)
+
+    def run(self):
+        i = 0
+        while not self.stop:
+            try:
+                self.ws = websocket.create_connection(self.get_feed_endpoint(), timeout=self.ping_interval)
+                self.subscribe()
+                self.resync_all()
+                self.connected = True
+                self.last_message_at = time.time()
+                log.info("Market data feed connected for %s", ','.join(self.symbols))
+                i = 0
+                self.receive_loop()
+            except Exception as e:
+                log.error("Market data feed disconnected.")
+                log.error(e)
+            finally:
+                self.connected = False
+                for book in self.books.values():
+                    book.ready = False
+                    if self.store:
+                        self.store.invalidate(book.symbol)
+                if self.ws:
+                    self.ws.close()
+            if not self.stop:
+                exponential_delay(0.2, min(i, 6))
+                i += 1
+
+    def receive_loop(self):
+        last_ping, last_resync = time.time(), time.time()
+        while not self.stop:
+            try:
+                self.handle_message(json.loads(self.ws.recv()))
+            except websocket.WebSocketTimeoutException:
+                pass
+            now = time.time()
+            if now - last_ping >= self.ping_interval:
+                self.ws.send(json.dumps({'id': int(now * 1000), 'type': 'ping'}))
+                last_ping = now
+            if now - last_resync >= self.resync_interval:
+                self.resync_all()
+                last_resync = now
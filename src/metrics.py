@@ -0,0 +1,298 @@
+import asyncio
+import collections
+import functools
+import http.server
+import logging
+import math
+import numbers
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Log-linear buckets: values below 2^SUB_BUCKET_BITS microseconds get a bucket each, every power of two above is
+# split into 2^SUB_BUCKET_BITS equal buckets, i.e. a relative error below 1/16 from 1 us up to ~100 days.
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+BUCKET_COUNT = 640
+QUANTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+API_CALL_METRIC = ('api_call_duration_seconds', 'Latency of the exchange API calls.')
+# Histograms other than the API calls: (histogram name, or prefix when labelled, metric, label, help)
+DURATION_METRICS = (
+    ('order_fill', 'order_fill_duration_seconds', None,
+     'Time orders took to be fully dealt, or their tracking timeout when they were not.'),
+    ('order_reaction', 'order_reaction_duration_seconds', None,
+     'Time an order took to be created, locating it after a lost response included.'),
+    ('rate_limit_wait_', 'rate_limit_wait_seconds', 'priority', 'Time requests waited for a rate limit token.'),
+)
+
+
+def bucket_index(value_us):
+    if value_us < SUB_BUCKETS:
+        return max(int(value_us), 0)
+    mantissa, exponent = math.frexp(value_us)
+    index = (exponent - SUB_BUCKET_BITS - 1) * SUB_BUCKETS + int(mantissa * 2 * SUB_BUCKETS)
+    return min(index, BUCKET_COUNT - 1)
+
+
+def bucket_bounds(index):
+    """
+    :return: (lower, upper) bound of a bucket in microseconds
+    """
+    if index < SUB_BUCKETS:
+        return index, index + 1
+    shift, sub_bucket = divmod(index - SUB_BUCKETS, SUB_BUCKETS)
+    width = 1 << shift
+    return (SUB_BUCKETS + sub_bucket) * width, (SUB_BUCKETS + sub_bucket + 1) * width
+
+
+class LatencyHistogram(object):
+    """
+    HDR-style histogram of durations with a fixed array of log-linear buckets.
+
+    Recording is one frexp and one list increment, percentiles are read by walking the buckets.
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        index = bucket_index(seconds * 1e6)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        """
+        :return: (bucket counts, count, max) as of now
+        """
+        with self.lock:
+            return list(self.counts), self.count, self.max
+
+    def percentile(self, quantile):
+        """
+        :return: duration in seconds below which the given fraction of the recorded values fall
+        """
+        return counts_percentile(*self.snapshot(), quantile=quantile)
+
+
+def histogram_metric(name):
+    """
+    :return: (metric, help, label text) a histogram is rendered as, the API calls being labelled by endpoint
+    """
+    for prefix, metric, label, help_text in DURATION_METRICS:
+        if label and name.startswith(prefix):
+            return metric, help_text, '%s="%s"' % (label, name[len(prefix):])
+        if name == prefix:
+            return metric, help_text, ''
+    return API_CALL_METRIC + ('endpoint="%s"' % name,)
+
+
+def label_set(*labels):
+    labels = ','.join(label for label in labels if label)
+    return '{%s}' % labels if labels else ''
+
+
+def counts_percentile(counts, count, maximum, quantile):
+    """
+    :return: percentile in seconds of the values counted in histogram buckets, e.g. the difference of two snapshots
+    """
+    if not count:
+        return 0.0
+    rank = max(1, int(math.ceil(quantile * count)))
+    seen = 0
+    for index, bucket_count in enumerate(counts):
+        seen += bucket_count
+        if seen >= rank:
+            lower, upper = bucket_bounds(index)
+            return min((lower + upper) / 2.0 / 1e6, maximum)
+    return maximum
+
+
+class Metrics(object):
+    """
+    Registry of the API latency histograms and error/retry counters, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(LatencyHistogram)
+        self.errors = collections.Counter()
+        self.retries = collections.Counter()
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self.latencies.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.latencies[name]
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).record(seconds)
+
+    def count_error(self, name):
+        with self.lock:
+            self.errors[name] += 1
+
+    def count_retry(self, name):
+        with self.lock:
+            self.retries[name] += 1
+
+    def register_gauge(self, name, fun, label='key'):
+        """
+        :param fun: callable returning {label value: number}, rendered as name{label="label value"} number
+        :param label: name of the label the keys are rendered under
+        """
+        with self.lock:
+            self.gauges[name] = (fun, label)
+
+    def histograms(self):
+        with self.lock:
+            return sorted(self.latencies.items())
+
+    def summary(self):
+        """
+        :return: {name: {'count', 'p50', 'p99', 'p999', 'max'}} in milliseconds, for logging
+        """
+        summary = {}
+        for name, histogram in self.histograms():
+            summary[name] = dict((label, round(histogram.percentile(quantile) * 1000, 3))
+                                 for label, quantile in QUANTILES)
+            summary[name].update(count=histogram.count, max=round(histogram.max * 1000, 3))
+        return summary
+
+    def render(self):
+        lines = []
+        by_metric = collections.OrderedDict([(API_CALL_METRIC, [])])
+        for name, histogram in self.histograms():
+            metric, help_text, labels = histogram_metric(name)
+            by_metric.setdefault((metric, help_text), []).append((labels, histogram))
+        for (metric, help_text), histograms in by_metric.items():
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s summary' % metric)
+            for labels, histogram in histograms:
+                for _, quantile in QUANTILES:
+                    lines.append('%s%s %.6f' % (metric, label_set(labels, 'quantile="%s"' % quantile),
+                                                histogram.percentile(quantile)))
+                lines.append('%s_sum%s %.6f' % (metric, label_set(labels), histogram.total))
+                lines.append('%s_count%s %d' % (metric, label_set(labels), histogram.count))
+        for metric, help_text, counter in (('api_call_errors_total', 'Failed exchange API calls.', self.errors),
+                                           ('api_call_retries_total', 'Retries made by call_api_with_retry.',
+                                            self.retries)):
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s counter' % metric)
+            with self.lock:
+                counts = sorted(counter.items())
+            for name, value in counts:
+                lines.append('%s{endpoint="%s"} %d' % (metric, name, value))
+        with self.lock:
+            gauges = sorted(self.gauges.items())
+        for metric, (fun, label) in gauges:
+            lines.append('# TYPE %s gauge' % metric)
+            for key, value in sorted(fun().items()):
+                if isinstance(value, bool) or not isinstance(value, numbers.Real):
+                    log.warning("Skipping non-numeric value of gauge %s{%s=\"%s\"}: %r", metric, label, key, value)
+                    continue
+                lines.append('%s{%s="%s"} %s' % (metric, label, key, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Metrics()
+
+
+class InstrumentedClient(object):
+    """
+    Proxy of a Client or AsyncClient timing every public method call into a Metrics registry.
+
+    Wrapped methods are cached on the proxy, so after the first call an endpoint costs two perf_counter calls.
+    """
+
+    def __init__(self, client, registry=REGISTRY):
+        self._client = client
+        self._registry = registry
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        wrapper = self._wrap_coroutine(name, attribute) if asyncio.iscoroutinefunction(attribute) else \
+            self._wrap(name, attribute)
+        setattr(self, name, wrapper)
+        return wrapper
+
+    def _wrap(self, name, fun):
+        registry = self._registry
+
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return fun(*args, **kwargs)
+            except Exception:
+                registry.count_error(name)
+                raise
+            finally:
+                registry.observe(name, time.perf_counter() - start_time)
+        return wrapper
+
+    def _wrap_coroutine(self, name, fun):
+        registry = self._registry
+
+        @functools.wraps(fun)
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await fun(*args, **kwargs)
+            except Exception:
+                registry.count_error(name)
+                raise
+            finally:
+                registry.observe(name, time.perf_counter() - start_time)
+        return wrapper
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serve a Metrics registry on http://<host>:<port>/metrics.
+    """
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        threading.Thread.__init__(self, name="MetricsServer", daemon=True)
+        handler = functools.partial(MetricsHandler, registry)
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+
+    def run(self):
+        log.info("Serving metrics on port %d", self.server.server_address[1])
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def __init__(self, registry, *args, **kwargs):
+        self.registry = registry
+        http.server.BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
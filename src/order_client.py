@@ -0,0 +1,107 @@
+import base64
+import hashlib
+import hmac
+import time
+
+import requests
+from kucoin.client import Client
+from kucoin.exceptions import KucoinAPIException, KucoinRequestException
+
+
+class OrderTemplate(object):
+    """
+    Request of a create_order on one symbol and side with everything but the price, the amount and the nonce
+    already rendered.
+
+    The kucoin signature is the HMAC of path/nonce/query, the query being the sorted params amount, price, symbol and
+    type, which is also the urlencoded body. Symbol and type sort last, so the body is the price and amount followed
+    by a fixed suffix.
+    """
+    __slots__ = ('uri', 'sign_prefix', 'suffix', 'headers')
+
+    def __init__(self, uri, path, symbol, order_type, headers):
+        self.uri = uri
+        self.sign_prefix = path + '/'
+        self.suffix = '&symbol=%s&type=%s' % (symbol, order_type)
+        self.headers = headers
+
+
+class OrderClient(Client):
+    """
+    kucoin v1 Client with a fast create_order, and the server timestamp of each response in its payload.
+
+    Orders are sent from a template per symbol and side, prepared ahead with prepare_orders or on first use: the
+    HMAC key is set up once and copied for each signature, the headers are merged once, and the request goes straight
+    to the adapter of the session, skipping the generic request building of requests.Session. Other endpoints are
+    those of Client.
+
+    Client keeps the response timestamp in _last_timestamp, shared by every thread. Dict payloads get it as their
+    'timestamp' key instead, in milliseconds, e.g. to tell when the exchange served an order book.
+    """
+    ORDER_PATH = 'order'
+
+    def __init__(self, api_key, api_secret, language=None):
+        Client.__init__(self, api_key, api_secret, language)
+        self.hmac = hmac.new(self.API_SECRET.encode('utf-8'), digestmod=hashlib.sha256)
+        self.templates = {}
+        self.settings = None
+
+    def prepare_orders(self, symbols):
+        for symbol in symbols:
+            for order_type in (self.SIDE_BUY, self.SIDE_SELL):
+                self.template(symbol, order_type)
+
+    def template(self, symbol, order_type):
+        template = self.templates.get((symbol, order_type))
+        if template is None:
+            path = self._create_path('post', self.ORDER_PATH)
+            headers = dict(self.session.headers)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            template = OrderTemplate(self._create_uri(path), path, symbol, order_type, headers)
+            self.templates[(symbol, order_type)] = template
+        return template
+
+    def send_settings(self):
+        """
+        :return: verify, cert and proxies settings of the session, environment included, as Session.request takes them
+        """
+        if self.settings is None:
+            self.settings = self.session.merge_environment_settings(self._create_uri('/'), {}, None, None, None)
+        return self.settings
+
+    def create_order(self, symbol, order_type, price, amount):
+        template = self.templates.get((symbol, order_type)) or self.template(symbol, order_type)
+        nonce = str(int(time.time() * 1000))
+        body = 'amount=%s&price=%s%s' % (amount, price, template.suffix)
+        signature = self.hmac.copy()
+        signature.update(base64.b64encode((template.sign_prefix + nonce + '/' + body).encode('utf-8')))
+
+        request = requests.PreparedRequest()
+        request.method = 'POST'
+        request.url = template.uri
+        request.body = body.encode('utf-8')
+        request.headers = dict(template.headers)
+        request.headers['Content-Length'] = str(len(request.body))
+        request.headers['KC-API-NONCE'] = nonce
+        request.headers['KC-API-SIGNATURE'] = signature.hexdigest()
+        settings = self.send_settings()
+        response = self.session.get_adapter(template.uri).send(request, verify=settings['verify'],
+                                                               cert=settings['cert'], proxies=settings['proxies'])
+        return self._handle_response(response)
+
+    def _handle_response(self, response):
+        if not str(response.status_code).startswith('2'):
+            raise KucoinAPIException(response)
+        try:
+            json = response.json()
+        except ValueError:
+            raise KucoinRequestException('Invalid Response: %s' % response.text)
+        if 'success' in json and not json['success']:
+            raise KucoinAPIException(response)
+        self._last_timestamp = json.get('timestamp')
+        if 'data' not in json:
+            return json
+        data = json['data']
+        if isinstance(data, dict) and 'timestamp' in json:
+            data.setdefault('timestamp', json['timestamp'])
+        return data
@@ -0,0 +1,145 @@
+class SymbolSpec(object):
+    """
+    Trading rules of a symbol COIN-MARKET, resolved once at startup.
+
+    Prices are counted in ticks of the market precision and amounts in ticks of the coin precision, the trade
+    precisions of coins_info, so rounding an order is one integer rounding instead of round(x, precision) with the
+    precision looked up every time.
+    """
+    __slots__ = ('symbol', 'coin', 'market', 'price_precision', 'amount_precision', 'price_scale', 'amount_scale',
+                 'min_amount')
+
+    def __init__(self, symbol, price_precision, amount_precision, min_amount=None):
+        self.symbol = symbol
+        self.coin, self.market = symbol.split('-')
+        self.price_precision = price_precision
+        self.amount_precision = amount_precision
+        self.price_scale = 10 ** price_precision
+        self.amount_scale = 10 ** amount_precision
+        self.min_amount = min_amount
+
+    def price_ticks(self, price):
+        return int(round(price * self.price_scale))
+
+    def amount_ticks(self, amount):
+        return int(round(amount * self.amount_scale))
+
+    def round_price(self, price):
+        return self.price_ticks(price) / self.price_scale
+
+    def round_amount(self, amount):
+        return self.amount_ticks(amount) / self.amount_scale
+
+
+class SymbolTable(object):
+    """
+    SymbolSpec of every symbol, and the specs of each coin's triangle, built from coins_info and the minimum order
+    amounts of coin_metadata.json.
+    """
+    TRADE_PRECISION = 'tradePrecision'
+
+    def __init__(self, coins_info, min_amounts, market_1, market_2):
+        self.coins_info = coins_info
+        self.min_amounts = min_amounts
+        self.market_1, self.market_2 = market_1, market_2
+        self.specs = {}
+        self.triangles = {}
+
+    def spec(self, symbol):
+        spec = self.specs.get(symbol)
+        if spec is None:
+            coin, market = symbol.split('-')
+            spec = SymbolSpec(symbol, self.coins_info[market][self.TRADE_PRECISION],
+                              self.coins_info[coin][self.TRADE_PRECISION], self.min_amounts.get(symbol))
+            self.specs[symbol] = spec
+        return spec
+
+    def triangle(self, coin):
+        """
+        :return: specs of (COIN-market_1, COIN-market_2, market_2-market_1)
+        """
+        triangle = self.triangles.get(coin)
+        if triangle is None:
+            triangle = tuple(self.spec(symbol) for symbol in ('%s-%s' % (coin, self.market_1),
+                                                               '%s-%s' % (coin, self.market_2),
+                                                               '%s-%s' % (self.market_2, self.market_1)))
+            if triangle[0].min_amount is None or triangle[1].min_amount is None:
+                raise KeyError("No minimum order amount for the symbols of %s" % coin)
+            self.triangles[coin] = triangle
+        return triangle
+
+
+class OrderParams(object):
+    """
+    Limit order held as integer price and amount ticks of its SymbolSpec.
+
+    Reads like the order params dicts it replaces, order_params['price'] and friends, so the ledger, the trackers
+    and the logs take either.
+    """
+    __slots__ = ('spec', 'type', 'price_ticks', 'amount_ticks')
+    KEYS = ('symbol', 'type', 'amount', 'price')
+
+    def __init__(self, spec, order_type, price_ticks, amount_ticks):
+        self.spec = spec
+        self.type = order_type
+        self.price_ticks = price_ticks
+        self.amount_ticks = amount_ticks
+
+    @classmethod
+    def from_float(cls, spec, order_type, price, amount):
+        return cls(spec, order_type, spec.price_ticks(price), spec.amount_ticks(amount))
+
+    @property
+    def symbol(self):
+        return self.spec.symbol
+
+    @property
+    def price(self):
+        return self.price_ticks / self.spec.price_scale
+
+    @property
+    def amount(self):
+        return self.amount_ticks / self.spec.amount_scale
+
+    @property
+    def price_text(self):
+        return '%.*f' % (self.spec.price_precision, self.price)
+
+    @property
+    def amount_text(self):
+        return '%.*f' % (self.spec.amount_precision, self.amount)
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.KEYS else default
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def keys(self):
+        return self.KEYS
+
+    def to_dict(self):
+        return {'symbol': self.symbol, 'type': self.type, 'amount': self.amount, 'price': self.price}
+
+    def __repr__(self):
+        return 'OrderParams(%s %s %s @ %s)' % (self.type, self.amount_text, self.symbol, self.price_text)
+
+
+def order_text(order_params):
+    """
+    :return: (price, amount) of an OrderParams or an order params dict, as sent to the exchange
+    """
+    if isinstance(order_params, OrderParams):
+        return order_params.price_text, order_params.amount_text
+    return str(order_params['price']), str(order_params['amount'])
+
+
+def json_default(value):
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
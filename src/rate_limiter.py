@@ -0,0 +1,188 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Priority classes, the lowest value is served first.
+ORDER, FILL, MARKET_DATA, HOUSEKEEPING = range(4)
+PRIORITY_NAMES = ('ORDER', 'FILL', 'MARKET_DATA', 'HOUSEKEEPING')
+
+ENDPOINT_PRIORITIES = {
+    'create_order': ORDER,
+    'cancel_order': ORDER,
+    'cancel_all_orders': ORDER,
+    # Read-only lookups, e.g. locating an order whose create_order response got lost.
+    'get_active_orders': FILL,
+    'get_dealt_orders': FILL,
+    'get_symbol_dealt_orders': FILL,
+    'get_order_details': FILL,
+    'get_order_book': MARKET_DATA,
+    'get_tick': MARKET_DATA,
+    'get_trading_ticker': MARKET_DATA,
+}
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """
+    Override the endpoint priority of the calls made by the current thread, e.g. keep-alive requests.
+    """
+    previous = getattr(_local, 'priority', None)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised instead of queuing a request whose priority class would wait longer than allowed.
+    """
+
+
+class RequestScheduler(object):
+    """
+    Token bucket model of the exchange rate limit, handing out tokens by priority class.
+
+    Requests queue in a heap ordered by (priority, arrival), so an order leg always gets the next token ahead of
+    any queued book fetch. The last order_reserve tokens of the bucket can only be taken by ORDER requests, so a
+    triangle can send its legs right away even while the lower classes drain the budget. A request of a lower
+    class is shed with RateLimitExceeded when its expected wait exceeds max_wait of its class.
+    """
+    DEFAULT_MAX_WAIT = (None, 2.0, 0.5, 0.2)
+
+    def __init__(self, rate=10.0, burst=20, order_reserve=3, max_wait=DEFAULT_MAX_WAIT, registry=metrics.REGISTRY):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.order_reserve = order_reserve
+        self.max_wait = max_wait
+        self.registry = registry
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.queue_depth = [0] * len(PRIORITY_NAMES)
+        self.shed = [0] * len(PRIORITY_NAMES)
+        registry.register_gauge('rate_limit_queue_depth', self.queue_depths)
+        registry.register_gauge('rate_limit_shed_requests', self.shed_counts)
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def floor(self, priority):
+        """
+        :return: tokens that must be left in the bucket after a request of this priority
+        """
+        return 0.0 if priority == ORDER else self.order_reserve
+
+    def expected_wait(self, priority):
+        ahead = sum(1 for waiter in self.waiters if waiter[0] <= priority)
+        return max(0.0, (ahead + 1 + self.floor(priority) - self.tokens) / self.rate)
+
+    def acquire(self, priority):
+        """
+        Block until a token is granted to a request of this priority.
+        :raise RateLimitExceeded: if the request is shed
+        """
+        start_time = time.monotonic()
+        with self.condition:
+            self.refill()
+            max_wait = self.max_wait[priority]
+            if max_wait is not None and self.expected_wait(priority) > max_wait:
+                self.shed[priority] += 1
+                raise RateLimitExceeded("Shed %s request, the rate limit budget is exhausted."
+                                        % PRIORITY_NAMES[priority])
+            waiter = (priority, next(self.sequence))
+            heapq.heappush(self.waiters, waiter)
+            self.queue_depth[priority] += 1
+            try:
+                while True:
+                    self.refill()
+                    if self.waiters[0] == waiter and self.tokens - 1 >= self.floor(priority):
+                        heapq.heappop(self.waiters)
+                        self.tokens -= 1
+                        break
+                    if self.waiters[0] == waiter:
+                        self.condition.wait((1 + self.floor(priority) - self.tokens) / self.rate)
+                    else:
+                        self.condition.wait()
+            except BaseException:
+                self.waiters.remove(waiter)
+                heapq.heapify(self.waiters)
+                raise
+            finally:
+                self.queue_depth[priority] -= 1
+                # Let the next head of the queue check the bucket.
+                self.condition.notify_all()
+        self.registry.observe('rate_limit_wait_%s' % PRIORITY_NAMES[priority].lower(),
+                              time.monotonic() - start_time)
+
+    def try_acquire(self, priority):
+        """
+        Take a token for a request of this priority only if one is free with nobody queued.
+        :return: True if the token has been taken
+        """
+        with self.condition:
+            self.refill()
+            if self.waiters or self.tokens - 1 < self.floor(priority):
+                return False
+            self.tokens -= 1
+        self.registry.observe('rate_limit_wait_%s' % PRIORITY_NAMES[priority].lower(), 0.0)
+        return True
+
+    async def acquire_async(self, priority):
+        if self.try_acquire(priority):
+            # Uncontended, the token is taken without a thread hop.
+            return
+        await asyncio.get_event_loop().run_in_executor(None, self.acquire, priority)
+
+    def queue_depths(self):
+        return dict(zip(PRIORITY_NAMES, self.queue_depth))
+
+    def shed_counts(self):
+        return dict(zip(PRIORITY_NAMES, self.shed))
+
+
+class ScheduledClient(object):
+    """
+    Proxy of a Client or AsyncClient taking a RequestScheduler token before each public method call.
+
+    The priority of a call comes from ENDPOINT_PRIORITIES, HOUSEKEEPING for unlisted endpoints, unless the thread
+    overrides it with request_priority.
+    """
+
+    def __init__(self, client, scheduler):
+        self._client = client
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or not callable(attribute) or name in ('open', 'close', 'prepare_orders'):
+            return attribute
+        default_priority = ENDPOINT_PRIORITIES.get(name, HOUSEKEEPING)
+        scheduler = self._scheduler
+        if asyncio.iscoroutinefunction(attribute):
+            async def wrapper(*args, **kwargs):
+                await scheduler.acquire_async(default_priority)
+                return await attribute(*args, **kwargs)
+        else:
+            def wrapper(*args, **kwargs):
+                priority = getattr(_local, 'priority', None)
+                scheduler.acquire(default_priority if priority is None else priority)
+                return attribute(*args, **kwargs)
+        wrapper.__name__ = name
+        setattr(self, name, wrapper)
+        return wrapper
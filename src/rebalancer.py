@@ -0,0 +1,136 @@
+import collections
+
+from utility import *
+
+log = logging.getLogger(__name__)
+
+
+class RebalancePlanner(object):
+    """
+    Plan the balance orders bringing the scan coins and the two markets back to their target weights.
+
+    Each coin out of its band is traded once to its target against one of the markets, picked so that the markets
+    drift apart the least: a sale goes to the market furthest below its target, a purchase is paid by the one
+    furthest above. The net gap left between the markets is then closed with at most one order on the base symbol.
+    That is the fewest orders reaching the targets, each coin out of band needing one, and keeps the volume of the
+    base order down.
+
+    Planned orders are dicts priced from the order book right before they are created, see Helper.price_balance_order.
+    """
+    # A scan coin is sold above UPPER_BAND times its target and bought below LOWER_BAND times it.
+    UPPER_BAND = 1.25
+    LOWER_BAND = 0.60
+    # The markets are balanced when market_1's ratio to target is above UPPER_MARKET_BAND times market_2's, or below
+    # LOWER_MARKET_BAND times it.
+    UPPER_MARKET_BAND = 1.25
+    LOWER_MARKET_BAND = 0.75
+
+    def __init__(self, market_1, market_2, coins_info, target_weights=None):
+        """
+        :param target_weights: {coin: weight} of the balances, equal weights for the coins not listed or if None
+        """
+        self.market_1, self.market_2 = market_1, market_2
+        self.base_symbol = "%s-%s" % (market_2, market_1)
+        self.coins_info = coins_info
+        self.target_weights = target_weights or {}
+
+    def precision(self, coin):
+        return self.coins_info[coin]['tradePrecision']
+
+    def targets(self, usd_balance):
+        """
+        :return: {coin: USD value} each coin should hold
+        """
+        weights = dict((coin, self.target_weights.get(coin, 1.0)) for coin in usd_balance)
+        total_weight = sum(weights.values())
+        total = sum(usd_balance.values())
+        return dict((coin, total * weight / total_weight) for coin, weight in weights.items())
+
+    def plan(self, scan_coins, usd_balance, exchange_rate):
+        """
+        :param usd_balance: {coin: USD value} of the scan coins and the markets, updated with the expected result
+        :return: planned orders, sales first, then the base order and the purchases
+        """
+        targets = self.targets(usd_balance)
+        markets = (self.market_1, self.market_2)
+
+        def market_ratio(market):
+            return usd_balance[market] / targets[market]
+
+        gaps = [(usd_balance[coin] - targets[coin], coin) for coin in scan_coins
+                if not self.LOWER_BAND <= usd_balance[coin] / targets[coin] <= self.UPPER_BAND]
+        sales, purchases = [], []
+        for diff, coin in sorted(gaps, key=lambda gap: -abs(gap[0])):
+            amount = round(abs(diff) / exchange_rate[coin], self.precision(coin))
+            if diff > 0:
+                market = min(markets, key=market_ratio)
+                sales.append({'symbol': '%s-%s' % (coin, market), 'type': 'SELL', 'amount': amount,
+                              'price_side': 'BUY', 'price_factor': 1.0, 'price_precision': self.precision(market)})
+            else:
+                market = max(markets, key=market_ratio)
+                purchases.append({'symbol': '%s-%s' % (coin, market), 'type': 'BUY', 'amount': amount,
+                                  'price_side': 'SELL', 'price_factor': 1.0, 'price_precision': self.precision(market)})
+            usd_balance[coin] -= diff
+            usd_balance[market] += diff
+
+        base_orders = []
+        ratio = market_ratio(self.market_1) / market_ratio(self.market_2)
+        if ratio > self.UPPER_MARKET_BAND or ratio < self.LOWER_MARKET_BAND:
+            # Move diff USD from market_1 to market_2 so both end at the same ratio to their target.
+            target_1, target_2 = targets[self.market_1], targets[self.market_2]
+            diff = (usd_balance[self.market_1] * target_2 - usd_balance[self.market_2] * target_1) / \
+                   (target_1 + target_2)
+            amount = round(abs(diff) / exchange_rate[self.market_2], self.precision(self.market_2))
+            if diff > 0:
+                base_orders.append({'symbol': self.base_symbol, 'type': 'BUY', 'amount': amount, 'price_side': 'BUY',
+                                    'price_factor': 0.9995, 'price_precision': self.precision(self.market_2)})
+            else:
+                base_orders.append({'symbol': self.base_symbol, 'type': 'SELL', 'amount': amount, 'price_side': 'BUY',
+                                    'price_factor': 1.0005, 'price_precision': self.precision(self.market_2)})
+            usd_balance[self.market_1] -= diff
+            usd_balance[self.market_2] += diff
+        return sales + base_orders + purchases
+
+    @staticmethod
+    def flows(planned_order, exchange_rate):
+        """
+        :return: ((coin spent, amount), (coin received, amount)) of a planned order, valued at the exchange rates
+        """
+        coin, market = planned_order['symbol'].split('-')
+        amount = planned_order['amount']
+        value = amount * exchange_rate[coin] / exchange_rate[market]
+        if planned_order['type'] == 'BUY':
+            return (market, value), (coin, amount)
+        return (coin, amount), (market, value)
+
+    def waves(self, planned_orders, balance, exchange_rate):
+        """
+        Group the planned orders in waves of orders which can run concurrently: each wave only spends what the
+        balances held before it, the proceeds of the previous waves included.
+
+        :param balance: {coin: available amount}
+        :return: list of waves, lists of planned orders
+        """
+        available = collections.defaultdict(float, balance)
+        waves = []
+        pending = list(planned_orders)
+        while pending:
+            wave, deferred, proceeds = [], [], collections.defaultdict(float)
+            for planned_order in pending:
+                (spent, cost), (received, gain) = self.flows(planned_order, exchange_rate)
+                if available[spent] >= cost:
+                    available[spent] -= cost
+                    proceeds[received] += gain
+                    wave.append(planned_order)
+                else:
+                    deferred.append(planned_order)
+            if not wave:
+                # Not affordable at the exchange rates, may be at the book prices: try them all, the balance
+                # ledger reservation skips what the balances can't pay.
+                waves.append(deferred)
+                break
+            waves.append(wave)
+            for coin, gain in proceeds.items():
+                available[coin] += gain
+            pending = deferred
+        return waves
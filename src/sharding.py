@@ -0,0 +1,159 @@
+import multiprocessing
+import threading
+from multiprocessing.managers import BaseManager, DictProxy
+
+import flight_recorder
+from balance_ledger import BalanceStore
+from coin_scheduler import CoinScheduler
+from connection_manager import ConnectionManager
+from helper import Helper
+from log_setup import enable_queue_logging
+from market_data import MarketDataFeed
+from metrics import InstrumentedClient, MetricsServer
+from order_client import OrderClient
+from rate_limiter import RequestScheduler, ScheduledClient
+from utility import *
+from constants import *
+
+log = logging.getLogger(__name__)
+
+_balance_store = None
+_shard_stats = None
+
+
+def get_balance_store():
+    global _balance_store
+    if _balance_store is None:
+        _balance_store = BalanceStore()
+    return _balance_store
+
+
+def get_shard_stats():
+    global _shard_stats
+    if _shard_stats is None:
+        _shard_stats = {}
+    return _shard_stats
+
+
+class BalanceManager(BaseManager):
+    """
+    Server process holding the BalanceStore shared by the parent and every shard, so two shards reserving funds
+    for their triangles can never spend the same balance.
+    """
+
+
+BalanceManager.register('get_balance_store', get_balance_store)
+BalanceManager.register('get_shard_stats', get_shard_stats, DictProxy)
+
+
+def split_coins(coins, shards):
+    """
+    :return: list of at most shards non-empty coin lists, assigned round-robin
+    """
+    return [coins[i::shards] for i in range(min(shards, len(coins)))]
+
+
+def rate_share(rate_limit, burst, processes):
+    """
+    :param processes: processes sharing the account, the parent included
+    :return: (rate, burst) of the share of one process of the per account limit of the exchange
+    """
+    return rate_limit / processes, max(1, burst // processes)
+
+
+def run_shard(index, credentials, market_1, market_2, coins, balance_store, shard_stats, options, book_store=None):
+    """
+    Entry point of a shard process: its own Client session, connection pool, rate limit share and Helper, scanning
+    its own coins with detect_spread_and_fill. Order books come from book_store, the SharedBookStore fed by the
+    parent, when given.
+    """
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    if options.get('log_queue'):
+        enable_queue_logging()
+    flight_recorder.RECORDER.dump_dir = options.get('flight_dir', flight_recorder.RECORDER.dump_dir)
+    client = InstrumentedClient(OrderClient(credentials['api_key'], credentials['secret_key']))
+    request_scheduler = None
+    if options.get('rate_limit'):
+        # The exchange limit is per account, each shard gets its share of it, as does the parent.
+        rate, burst = rate_share(options['rate_limit'], options['rate_burst'], options['shards'] + 1)
+        request_scheduler = RequestScheduler(rate=rate, burst=burst)
+        client = ScheduledClient(client, request_scheduler)
+    if options.get('metrics_port'):
+        MetricsServer(options['metrics_port'] + 1 + index).start()
+    market_data = book_store
+    if not market_data and options.get('feed') == 'stream':
+        symbols = ['%s-%s' % (coin, market) for coin in coins for market in (market_1, market_2)]
+        market_data = MarketDataFeed(client, symbols + ['%s-%s' % (market_2, market_1)], url=options.get('feed_url'),
+                                     depth=Helper.ORDER_BOOK_DEPTH)
+        market_data.start()
+    helper = Helper(client, market_1, market_2, market_data=market_data, balance_store=balance_store,
+                    consistency_window=options.get('consistency_window', Helper.CONSISTENCY_WINDOW))
+    helper.transaction_helper.prepare_orders([symbol for coin in coins for symbol in helper.get_triangle_symbols(coin)])
+    ConnectionManager(client, helper.transaction_helper.pool_size(), helper.base_symbol,
+                      ping_interval=options.get('ping_interval', 20.0), scheduler=request_scheduler).start()
+    scheduler = CoinScheduler(coins, helper.TRADE_THRESHOLD)
+    log.info("Shard %d scanning %s", index, coins)
+
+    while True:
+        for _ in range(len(coins)):
+            coin = scheduler.next_coin()
+            filled = False
+            helper.last_spreads.pop(coin, None)
+            try:
+                filled = helper.detect_spread_and_fill(coin)
+            except Exception as e:
+                log.error("Shard %d failed to detect spread and create orders for it.", index)
+                log.error(e, exc_info=True)
+                time.sleep(1)
+            scheduler.record(coin, helper.last_spreads.get(coin), filled)
+            time.sleep(0.02)
+        shard_stats[index] = {'profit': helper.profit, 'trade_static': helper.trade_static}
+
+
+class ShardPool(threading.Thread):
+    """
+    Split the scan coins across worker processes and restart any that dies.
+
+    Stands in for the Trader thread in the controller: profit sums the shards' profits and setting stop
+    terminates them.
+    """
+
+    def __init__(self, credentials, market_1, market_2, coins, shards, balance_manager, options, book_store=None):
+        threading.Thread.__init__(self, name="ShardPool")
+        self.credentials = credentials
+        self.market_1, self.market_2 = market_1, market_2
+        self.coin_shards = split_coins(coins, shards)
+        self.balance_store = balance_manager.get_balance_store()
+        self.shard_stats = balance_manager.get_shard_stats()
+        self.options = dict(options, shards=len(self.coin_shards))
+        self.book_store = book_store
+        # Spawn rather than fork, the parent already runs threads holding locks.
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = {}
+        self.stop = False
+
+    @property
+    def profit(self):
+        return sum(stats['profit'] for stats in self.shard_stats.values())
+
+    def start_shard(self, index):
+        process = self.context.Process(target=run_shard, name="Shard-%d" % index, daemon=True,
+                                       args=(index, self.credentials, self.market_1, self.market_2,
+                                             self.coin_shards[index], self.balance_store, self.shard_stats,
+                                             self.options, self.book_store))
+        process.start()
+        self.processes[index] = process
+
+    def run(self):
+        for index in range(len(self.coin_shards)):
+            self.start_shard(index)
+        while not self.stop:
+            time.sleep(5)
+            for index, process in list(self.processes.items()):
+                if not process.is_alive() and not self.stop:
+                    log.error("Shard %d exited with code %s, restarting it.", index, process.exitcode)
+                    self.start_shard(index)
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(5)
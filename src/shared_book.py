@@ -0,0 +1,114 @@
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+HEADER_SIZE = 64
+
+
+def record_dtype(depth):
+    return np.dtype([('sequence', '<u8'), ('updated', '<f8'),
+                     ('bids', '<f8', (depth, 2)), ('asks', '<f8', (depth, 2))])
+
+
+class SharedBookStore(object):
+    """
+    Top-N order books of a fixed list of symbols in one shared memory block, readable from any process.
+
+    Every symbol has one writer, the process running the MarketDataFeed, and any number of readers. Records are
+    versioned seqlock style: the writer makes the sequence odd, writes the levels, then makes it even again, and a
+    reader retries when the sequence was odd or changed while it copied the levels, so neither side ever takes a
+    lock. The writer also beats a heartbeat in the header on every feed message; a reader treats every book as
+    stale once the heartbeat is older than max_age, the same way MarketDataFeed.get_ticker does. Tickers carry the
+    time.monotonic(), system wide, and the exchange time of the last beat, as those of MarketDataFeed do.
+
+    Pass name=None to create the block, or the name of an existing block to attach to it. A store can be handed to
+    another process as is, it re-attaches when unpickled.
+    """
+    READ_RETRIES = 100
+
+    def __init__(self, symbols, depth=5, name=None, max_age=3.0):
+        self.symbols = list(symbols)
+        self.index = dict((symbol, i) for i, symbol in enumerate(self.symbols))
+        self.depth = depth
+        self.max_age = max_age
+        dtype = record_dtype(depth)
+        size = HEADER_SIZE + dtype.itemsize * len(self.symbols)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        # time.time(), time.monotonic() and exchange time of the last beat
+        self.header = np.ndarray((3,), dtype='<f8', buffer=self.shm.buf, offset=0)
+        records = np.ndarray((len(self.symbols),), dtype=dtype, buffer=self.shm.buf, offset=HEADER_SIZE)
+        if self.owner:
+            self.header[:] = 0
+            records.fill(0)
+        self.sequence = records['sequence']
+        self.updated = records['updated']
+        self.bids = records['bids']
+        self.asks = records['asks']
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __reduce__(self):
+        return self.__class__, (self.symbols, self.depth, self.name, self.max_age)
+
+    def beat(self, exchange_time=None):
+        self.header[2] = exchange_time or 0.0
+        self.header[1] = time.monotonic()
+        self.header[0] = time.time()
+
+    def write(self, ticker):
+        """
+        :param ticker: order book in the Helper.get_order_book format
+        """
+        i = self.index[ticker['symbol']]
+        buy_levels = ticker.get('BUY_LEVELS') or [ticker['BUY']]
+        sell_levels = ticker.get('SELL_LEVELS') or [ticker['SELL']]
+        self.sequence[i] += 1
+        for levels, array in ((buy_levels, self.bids), (sell_levels, self.asks)):
+            count = min(len(levels), self.depth)
+            if count:
+                array[i, :count] = [level[:2] for level in levels[:count]]
+            array[i, count:] = 0
+        self.updated[i] = time.time()
+        self.sequence[i] += 1
+
+    def invalidate(self, symbol):
+        i = self.index[symbol]
+        self.sequence[i] += 1
+        self.updated[i] = 0
+        self.sequence[i] += 1
+
+    def get_ticker(self, symbol):
+        """
+        :return: ticker in the Helper.get_order_book format, or None if the book is not usable
+        """
+        i = self.index.get(symbol)
+        if i is None or time.time() - self.header[0] > self.max_age:
+            return None
+        for _ in range(self.READ_RETRIES):
+            sequence = int(self.sequence[i])
+            if sequence & 1:
+                continue
+            updated = float(self.updated[i])
+            bids = self.bids[i].tolist()
+            asks = self.asks[i].tolist()
+            if int(self.sequence[i]) == sequence:
+                break
+        else:
+            return None
+        buy_levels = [level for level in bids if level[1] > 0]
+        sell_levels = [level for level in asks if level[1] > 0]
+        if not updated or not buy_levels or not sell_levels:
+            return None
+        return {'symbol': symbol, 'BUY': buy_levels[0], 'SELL': sell_levels[0],
+                'BUY_LEVELS': buy_levels, 'SELL_LEVELS': sell_levels, 'received': float(self.header[1]),
+                'exchange_time': float(self.header[2]) or None}
+
+    def close(self):
+        self.header = self.sequence = self.updated = self.bids = self.asks = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,56 @@
+import numpy as np
+
+from constants import *
+
+
+class SpreadScanner(object):
+    """
+    Compute the triangular spreads of every coin listed on both markets from one get_tick snapshot.
+
+    Bid/ask prices of all coins on both markets are packed into arrays, so spread_12 (market_1 -> coin -> market_2)
+    and spread_21 (market_2 -> coin -> market_1) are computed for the whole exchange in one vectorized pass.
+    """
+
+    def __init__(self, market_1, market_2, threshold):
+        self.market_1 = market_1
+        self.market_2 = market_2
+        self.threshold = threshold
+
+    def pack(self, all_tickers):
+        """
+        Pack the tick snapshot into arrays.
+        :return: coins, bid/ask array of shape (len(coins), 4) as [bid_1, ask_1, bid_2, ask_2], base (bid, ask)
+        """
+        quotes = {}
+        base_quote = None
+        for ticker in all_tickers:
+            coin, market = ticker[COIN_TYPE], ticker[COIN_TYPE_PAIR]
+            if coin == self.market_2 and market == self.market_1:
+                base_quote = (ticker.get(BUY), ticker.get(SELL))
+            elif market == self.market_1 or market == self.market_2:
+                row = quotes.setdefault(coin, [np.nan] * 4)
+                offset = 0 if market == self.market_1 else 2
+                row[offset], row[offset + 1] = ticker.get(BUY) or np.nan, ticker.get(SELL) or np.nan
+        coins = list(quotes.keys())
+        prices = np.array([quotes[coin] for coin in coins], dtype=np.float64).reshape(len(coins), 4)
+        return coins, prices, base_quote
+
+    def scan(self, all_tickers):
+        """
+        :param all_tickers: response of client.get_tick()
+        :return: list of (spread, coin, direction) above the threshold, the largest spread first. direction is True
+                 for market_1 -> coin -> market_2 and False for the reverse, same as Helper.get_spread.
+        """
+        coins, prices, base_quote = self.pack(all_tickers)
+        if not coins or not base_quote or not all(base_quote):
+            return []
+        base_bid, base_ask = base_quote
+        bid_1, ask_1, bid_2, ask_2 = prices.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            spread_12 = bid_2 / ask_1 * base_bid - 1
+            spread_21 = bid_1 / ask_2 / base_ask - 1
+        spreads = np.fmax(spread_12, spread_21)
+        # NaN (coin missing on one market) and inf (zero quotes) never count as a spread.
+        candidates = np.flatnonzero(np.isfinite(spreads) & (spreads > self.threshold))
+        candidates = candidates[np.argsort(-spreads[candidates], kind='stable')]
+        return [(float(spreads[i]), coins[i], bool(spread_12[i] == spreads[i])) for i in candidates]
@@ -1,8 +1,14 @@
 import concurrent.futures
+import threading
 
 from kucoin.exceptions import *
-from requests.adapters import HTTPAdapter
 
+import flight_recorder
+import metrics
+from cleanup import CleanupCoordinator
+from deadlines import DeadlineManager
+from quotes import order_text
+from fill_tracker import FillTracker
 from utility import *
 
 log = logging.getLogger(__name__)
@@ -10,52 +16,79 @@ log = logging.getLogger(__name__)
 
 class TransactionHelper(object):
     MAX_RETRY = 3
+    WORKERS = 3
+    # Threads of the caller which may request concurrently with the executors, e.g. order book reads.
+    CALLER_THREADS = 2
 
-    def __init__(self, client):
+    def __init__(self, client, ledger=None):
         self.client = client
-        self.add_http_connection_pool()
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
-        self.reaction_count = 0
-        self.reaction_time = 0.0
+        self.ledger = ledger
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.WORKERS)
+        # Duplicates of slow requests, not queued behind the requests they duplicate.
+        self.hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.WORKERS)
+        # Single orders tracked concurrently, e.g. the balance orders, without holding the executor for their tracking.
+        self.order_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.WORKERS)
+        self.deadlines = DeadlineManager()
+        metrics.REGISTRY.register_gauge('deadlines', self.deadlines.stats)
+        self.fill_tracker = FillTracker(client)
+        self.fill_tracker.start()
+        self.fill_poll_step = 0.8
+        self.cleanup = CleanupCoordinator(client, self.fill_tracker)
+        # Orders located after a lost create_order response, each one claimed by a single caller.
+        self.located = set()
+        self.locate_lock = threading.Lock()
 
-    def add_http_connection_pool(self):
-        self.client.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=3))
+    def pool_size(self):
+        """
+        :return: number of HTTP connections the helper may use at once, for the connection pool of the client
+        """
+        return 3 * self.WORKERS + self.fill_tracker.WORKERS + self.cleanup.max_workers + self.CALLER_THREADS
+
+    def prepare_orders(self, symbols):
+        """
+        Prepare the order requests of the symbols ahead of the first trade, if the client supports it.
+        """
+        if hasattr(self.client, 'prepare_orders'):
+            self.client.prepare_orders(symbols)
 
     def list_active_orders(self, symbol):
         response = call_api_with_retry(self.client.get_active_orders, symbol)
         # Merge two lists
         return response['BUY'] + response['SELL']
 
+    def claim_order(self, order_id):
+        """
+        Claim an order located after a lost create_order response, unless it is another order of ours.
+        :return: True if the order is free to be tracked by the caller
+        """
+        with self.locate_lock:
+            if order_id in self.located or self.cleanup.is_registered(order_id) or self.fill_tracker.is_tracked(
+                    order_id):
+                return False
+            self.located.add(order_id)
+            return True
+
     def match_dealt_orders(self, order_params):
         dealt_orders = call_api_with_retry(self.client.get_symbol_dealt_orders,
                                            order_params['symbol'], order_params['type'], 6)['datas']
         for order in dealt_orders:
-            if order['direction'] == order_params['type'] and time.time() * 1000 - float(order['createdAt']) < 200000:
+            if order['direction'] == order_params['type'] and time.time() * 1000 - float(order['createdAt']) < 200000 \
+                    and self.claim_order(order['orderOid']):
                 return order['orderOid'], order['amount']
 
-    def check_order_dealt_amount(self, order_id, order_params):
-        dealt_orders = call_api_with_retry(self.client.get_symbol_dealt_orders,
-                                            order_params['symbol'], order_params['type'], 10)['datas']
-        deal_total = 0.0
-        for order in dealt_orders:
-            if order_id == order['orderOid']:
-                deal_total += float(order['amount'])
-        return order_id, deal_total
-
     def match_active_order(self, order_params):
         order_book = self.list_active_orders(order_params['symbol'])
         for order in order_book:
-            if order[1] == order_params['type'] and order[2] - order_params['price'] < 1e-9 and order[3] - order_params[
-                'amount'] < 1e-9:
+            if order[1] == order_params['type'] and abs(order[2] - order_params['price']) < 1e-9 and abs(
+                    order[3] - order_params['amount']) < 1e-9 and self.claim_order(order[5]):
                 return order[5]
 
     def create_order(self, order_params):
+        price, amount = order_text(order_params)
         log_json_utils(log.info, message="Creating an order.", symbol=order_params['symbol'], type=order_params['type'],
-                       price=str(order_params['price']), amount=str(order_params['amount']))
+                       price=price, amount=amount)
         try:
-            response = self.client.create_order(order_params['symbol'],
-                                                order_params['type'], str(order_params['price']),
-                                                str(order_params['amount']))
+            response = self.client.create_order(order_params['symbol'], order_params['type'], price, amount)
             if not response or "orderOid" not in response:
                 raise TypeError("None or invalid response type.")
             else:
@@ -114,76 +147,174 @@ class TransactionHelper(object):
             log.error("Failed: Only successfully created and dealt %d orders.", count)
             raise Exception("Failed to create and deal all requested orders")
 
-    def create_and_track_single_order(self, order_params, additional_wait_time=0):
+    def create_and_track_single_order(self, order_params, additional_wait_time=0, reserve_timeout=0.0):
+        reservation = self.reserve([order_params], reserve_timeout)
+        if reservation is False:
+            return 0.0
+        try:
+            return self.create_track_and_apply(order_params, additional_wait_time)
+        finally:
+            self.release(reservation)
+
+    def create_and_track_orders(self, order_params_list, additional_wait_time=0, reserve_timeout=0.0):
+        """
+        Create and track independent single orders concurrently, each with its own reservation.
+        :param reserve_timeout: seconds an order waits for the funds reserved by others, e.g. a triangle in flight
+        :return: deal ratios in the order of order_params_list, 0.0 for an order which failed
+        """
+        futures = [self.order_executor.submit(self.create_and_track_single_order, order_params, additional_wait_time,
+                                              reserve_timeout)
+                   for order_params in order_params_list]
+        deal_ratios = []
+        for future in futures:
+            try:
+                deal_ratios.append(future.result())
+            except Exception as e:
+                log.error("Error while creating a single order.")
+                log.error(e, exc_info=True)
+                deal_ratios.append(0.0)
+        return deal_ratios
+
+    def reserve(self, order_params_group, timeout=0.0):
+        """
+        Reserve the funds of the orders in the balance ledger.
+        :param timeout: seconds to wait for other reservations of the same assets to be released
+        :return: reservation id, None without ledger, or False if the balance is not enough
+        """
+        if not self.ledger:
+            return None
+        reservation = self.ledger.reserve(order_params_group, timeout)
+        if reservation is None:
+            log_json_utils(log.error, message="Not enough balance for the orders, skipping.", data=order_params_group)
+            return False
+        return reservation
+
+    def release(self, reservation):
+        if self.ledger and reservation is not None:
+            self.ledger.release(reservation)
+
+    def create_track_and_apply(self, order_params, additional_wait_time=0):
+        """
+        Create and track an order, then apply its dealt amount to the balance ledger.
+        """
+        deal_ratio = None
+        try:
+            deal_ratio = self.track_single_order(order_params, additional_wait_time)
+            return deal_ratio
+        finally:
+            if self.ledger:
+                if deal_ratio is None:
+                    # The order state is unknown, let the ledger catch up with the exchange.
+                    self.ledger.request_reconcile()
+                else:
+                    self.ledger.apply_fill(order_params, order_params['amount'] * deal_ratio)
+
+    def track_single_order(self, order_params, additional_wait_time=0):
         start_time = time.time()
         orderOid, deal_amount = self.create_order(order_params)
+        self.cleanup.register(order_params, orderOid)
         log_json_utils(log.info, message="Successfully created an order.", orderOid=orderOid,
                        symbol=order_params['symbol'],
                        type=order_params['type'])
-        self.reaction_count += 1
-        self.reaction_time += time.time() - start_time
+        metrics.REGISTRY.observe('order_reaction', time.time() - start_time)
+        flight_recorder.RECORDER.order_submit(order_params, deal_amount, time.time() - start_time)
         if abs(order_params['amount'] - deal_amount) < 1e-9:
             log.info("Order %s has been fully dealt.", orderOid)
             return 1.0
-        else:
-            for i in range(10 + additional_wait_time):
-                tmp_order_id, deal_amount = self.check_order_dealt_amount(orderOid, order_params)
-                deal_ratio = deal_amount / order_params['amount']
-                if orderOid == tmp_order_id and deal_ratio > 0.999:
-                    log.info("Order %s has been fully dealt.", orderOid)
-                    return 1.0
-                time.sleep(0.8 * i)
-            log_json_utils(log.error, message="The transaction didn't finished on time. Cancelling...",
-                           orderOid=orderOid, symbol=order_params['symbol'], type=order_params['type'],
-                           amount=order_params['amount'], deal_amount=deal_amount)
-            self.cancel_active_order(orderOid, order_params['type'], order_params['symbol'])
-            log.error("Successfully cancelled order %s", orderOid)
+        deal_amount = self.fill_tracker.track(orderOid, order_params,
+                                             self.tracking_timeout(additional_wait_time)).result()
+        deal_ratio = deal_amount / order_params['amount']
+        if deal_ratio > 0.999:
+            log.info("Order %s has been fully dealt.", orderOid)
+            return 1.0
+        if self.cleanup.is_confirmed(orderOid):
+            log.error("Order %s has been cancelled by the clean-up of its group.", orderOid)
             return deal_ratio
+        log_json_utils(log.error, message="The transaction didn't finished on time. Cancelling...",
+                       orderOid=orderOid, symbol=order_params['symbol'], type=order_params['type'],
+                       amount=order_params['amount'], deal_amount=deal_amount)
+        self.cancel_active_order(orderOid, order_params['type'], order_params['symbol'])
+        log.error("Successfully cancelled order %s", orderOid)
+        return deal_ratio
+
+    def tracking_timeout(self, additional_wait_time=0):
+        """
+        How long an order is tracked before it gets cancelled: learnt from how long orders take to be dealt, at most
+        the former fill_poll_step * i polling schedule.
+        """
+        polls = 10 + additional_wait_time
+        return self.deadlines.fill_deadline(self.fill_poll_step * polls * (polls - 1) / 2, polls / 10.0)
 
-    def deal_parallel_orders(self, order_params_group, timeout=60, additional_wait_time=0):
+    def deal_parallel_orders(self, order_params_group, timeout=None, additional_wait_time=0):
         """
         Create orders in parallel.
+        :param timeout: seconds to wait for the group, None to derive it from the tracking timeout and the latencies
         :return: ratio of dealt quantity against submitted quantity
         """
-        futures = [self.executor.submit(self.create_and_track_single_order, order_params, additional_wait_time) for order_params in
-                   order_params_group]
-        min_deal_ratio = 1.0
-        for future in concurrent.futures.as_completed(futures, timeout=timeout):
-            try:
-                deal_ratio = future.result()
-                min_deal_ratio = min(min_deal_ratio, deal_ratio)
-                if abs(1.0 - deal_ratio) >= 0.02:
+        if timeout is None:
+            timeout = self.deadlines.group_deadline(self.tracking_timeout(additional_wait_time))
+        reservation = self.reserve(order_params_group)
+        if reservation is False:
+            return 0.0
+        try:
+            self.cleanup.open_group(order_params_group)
+            futures = [self.executor.submit(self.create_track_and_apply, order_params, additional_wait_time) for
+                       order_params in order_params_group]
+        except Exception:
+            self.cleanup.forget(order_params_group)
+            self.release(reservation)
+            raise
+        group_done = self.release_when_done(futures, reservation, order_params_group)
+        try:
+            min_deal_ratio = 1.0
+            for future in concurrent.futures.as_completed(futures, timeout=timeout):
+                try:
+                    deal_ratio = future.result()
+                    min_deal_ratio = min(min_deal_ratio, deal_ratio)
+                    if abs(1.0 - deal_ratio) >= 0.02:
+                        self.trade_on_fail(order_params_group)
+                except Exception as e:
+                    log.error("Error while deal orders parallel.")
+                    log.error(e, exc_info=True)
                     self.trade_on_fail(order_params_group)
-            except Exception as e:
-                log.error("Error while deal orders parallel.")
-                log.error(e, exc_info=True)
-                self.trade_on_fail(order_params_group)
-                min_deal_ratio = 0.0
-        return min_deal_ratio
+                    min_deal_ratio = 0.0
+            return min_deal_ratio
+        finally:
+            group_done()
 
-    def idle_all_executors(self):
+    def release_when_done(self, futures, reservation, order_params_group):
         """
-        The website may periodically kill the session. Call API periodically to keep all connections in the pool alive.
-        :return:
+        Release the reservation of an order group and forget its clean-up state once both the caller and every leg
+        are done with it: legs still creating or tracking their orders after the group timed out keep their funds.
+        :param futures: futures of the legs, concurrent or asyncio ones
+        :return: function the caller calls once done with the group
         """
-        log.info("Idle executors.")
-        futures = [self.executor.submit(self.list_active_orders, symbol) for symbol
-                   in ["ETH-BTC", "VEN-BTC", "VEN-ETH"]]
-        for future in concurrent.futures.as_completed(futures, timeout=10):
-            try:
-                future.result()
-            except Exception as e:
-                log.error("Error while keeping executors alive.")
-                log.error(e, exc_info=True)
+        remaining = [len(futures) + 1]
+        lock = threading.Lock()
+
+        def done(_=None):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            self.release(reservation)
+            self.cleanup.forget(order_params_group)
+
+        for future in futures:
+            future.add_done_callback(done)
+        return done
 
     def trade_on_success(self, symbols):
         pass
 
     def trade_on_fail(self, order_params_group):
-        log.info("Clean-up, cancelling all active orders.")
+        """
+        Cancel what is left of a failed order group, once however many of its legs failed.
+        :return: dealt amounts and residual position of the group, see CleanupCoordinator.cleanup, None on failure
+        """
+        log.info("Clean-up, cancelling the orders of the group.")
         try:
-            for order_params in order_params_group:
-                call_api_with_retry(self.client.cancel_all_orders, symbol=order_params['symbol'])
+            return self.cleanup.cleanup(order_params_group)
         except Exception as e:
-            log.error("Failed to cancel all active orders.")
+            log.error("Failed to clean up the order group.")
             log.error(e, exc_info=True)
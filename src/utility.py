@@ -1,4 +1,6 @@
+import asyncio
 import errno
+import itertools
 import json
 import logging
 import os
@@ -6,6 +8,10 @@ import signal
 import time
 from functools import wraps
 
+import metrics
+from quotes import json_default
+from rate_limiter import RateLimitExceeded
+
 logger = logging.getLogger()
 
 MAX_RETRY = 3
@@ -22,14 +28,38 @@ def call_api_with_retry(fun, *args, **kwargs):
     for i in range(MAX_RETRY):
         try:
             return fun(*args, **kwargs)
+        except RateLimitExceeded:
+            # Shed by the scheduler, retrying would only queue it again.
+            raise
         except Exception as e:
             logger.error('An unexpected error happened while calling %s', fun.__name__)
             logger.error(e)
+        metrics.REGISTRY.count_retry(fun.__name__)
         exponential_delay(0.2, i)
     # Final attempt.
     return fun(*args, **kwargs)
 
 
+async def async_call_api_with_retry(fun, *args, **kwargs):
+    """
+    Coroutine version of call_api_with_retry, backs off without blocking the event loop.
+    :param fun: coroutine function to call
+    """
+    for i in range(MAX_RETRY):
+        try:
+            return await fun(*args, **kwargs)
+        except RateLimitExceeded:
+            # Shed by the scheduler, retrying would only queue it again.
+            raise
+        except Exception as e:
+            logger.error('An unexpected error happened while calling %s', fun.__name__)
+            logger.error(e)
+        metrics.REGISTRY.count_retry(fun.__name__)
+        await asyncio.sleep(0.2 * (2 ** i))
+    # Final attempt.
+    return await fun(*args, **kwargs)
+
+
 def exponential_delay(coeff, i):
     time.sleep(coeff * (2 ** i))
 
@@ -65,23 +95,84 @@ def get_credentials(filename):
             return json.load(f)
 
 
+def walk_levels(levels, quantity):
+    """
+    Take a quantity from order book levels, best level first.
+    :param levels: list of [price, amount]
+    :return: (total value, worst price taken), (None, None) if the levels are not deep enough
+    """
+    value, remaining = 0.0, quantity
+    for price, amount in levels:
+        taken = min(amount, remaining)
+        value += taken * price
+        remaining -= taken
+        if remaining <= 1e-12:
+            return value, price
+    return None, None
+
+
+def walk_levels_by_value(levels, value):
+    """
+    Spend a value on order book levels, best level first.
+    :return: (total quantity, worst price taken), (None, None) if the levels are not deep enough
+    """
+    quantity, remaining = 0.0, value
+    for price, amount in levels:
+        taken = min(amount * price, remaining)
+        quantity += taken / price
+        remaining -= taken
+        if remaining <= 1e-12:
+            return quantity, price
+    return None, None
+
+
+class JsonMessage(object):
+    """
+    Log message serialized to JSON only when the record is handled, and not at all if the level is disabled.
+    With queue logging that happens in the listener thread, see DeferredQueueHandler, so the data must not be
+    changed by the caller afterwards, log_json_utils logs a snapshot of it.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, default=json_default)
+
+
+def snapshot(value):
+    """
+    Copy the dicts and lists of a logged value, and convert the objects having a to_dict, e.g. OrderParams, leaving
+    the immutable values shared. Much cheaper than serializing it.
+    """
+    if isinstance(value, dict):
+        return dict((key, snapshot(item)) for key, item in value.items())
+    if isinstance(value, (list, set)):
+        return [snapshot(item) for item in value]
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    return value
+
+
 def log_json_utils(log_fun, **kwargs):
-    log_fun(json.dumps(kwargs))
+    log_fun(JsonMessage(snapshot(kwargs)))
+
 
+_sample_counters = {}
 
-def acquire_semaphore(semaphore, timeout=60):
-    logger.info("Acquiring a semaphore in order to make create/delete order operations.")
-    semaphore_status = semaphore.acquire(timeout=timeout)
-    if semaphore_status:
-        logger.info("Successfully acquired a semaphore.")
-    else:
-        logger.error("The semaphore acquirement timed out. Bypassing semaphore.")
 
+def sample_log(key, every):
+    """
+    Sample a hot path log line.
+    :param every: log 1 call out of every, never if 0
+    :return: True if this call of key should log
+    """
+    if not every:
+        return False
+    counter = _sample_counters.get(key)
+    if counter is None:
+        counter = _sample_counters.setdefault(key, itertools.count())
+    return next(counter) % every == 0
 
-def release_semaphore(semaphore):
-    logger.info("Releasing a semaphore.")
-    try:
-        semaphore.release()
-    except ValueError as e:
-        logger.error(e)
 
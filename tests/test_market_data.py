@@ -0,0 +1,122 @@
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from feed_stub_server import FeedStubServer
+from market_data import MarketDataFeed
+
+SYMBOL = 'NEO-BTC'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.01)
+    raise AssertionError("Timed out waiting for the feed.")
+
+
+class SnapshotClient(object):
+    """
+    REST side of the feed: order book snapshots stamped with the time they were served at.
+    """
+
+    def __init__(self, levels):
+        self.levels = levels
+        self.snapshots = 0
+        self.lock = threading.Lock()
+
+    def get_order_book(self, symbol, group=None, limit=None):
+        with self.lock:
+            self.snapshots += 1
+            return {'BUY': [list(level) for level in self.levels['BUY']],
+                    'SELL': [list(level) for level in self.levels['SELL']],
+                    'timestamp': int(time.time() * 1000)}
+
+
+class MarketDataFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FeedStubServer(port=free_port())
+        self.server.start()
+        self.assertTrue(self.server.started.wait(5))
+        self.client = SnapshotClient({'BUY': [[0.0010, 5.0], [0.0009, 7.0]], 'SELL': [[0.0011, 3.0], [0.0012, 4.0]]})
+        self.feed = MarketDataFeed(self.client, [SYMBOL], url=self.server.url, ping_interval=0.1, resync_interval=60.0,
+                                   depth=2)
+        self.feed.start()
+        self.ticker = wait_for(lambda: self.feed.get_ticker(SYMBOL))
+
+    def tearDown(self):
+        self.feed.stop = True
+        self.server.shutdown()
+        self.feed.join(5)
+
+    def publish(self, side, price, count, action='ADD', timestamp=None):
+        self.server.publish(SYMBOL, side, price, count, action, timestamp).result(5)
+
+    def wait_for_level(self, side, price, count):
+        def matches():
+            ticker = self.feed.get_ticker(SYMBOL)
+            levels = dict((level[0], level[1]) for level in ticker[side + '_LEVELS']) if ticker else {}
+            return abs(levels.get(price, 0.0) - count) < 1e-9
+        wait_for(matches)
+
+    def test_snapshot(self):
+        self.assertEqual(self.ticker['BUY'], [0.0010, 5.0])
+        self.assertEqual(self.ticker['SELL'], [0.0011, 3.0])
+        self.assertEqual(self.ticker['BUY_LEVELS'], [[0.0010, 5.0], [0.0009, 7.0]])
+        self.assertEqual(self.ticker['SELL_LEVELS'], [[0.0011, 3.0], [0.0012, 4.0]])
+
+    def test_add_and_cancel(self):
+        time.sleep(0.01)
+        self.publish('BUY', 0.0010, 2.0, 'ADD')
+        self.wait_for_level('BUY', 0.0010, 7.0)
+        self.publish('SELL', 0.0011, 1.0, 'CANCEL')
+        self.wait_for_level('SELL', 0.0011, 2.0)
+        self.publish('SELL', 0.0011, 2.0, 'CANCEL')
+        wait_for(lambda: self.feed.get_ticker(SYMBOL)['SELL'] == [0.0012, 4.0])
+
+    def test_updates_in_snapshot_are_dropped(self):
+        snapshot_time = self.feed.books[SYMBOL].snapshot_time
+        self.publish('BUY', 0.0010, 2.0, 'ADD', timestamp=snapshot_time - 5)
+        time.sleep(0.01)
+        self.publish('BUY', 0.0009, 1.0, 'ADD')
+        self.wait_for_level('BUY', 0.0009, 8.0)
+        self.assertEqual(self.feed.get_ticker(SYMBOL)['BUY'], [0.0010, 5.0])
+
+    def test_crossed_book_resyncs(self):
+        snapshots = self.client.snapshots
+        self.client.levels = {'BUY': [[0.0010, 1.0]], 'SELL': [[0.0013, 1.0]]}
+        time.sleep(0.01)
+        self.publish('BUY', 0.0011, 1.0, 'ADD')
+        wait_for(lambda: self.client.snapshots > snapshots)
+        self.wait_for_level('SELL', 0.0013, 1.0)
+        ticker = self.feed.get_ticker(SYMBOL)
+        self.assertEqual(ticker['BUY'], [0.0010, 1.0])
+        self.assertFalse(self.feed.books[SYMBOL].is_crossed())
+
+    def test_reconnect(self):
+        snapshots = self.client.snapshots
+        self.client.levels = {'BUY': [[0.0008, 2.0]], 'SELL': [[0.0014, 2.0]]}
+        self.server.disconnect()
+        wait_for(lambda: self.client.snapshots > snapshots)
+        self.wait_for_level('SELL', 0.0014, 2.0)
+        time.sleep(0.01)
+        self.publish('BUY', 0.0008, 1.0, 'ADD')
+        self.wait_for_level('BUY', 0.0008, 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()